@@ -3,4 +3,13 @@ from .schema import register_field, register_class, register_attribute
 from .schema import validate
 from .pmsstypes import TYPES, parser
 from .functional import init, usage, register_ruleset, delete_ruleset
-from .rulesets import CombinedRuleset, ArgsRuleset, SimpleEnvsRuleset, YAMLFileRuleset, PMSSFileRuleset
+from .rulesets import CombinedRuleset, ArgsRuleset, SimpleEnvsRuleset, YAMLFileRuleset, PMSSFileRuleset, SQLiteRuleset
+from .vectorized import ContextBatch
+
+
+def __getattr__(name):
+    # `asyncio` is slow to import, and most programs never need it
+    if name == 'AsyncSettings':
+        from .asyncsettings import AsyncSettings
+        return AsyncSettings
+    raise AttributeError(f"module 'pmss' has no attribute '{name}'")
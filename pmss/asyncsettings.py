@@ -0,0 +1,291 @@
+'''
+Settings for `asyncio` code, where `await settings.get(...)` never
+blocks the event loop.
+
+Rulesets can take part in one of two ways:
+
+* Asynchronous rulesets implement `async def aload(self)` and
+  `async def aquery(self, key, context)`, with the same contracts as
+  `load()` and `query()`. We await those directly.
+* Everything else is a plain, synchronous ruleset. Those which may
+  block on I/O (see `Ruleset.blocking`) are called on a thread, in
+  `executor` (the loop's default executor if `None`). The rest only
+  touch memory, so we call them directly; a trip to a thread would
+  cost far more than the lookup.
+
+Concurrent lookups of the same key and context share one resolution.
+As with `Settings`, if `cache_size` is given, resolved values are kept
+in an LRU cache.
+
+Use each `AsyncSettings` from a single event loop.
+'''
+
+import asyncio
+
+import pmss.cache
+import pmss.rulesets
+import pmss.schema
+
+
+def _is_async(ruleset):
+    return hasattr(ruleset, 'aquery')
+
+
+class AsyncSettings():
+    '''
+    The same interface as `Settings` for reading (`get`, `get_many`,
+    and `settings.key()`), but with coroutines. Since loading may do
+    I/O, it's not done in the constructor: call `await
+    settings.load()` first.
+    '''
+    def __init__(
+            self,
+            rulesets,
+            cache_size=None,  # Keep up to this many resolved values in an LRU cache
+            executor=None
+    ):
+        self.ruleset = pmss.rulesets.CombinedRuleset(rulesets, cache_size=cache_size)
+        self.executor = executor
+        self.inflight = {}
+
+    async def _call(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    async def load(self):
+        '''
+        Load all of our rulesets, concurrently.
+        '''
+        loads = []
+        for ruleset in self.ruleset.rulesets:
+            if hasattr(ruleset, 'aload'):
+                loads.append(ruleset.aload())
+            else:
+                # Timed, and under the ruleset's reload lock, as in
+                # `CombinedRuleset.load()`
+                loads.append(self._call(pmss.rulesets._load, ruleset))
+        await asyncio.gather(*loads)
+        self.ruleset.loaded = True
+        self.ruleset.ruleset_changed(self.ruleset)
+
+    async def check_changes(self):
+        '''
+        Reload synchronous rulesets whose sources changed. Those which
+        block are checked together, on one thread.
+        '''
+        blocking = []
+        for ruleset in self.ruleset.rulesets:
+            if _is_async(ruleset):
+                continue
+            if ruleset.blocking:
+                blocking.append(ruleset)
+            else:
+                ruleset.check_changes()
+        if blocking:
+            await self._call(lambda: [ruleset.check_changes() for ruleset in blocking])
+
+    async def _best_match(self, key, context):
+        '''
+        The cascade of `CombinedRuleset.resolve`: the first ruleset
+        with any matching selector wins.
+        '''
+        rulesets = self.ruleset.rulesets
+        position = 0
+        while position < len(rulesets):
+            ruleset = rulesets[position]
+            position += 1
+            if _is_async(ruleset):
+                match = pmss.rulesets._most_specific(await ruleset.aquery(key, context))
+            elif ruleset.blocking:
+                # Ask a run of blocking rulesets on one thread
+                run = [ruleset]
+                while position < len(rulesets) and not _is_async(rulesets[position]) and rulesets[position].blocking:
+                    run.append(rulesets[position])
+                    position += 1
+                match = await self._call(_first_match, run, key, context)
+            else:
+                match = ruleset.best_match(key, context)
+            if match:
+                return match
+        return None
+
+    async def _resolve(self, key, context, cache_key):
+        await self.check_changes()
+        stats = self.ruleset.stats
+        cache = self.ruleset.cache
+        if cache is not None and cache_key is not None:
+            cached = cache.get(cache_key)
+            if cached is not pmss.cache.MISSING:
+                value, match = cached
+                if stats is not None:
+                    stats.resolved(key, match, cached=True)
+                return value
+            generation = cache.generation
+        match = await self._best_match(key, context)
+        if stats is not None:
+            stats.resolved(key, match)
+        value = self.ruleset.parse(key, match)
+        if cache is not None and cache_key is not None:
+            # As in `CombinedRuleset`, with the rule it came from
+            cache.put(cache_key, (value, match), generation)
+        return value
+
+    async def get(self, key, *args, id=None, types=[], classes=[], attributes={}, default=None):
+        context = {
+            "id": id,
+            "types": types,
+            "classes": classes,
+            "attributes": attributes
+        }
+        cache_key = pmss.cache.context_key(key, context)
+        if cache_key is None:
+            results = await self._resolve(key, context, None)
+        else:
+            future = self.inflight.get(cache_key)
+            if future is None:
+                future = asyncio.ensure_future(self._resolve(key, context, cache_key))
+                self.inflight[cache_key] = future
+                future.add_done_callback(lambda done: self.inflight.pop(cache_key, None))
+            # One caller giving up shouldn't cancel the others' lookup
+            results = await asyncio.shield(future)
+        if results is None:
+            return default
+        return results
+
+    async def get_many(self, keys, *args, id=None, types=[], classes=[], attributes={}):
+        '''
+        Look up several keys with the same context, concurrently,
+        returning a dictionary of `{key: value}`. If some values can't
+        be parsed, this raises one `pmss.rulesets.ParseErrors` covering
+        all of them.
+        '''
+        keys = list(dict.fromkeys(keys))
+        values = await asyncio.gather(
+            *(self.get(key, id=id, types=types, classes=classes, attributes=attributes) for key in keys),
+            return_exceptions=True
+        )
+        errors = {}
+        for key, value in zip(keys, values):
+            if isinstance(value, ValueError):
+                errors[key] = value
+            elif isinstance(value, BaseException):
+                raise value
+        if errors:
+            raise pmss.rulesets.ParseErrors(errors)
+        return dict(zip(keys, values))
+
+    def __getattr__(self, key):
+        '''
+        Enum-style access to pmss.schema.fields, e.g. `await
+        settings.hostname()`.
+        '''
+        if key in pmss.schema.default_schema.fields_by_name:
+            async def getter(**kwargs):
+                return await self.get(key, **kwargs)
+            return getter
+
+        raise ValueError(f"Invalid Key: {key}")
+
+    def __dir__(self):
+        return sorted(pmss.schema.default_schema.fields_by_name)
+
+    def cache_info(self):
+        '''
+        Hit / miss counters for the resolution cache, or `None` if
+        caching is disabled.
+        '''
+        return self.ruleset.cache_info()
+
+    def debug_dump(self):
+        return self.ruleset.debug_dump()
+
+
+def _first_match(rulesets, key, context):
+    for ruleset in rulesets:
+        match = ruleset.best_match(key, context)
+        if match:
+            return match
+    return None
+
+
+def test_load_under_concurrent_reloads():
+    import os
+    import sys
+    import tempfile
+    import threading
+
+    import pmss.pmsstypes
+
+    keys = ("test_async_first", "test_async_second")
+    for key in keys:
+        if key not in pmss.schema.default_schema.fields_by_name:
+            pmss.schema.register_field(name=key, type=pmss.pmsstypes.TYPES.integer)
+
+    def write(filename, version):
+        # Explicit modification times, so `'stat'` sees every version
+        rules = "".join(f"    {key}: {version};\n" for key in keys)
+        with open(filename + '.tmp', 'w') as f:
+            f.write(f"* {{\n{rules}}}\n.reader {{\n{rules}}}\n")
+        os.utime(filename + '.tmp', ns=(version, version))
+        os.replace(filename + '.tmp', filename)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'versions.pmss')
+        write(filename, 1)
+        ruleset = pmss.rulesets.PMSSFileRuleset(filename, watch='stat')
+        settings = AsyncSettings([ruleset])
+        stop = threading.Event()
+        errors = []
+
+        def read():
+            latest = 0
+            try:
+                while not stop.is_set():
+                    values = settings.ruleset.query_many(keys, {"classes": ["reader"]})
+                    first, second = (values[key] for key in keys)
+                    assert first == second, f"Mixed versions: {values}"
+                    assert first >= latest, f"Went back from version {latest} to {first}"
+                    latest = first
+            except Exception as e:
+                errors.append(e)
+
+        def reload():
+            # As the watcher thread would
+            try:
+                while not stop.is_set():
+                    ruleset.reload()
+            except Exception as e:
+                errors.append(e)
+
+        def write_versions():
+            for version in range(2, 500):
+                write(filename, version)
+            stop.set()
+
+        async def load():
+            await settings.load()
+            threads = [threading.Thread(target=target) for target in (read, read, reload, write_versions)]
+            for thread in threads:
+                thread.start()
+            try:
+                while not stop.is_set():
+                    await settings.load()
+            finally:
+                stop.set()
+                for thread in threads:
+                    thread.join()
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+        try:
+            asyncio.run(load())
+        finally:
+            sys.setswitchinterval(interval)
+        assert not errors, errors[0]
+        assert ruleset.load_seconds is not None
+        assert settings.ruleset.query("test_async_first", {}) == 499
+
+
+if __name__ == "__main__":
+    test_load_under_concurrent_reloads()
+    print("All test cases passed successfully.")
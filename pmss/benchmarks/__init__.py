@@ -0,0 +1,10 @@
+'''
+Benchmarks for pmss. These are not tests; they print timings (and
+memory use) for synthetic workloads, so we can see the effect of
+changes to the hot paths. Each module can be run directly, e.g.:
+
+    python -m pmss.benchmarks.selectors
+
+`pmss.benchmarks.suite` runs the whole pipeline on one large
+deployment, writing JSON, and compares two such runs.
+'''
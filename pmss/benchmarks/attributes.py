@@ -0,0 +1,102 @@
+'''
+Lookups against thousands of rules using attribute operators, such as
+`[email$=@district12.org]` or `[school^=mvs12_]`, with the
+`SelectorIndex` (tries, word lookups, and an Aho-Corasick automaton),
+against the naive loop: `match()` every rule, in order of precedence,
+until one does. Both must give the same answers.
+
+    python -m pmss.benchmarks.attributes [rules]
+'''
+
+import sys
+import time
+
+import pmss.loadfile
+import pmss.selectorindex
+
+KEY = "roster_source"
+
+
+def sheet(rules):
+    '''
+    A quarter of the rules each for `$=`, `^=`, `~=`, and `*=`.
+    '''
+    blocks = []
+    for n in range(rules):
+        operator = n % 4
+        if operator == 0:
+            selector = f"[email$=@district{n}.org]"
+        elif operator == 1:
+            selector = f"[school^=mvs{n}_]"
+        elif operator == 2:
+            selector = f"[tags~=cohort{n}]"
+        else:
+            selector = f"[path*=-unit{n}-]"
+        blocks.append(f"{selector} {{\n    {KEY}: source{n};\n}}\n")
+    return "".join(blocks)
+
+
+def contexts(rules, count=2000):
+    '''
+    Contexts which each match a few rules, and some which match none.
+    '''
+    return [
+        {"attributes": {
+            "email": f"teacher{n}@district{(n * 7919) % (rules * 2)}.org",
+            "school": f"mvs{(n * 104729) % rules}_east",
+            "tags": f"staff cohort{(n * 31) % (rules * 2)} 2024",
+            "path": f"course-unit{(n * 13) % rules}-week{n % 10}"
+        }}
+        for n in range(count)
+    ]
+
+
+def _naive(entries, context):
+    for selector, value in entries:
+        if selector.match(**context):
+            return [selector, value]
+    return None
+
+
+def _seconds_per_lookup(function, contexts):
+    start = time.perf_counter()
+    for context in contexts:
+        function(context)
+    return (time.perf_counter() - start) / len(contexts)
+
+
+def run(rules=10000):
+    results = pmss.loadfile.load_pmss_string(sheet(rules), provenance="benchmark", backend='descent')
+
+    start = time.perf_counter()
+    selector_index = pmss.selectorindex.SelectorIndex(results[KEY])
+    index_time = time.perf_counter() - start
+
+    queries = contexts(rules)
+    entries = selector_index.entries
+    indexed = _seconds_per_lookup(selector_index.best_match, queries)
+    # The naive loop is slow, so it gets fewer contexts
+    naive_queries = queries[:max(1, len(queries) * 1000 // rules)]
+    naive = _seconds_per_lookup(lambda context: _naive(entries, context), naive_queries)
+
+    matched = 0
+    for context in naive_queries:
+        expected = _naive(entries, context)
+        assert selector_index.best_match(context) == expected, f"Index disagrees with the naive loop for {context}"
+        matched += expected is not None
+
+    return {
+        "rules": len(entries),
+        "contexts_checked": len(naive_queries),
+        "contexts_matched": matched,
+        "index_seconds": index_time,
+        "indexed_microseconds": indexed * 1e6,
+        "naive_microseconds": naive * 1e6,
+        "speedup": naive / indexed
+    }
+
+
+if __name__ == '__main__':
+    rules = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for name, value in run(rules).items():
+        print(f"{name:>22}: {value:,.2f}" if isinstance(value, float) else f"{name:>22}: {value:,}")
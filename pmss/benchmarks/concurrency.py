@@ -0,0 +1,191 @@
+'''
+Lookups from many threads at once, while rulesets reload underneath
+them.
+
+`run()` measures lookup throughput with 1, 2, 4, ... reader threads,
+with and without the resolution cache. Reads take no locks (see
+`pmss.rulesets.IndexedRuleset`), so on a free-threaded Python, this
+should scale with cores; with the GIL, it can't, and the point is
+that it doesn't get worse.
+
+`stress()` has readers check what they see while another thread
+rewrites the file and adds and deletes a ruleset: without a cache,
+both keys of a version always come from the same load, and a reader
+never goes back to an older version (see `CombinedRuleset` for the
+cached case). It raises `AssertionError` if not. The same checks run
+as a test in `pmss.rulesets`.
+
+    python -m pmss.benchmarks.concurrency [max threads] [seconds]
+    python -m pmss.benchmarks.concurrency stress [seconds]
+'''
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pmss.pmsstypes
+import pmss.rulesets
+import pmss.schema
+from pmss.benchmarks.generators import school_sheet
+
+KEYS = ("roster_source", "server_port")
+STRESS_KEYS = ("stress_first", "stress_second")
+
+
+def _register(keys, type_):
+    for key in keys:
+        if key not in pmss.schema.default_schema.fields_by_name:
+            pmss.schema.register_field(name=key, type=type_)
+
+
+def _contexts(count=1000):
+    return [
+        {"types": ["roster"], "classes": [f"class{n % 20}"], "attributes": {"school": f"school{n % 500}"}}
+        for n in range(count)
+    ]
+
+
+def _run_threads(count, target):
+    '''
+    Run `target(stop)` on `count` threads, started together, and
+    return their results once they're done.
+    '''
+    start = threading.Barrier(count + 1)
+    stop = threading.Event()
+    results = [None] * count
+    errors = []
+
+    def worker(n):
+        start.wait()
+        try:
+            results[n] = target(stop)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(count)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    return threads, stop, results, errors
+
+
+def _throughput(ruleset, threads, seconds):
+    contexts = _contexts()
+
+    def read(stop):
+        lookups = 0
+        while not stop.is_set():
+            for context in contexts:
+                for key in KEYS:
+                    ruleset.query(key, context)
+            lookups += len(contexts) * len(KEYS)
+        return lookups
+
+    workers, stop, results, errors = _run_threads(threads, read)
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+    return sum(results) / seconds
+
+
+def run(max_threads=8, seconds=2.0, rules=50000):
+    _register(KEYS, pmss.pmsstypes.TYPES.string)
+    report = {"free_threaded": not getattr(sys, '_is_gil_enabled', lambda: True)()}
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'sheet.pmss')
+        with open(filename, 'w') as f:
+            f.write(school_sheet(rules=rules))
+        for cache_size in (None, 4096):
+            ruleset = pmss.rulesets.CombinedRuleset(
+                [pmss.rulesets.PMSSFileRuleset(filename, rulesetid="benchmark", backend='descent')],
+                cache_size=cache_size
+            )
+            ruleset.load()
+            name = "cached" if cache_size else "uncached"
+            threads = 1
+            while threads <= max_threads:
+                report[f"{name}_{threads}_threads_lookups_per_second"] = _throughput(ruleset, threads, seconds)
+                threads *= 2
+    return report
+
+
+def _write_version(filename, version):
+    '''
+    Every key of a sheet has the same value, `version`. The
+    modification time is set explicitly, so `'stat'` sees every
+    version, however coarse the file system's clock.
+    '''
+    rules = "".join(f"    {key}: {version};\n" for key in STRESS_KEYS)
+    with open(filename + '.tmp', 'w') as f:
+        f.write(f"* {{\n{rules}}}\n.reader {{\n{rules}}}\n")
+    os.utime(filename + '.tmp', ns=(version, version))
+    os.replace(filename + '.tmp', filename)
+
+
+def stress(seconds=5.0, readers=4, cache_size=None):
+    '''
+    Returns `{"versions": ..., "lookups": ...}`: how many versions the
+    writer published, and how many lookups the readers made.
+    '''
+    _register(STRESS_KEYS, pmss.pmsstypes.TYPES.integer)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'stress.pmss')
+        extra_filename = os.path.join(directory, 'extra.pmss')
+        _write_version(filename, 1)
+        _write_version(extra_filename, 0)
+        ruleset = pmss.rulesets.CombinedRuleset(
+            [pmss.rulesets.PMSSFileRuleset(filename, rulesetid="stress", watch='stat')],
+            cache_size=cache_size
+        )
+        ruleset.load()
+        context = {"classes": ["reader"]}
+
+        def read(stop):
+            lookups = 0
+            latest = 0
+            while not stop.is_set():
+                values = ruleset.query_many(STRESS_KEYS, context)
+                first, second = (values[key] for key in STRESS_KEYS)
+                if cache_size is None:
+                    # Without a cache, both come from one snapshot,
+                    # and never an older one
+                    assert first == second, f"Mixed versions: {values}"
+                    assert first >= latest, f"Went back from version {latest} to {first}"
+                    latest = first
+                lookups += 1
+            return lookups
+
+        workers, stop, results, errors = _run_threads(readers, read)
+        version = 1
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline and not stop.is_set():
+            version += 1
+            _write_version(filename, version)
+            # Changing the stack mustn't disturb readers either
+            ruleset.add_ruleset(pmss.rulesets.PMSSFileRuleset(extra_filename, rulesetid="extra"))
+            ruleset.delete_ruleset("extra")
+        stop.set()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+    return {"versions": version, "lookups": sum(results)}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'stress':
+        seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+        for cache_size in (None, 128):
+            for name, value in stress(seconds, cache_size=cache_size).items():
+                print(f"{'cached' if cache_size else 'uncached'} {name:>10}: {value:,}")
+    else:
+        max_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+        seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+        for name, value in run(max_threads, seconds).items():
+            print(f"{name:>44}: {value:,.0f}" if not isinstance(value, bool) else f"{name:>44}: {value}")
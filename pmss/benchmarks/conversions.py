@@ -0,0 +1,46 @@
+'''
+Time to convert one value with each built-in type's parser, as
+`CombinedRuleset.parse` does. `repeated` converts the same value over
+and over (the common case, which the memo helps with); `distinct`
+converts a different value each time.
+
+    python -m pmss.benchmarks.conversions [repeats]
+'''
+
+import sys
+import time
+
+import pmss.pmsstypes
+
+# Type, then a function giving the n'th value to convert
+CASES = {
+    'boolean': lambda n: ('true', 'no', 'on', '0')[n % 4],
+    'timedelta': lambda n: f'{n % 100000} minutes',
+    'port': lambda n: str(n % 65536),
+    'hostname': lambda n: f'host{n}.example.com',
+    'filename': lambda n: f'/var/lib/pmss/file{n}.pmss'
+}
+
+
+def _time(parser, values):
+    start = time.perf_counter()
+    for value in values:
+        parser(value)
+    return (time.perf_counter() - start) / len(values)
+
+
+def run(repeats=100000):
+    report = {}
+    for type_name, value in CASES.items():
+        parser = pmss.pmsstypes.TYPES[type_name]['parser']
+        repeated = [value(0)] * repeats
+        distinct = [value(n) for n in range(repeats)]
+        report[f"{type_name}_repeated_ns"] = min(_time(parser, repeated) for i in range(3)) * 1e9
+        report[f"{type_name}_distinct_ns"] = min(_time(parser, distinct) for i in range(3)) * 1e9
+    return report
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, value in run(repeats).items():
+        print(f"{name:>26}: {value:,.1f}")
@@ -0,0 +1,98 @@
+'''
+Generators for synthetic PMSS workloads.
+'''
+
+
+def school_sheet(rules=50000, schools=1000):
+    '''
+    A PMSS sheet with `rules` distinct rules: one block per school,
+    then one per classroom within a school, with some classroom
+    blocks nested under a `roster` type. This is the shape of sheet
+    we get when generating settings from a student information system.
+    '''
+    keys = ("roster_source", "server_port")
+    lines = ["* {", "    roster_source: google;", "    server_port: 8888;", "}"]
+    count = len(keys)
+    block = 0
+    while count < rules:
+        school = f"[school=school{block % schools}]"
+        if block < schools:
+            selector = school
+        elif block % 3:
+            selector = f"{school} .class{block // schools}"
+        else:
+            selector = f"roster {school} .class{block // schools}"
+        lines.append(f"{selector} {{")
+        for key in keys[:rules - count]:
+            lines.append(f"    {key}: value{count};")
+            count += 1
+        lines.append("}")
+        block += 1
+    return "\n".join(lines) + "\n"
+
+
+def school_yaml(rules=50000, schools=1000):
+    '''
+    The closest YAML equivalent of `school_sheet`, for
+    `YAMLFileRuleset`. YAML nesting only gives us type selectors, so
+    classrooms are nested under their school (`school3: class7:
+    ...`), some of them under a `roster` type first.
+    '''
+    keys = ("roster_source", "server_port")
+    tree = {}
+    count = 0
+    block = 0
+    while count < rules:
+        school = f"school{block % schools}"
+        if block < schools:
+            path = (school,)
+        elif block % 3:
+            path = (school, f"class{block // schools}")
+        else:
+            path = ("roster", school, f"class{block // schools}")
+        node = tree
+        for name in path:
+            node = node.setdefault(name, {})
+        for key in keys[:rules - count]:
+            node[key] = f"value{count}"
+            count += 1
+        block += 1
+
+    lines = []
+
+    def emit(node, depth):
+        for name, value in node.items():
+            if isinstance(value, dict):
+                lines.append(f"{'  ' * depth}{name}:")
+                emit(value, depth + 1)
+            else:
+                lines.append(f"{'  ' * depth}{name}: {value}")
+    emit(tree, 0)
+    return "\n".join(lines) + "\n"
+
+
+def field_names(count=1000):
+    '''
+    Names for `count` settings, for `environment` and `arguments`.
+    These need registering (as strings) before use.
+    '''
+    return [f"benchmark_setting{n}" for n in range(count)]
+
+
+def environment(names, unrelated=1000):
+    '''
+    An environment with a variable for each of `names` (upper-cased,
+    as `SimpleEnvsRuleset` expects), and `unrelated` other variables,
+    as a real environment has.
+    '''
+    env = {f"UNRELATED_VARIABLE{n}": f"value{n}" for n in range(unrelated)}
+    for n, name in enumerate(names):
+        env[name.upper()] = f"value{n}"
+    return env
+
+
+def arguments(names):
+    '''
+    A command line, as `sys.argv`, setting each of `names`.
+    '''
+    return ["benchmark"] + [f"--{name}=value{n}" for n, name in enumerate(names)]
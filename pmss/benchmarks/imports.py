@@ -0,0 +1,60 @@
+'''
+Time to `import pmss`, in a fresh interpreter, over and above starting
+Python itself. Short-lived command-line tools pay this on every run,
+so we keep a budget: the grammar, YAML, and `pkg_resources` should
+only load once something needs them.
+
+    python -m pmss.benchmarks.imports [budget in milliseconds]
+
+Exits with an error if the import takes longer than the budget, or
+pulls in any of the modules we defer.
+'''
+
+import subprocess
+import sys
+import time
+
+BUDGET_MILLISECONDS = 75
+
+# Nothing in here should be imported by a plain `import pmss`
+DEFERRED = ['ply.lex', 'ply.yacc', 'pmss.parsetab', 'yaml', 'pkg_resources', 'numpy', 'ctypes', 'asyncio', 'sqlite3']
+
+_CHECK = f'''
+import sys
+import pmss
+print(",".join(name for name in {DEFERRED!r} if name in sys.modules))
+'''
+
+
+def _time(code, repeats):
+    best = float('inf')
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, capture_output=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(repeats=10):
+    # The first import may compile bytecode; don't count that
+    loaded = subprocess.run(
+        [sys.executable, '-c', _CHECK], check=True, capture_output=True, text=True
+    ).stdout.strip()
+    baseline = _time('pass', repeats)
+    with_pmss = _time('import pmss', repeats)
+    return {
+        "python_milliseconds": baseline * 1000,
+        "import_milliseconds": (with_pmss - baseline) * 1000,
+        "deferred_modules_loaded": loaded or "none"
+    }
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET_MILLISECONDS
+    results = run()
+    for name, value in results.items():
+        print(f"{name:>24}: {value:,.2f}" if isinstance(value, float) else f"{name:>24}: {value}")
+    if results["deferred_modules_loaded"] != "none":
+        sys.exit(f"`import pmss` loaded {results['deferred_modules_loaded']}")
+    if results["import_milliseconds"] > budget:
+        sys.exit(f"`import pmss` took {results['import_milliseconds']:.1f}ms; the budget is {budget:.1f}ms")
@@ -0,0 +1,53 @@
+'''
+Parse time for each parser backend on a multi-megabyte sheet, and a
+check that they agree.
+
+    python -m pmss.benchmarks.parsers [rules]
+'''
+
+import sys
+import time
+
+import pmss.loadfile
+from pmss.benchmarks.generators import school_sheet
+
+BACKENDS = ('ply', 'descent')
+
+
+def _rules(results):
+    return [
+        (key, [(repr(selector), selector.provenance, value) for selector, value in selector_dict.items()])
+        for key, selector_dict in results.items()
+    ]
+
+
+def run(rules=100000):
+    # Comments, so we also measure skipping them
+    text = "/* Generated for benchmarking */\n" + school_sheet(rules=rules).replace("}\n", "}  // end\n")
+    results = {}
+    timings = {}
+    for backend in BACKENDS:
+        pmss.loadfile.load_pmss_string("* { warmup: up; }", provenance="warmup", backend=backend)
+        best = float('inf')
+        for repeat in range(3):
+            start = time.perf_counter()
+            results[backend] = pmss.loadfile.load_pmss_string(text, provenance="benchmark", backend=backend)
+            best = min(best, time.perf_counter() - start)
+        timings[backend] = best
+
+    if _rules(results['ply']) != _rules(results['descent']):
+        raise AssertionError("The parser backends disagree")
+
+    megabytes = len(text.encode()) / 1e6
+    report = {"megabytes": megabytes}
+    for backend in BACKENDS:
+        report[f"{backend}_seconds"] = timings[backend]
+        report[f"{backend}_megabytes_per_second"] = megabytes / timings[backend]
+    report["speedup"] = timings['ply'] / timings['descent']
+    return report
+
+
+if __name__ == '__main__':
+    rules = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, value in run(rules).items():
+        print(f"{name:>30}: {value:,.2f}" if isinstance(value, float) else f"{name:>30}: {value:,}")
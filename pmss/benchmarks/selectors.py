@@ -0,0 +1,137 @@
+'''
+Load time and memory for a large rule sheet. Selectors dominate the
+memory of a loaded ruleset, and are hashed every time they're used as
+a dictionary key, so this is mostly a benchmark of the selector
+classes.
+
+Where we can turn an optimization off at run time, we also measure
+without it, and report both, as `before -> after`:
+
+* `hash_nanoseconds`: recomputing the hash from the selector's string
+  form on every call, rather than once, on construction.
+* `bytes_per_rule`, `resident_bytes`: giving each block its own
+  selectors, as the parser returns them, rather than sharing equal
+  selectors across the sheet (`pmss.pmssselectors.intern`).
+
+The memory saved by `__slots__` is in both numbers.
+
+    python -m pmss.benchmarks.selectors [rules]
+'''
+
+import gc
+import sys
+import time
+import tracemalloc
+
+import pmss.loadfile
+import pmss.pmsslex
+import pmss.pmssyacc
+import pmss.selectorindex
+from pmss.benchmarks.generators import school_sheet
+
+
+def _count_selectors(results):
+    return sum(len(selector_dict) for selector_dict in results.values())
+
+
+def _uninterned(text, provenance):
+    '''
+    Like `load_pmss_string`, but without interning: each block keeps
+    its own copy of its selector.
+    '''
+    parsed = pmss.pmssyacc.parse(pmss.pmsslex.strip_comments(text))
+    results = {}
+    previous = copy = None
+    for selector, key, value in pmss.loadfile.flatten_rules(parsed):
+        if selector is not previous:
+            previous = selector
+            copy = selector.with_provenance(provenance)
+        selector_dict = results.setdefault(key, {})
+        selector_dict.pop(copy, None)
+        selector_dict[copy] = value.strip()
+    return results
+
+
+def _memory(load):
+    '''
+    Bytes held by the result of `load()`. We load before tracing too,
+    since tracing slows loads down.
+    '''
+    gc.collect()
+    tracemalloc.start()
+    results = load()
+    # PLY holds on to its last input and parse tree; parse something
+    # tiny so we only measure the ruleset itself.
+    pmss.loadfile.load_pmss_string("* { warmup: up; }", provenance="warmup")
+    gc.collect()
+    memory, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return results, memory, peak
+
+
+def _uncached_hash(selector):
+    return hash(str(selector.provenance) + ":" + str(selector))
+
+
+def _time_hashes(hash_function, selectors, repeats=10):
+    start = time.perf_counter()
+    for repeat in range(repeats):
+        for selector in selectors:
+            hash_function(selector)
+    return (time.perf_counter() - start) / (repeats * len(selectors))
+
+
+def run(rules=50000):
+    text = school_sheet(rules=rules)
+    pmss.loadfile.load_pmss_string("* { warmup: up; }", provenance="warmup")
+
+    load_time = float('inf')
+    for repeat in range(3):
+        start = time.perf_counter()
+        results = pmss.loadfile.load_pmss_string(text, provenance="benchmark")
+        load_time = min(load_time, time.perf_counter() - start)
+        del results
+
+    uninterned, memory_before, peak_before = _memory(lambda: _uninterned(text, "benchmark"))
+    del uninterned
+    results, memory, peak = _memory(lambda: pmss.loadfile.load_pmss_string(text, provenance="benchmark"))
+    count = _count_selectors(results)
+
+    selectors = [selector for selector_dict in results.values() for selector in selector_dict]
+    hash_time_before = _time_hashes(_uncached_hash, selectors)
+    hash_time = _time_hashes(hash, selectors)
+
+    start = time.perf_counter()
+    pmss.selectorindex.index_results(results)
+    index_time = time.perf_counter() - start
+
+    return {
+        "rules": count,
+        "load_seconds": load_time,
+        "resident_bytes_before": memory_before,
+        "resident_bytes": memory,
+        "bytes_per_rule_before": memory_before / count,
+        "bytes_per_rule": memory / count,
+        "peak_bytes_before": peak_before,
+        "peak_bytes": peak,
+        "hash_nanoseconds_before": hash_time_before * 1e9,
+        "hash_nanoseconds": hash_time * 1e9,
+        "index_seconds": index_time
+    }
+
+
+def _format(value):
+    return f"{value:,.2f}" if isinstance(value, float) else f"{value:,}"
+
+
+if __name__ == '__main__':
+    rules = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    report = run(rules)
+    for name, value in report.items():
+        if name.endswith("_before"):
+            continue
+        before = report.get(name + "_before")
+        if before is None:
+            print(f"{name:>20}: {_format(value)}")
+        else:
+            print(f"{name:>20}: {_format(before)} -> {_format(value)} ({value / before:.2f}x)")
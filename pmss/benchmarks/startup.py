@@ -0,0 +1,73 @@
+'''
+Startup time for settings spread over several large PMSS files, loading
+them one after another, on threads, and in processes. `latency` adds a
+delay to each file's load, as for files on a network file system.
+
+Threads help when loading waits on I/O; parsing holds the GIL, so
+only processes (or a free-threaded Python) help with big files on
+fast disks.
+
+    python -m pmss.benchmarks.startup [files] [rules per file] [latency in seconds]
+'''
+
+import os
+import sys
+import tempfile
+import time
+
+import pmss.rulesets
+from pmss.benchmarks.generators import school_sheet
+
+
+def _slow_read(latency, *args):
+    time.sleep(latency)
+    return pmss.rulesets._read_pmss_file(*args)
+
+
+class _SlowPMSSFileRuleset(pmss.rulesets.PMSSFileRuleset):
+    def __init__(self, filename, latency, **kwargs):
+        self.latency = latency
+        super().__init__(filename, **kwargs)
+
+    def load(self):
+        time.sleep(self.latency)
+        super().load()
+
+    def loader(self):
+        function, args = super().loader()
+        return _slow_read, (self.latency,) + args
+
+
+def _time_load(filenames, latency, workers, processes):
+    rulesets = [
+        _SlowPMSSFileRuleset(filename, latency, rulesetid=f"file{n}")
+        for n, filename in enumerate(filenames)
+    ]
+    combined = pmss.rulesets.CombinedRuleset(rulesets)
+    start = time.perf_counter()
+    combined.load(workers=workers, processes=processes)
+    return time.perf_counter() - start
+
+
+def run(files=4, rules=100000, latency=0.0):
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = []
+        for n in range(files):
+            filename = os.path.join(directory, f"sheet{n}.pmss")
+            with open(filename, 'w') as f:
+                f.write(school_sheet(rules=rules))
+            filenames.append(filename)
+
+        report = {"megabytes": sum(os.path.getsize(filename) for filename in filenames) / 1e6}
+        report["sequential_seconds"] = _time_load(filenames, latency, None, False)
+        report["threads_seconds"] = _time_load(filenames, latency, files, False)
+        report["processes_seconds"] = _time_load(filenames, latency, files, True)
+    return report
+
+
+if __name__ == '__main__':
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    rules = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    for name, value in run(files, rules, latency).items():
+        print(f"{name:>20}: {value:,.2f}")
@@ -0,0 +1,56 @@
+'''
+Peak memory when loading a large generated sheet from disk, with each
+parser backend. We report the peak over and above the loaded rules
+themselves. For `descent` and `ply`, that includes the whole text of
+the file (and, for PLY, the parse tree). For `streaming`, the text
+only costs a few chunks. What's left grows with the number of distinct
+selectors, not with the size of the file. It comes from the interning
+table and from dictionaries resizing as they grow.
+
+    python -m pmss.benchmarks.streaming [rules]
+'''
+
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pmss.loadfile
+from pmss.benchmarks.generators import school_sheet
+
+BACKENDS = ('ply', 'descent', 'streaming')
+
+
+def run(rules=200000, backends=BACKENDS):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'sheet.pmss')
+        with open(filename, 'w') as f:
+            f.write(school_sheet(rules=rules))
+        report = {"megabytes": os.path.getsize(filename) / 1e6}
+
+        for backend in backends:
+            pmss.loadfile.load_pmss_string("* { warmup: up; }", provenance="warmup", backend=backend)
+            gc.collect()
+            tracemalloc.start()
+            start = time.perf_counter()
+            results = pmss.loadfile.load_pmss_file(filename, provenance="benchmark", backend=backend)
+            seconds = time.perf_counter() - start
+            # As in `selectors`, don't count PLY's last parse tree
+            pmss.loadfile.load_pmss_string("* { warmup: up; }", provenance="warmup", backend=backend)
+            gc.collect()
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del results
+            report[f"{backend}_seconds"] = seconds
+            report[f"{backend}_rules_megabytes"] = retained / 1e6
+            report[f"{backend}_overhead_megabytes"] = (peak - retained) / 1e6
+    return report
+
+
+if __name__ == '__main__':
+    rules = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    backends = sys.argv[2].split(',') if len(sys.argv) > 2 else BACKENDS
+    for name, value in run(rules, backends).items():
+        print(f"{name:>32}: {value:,.2f}" if isinstance(value, float) else f"{name:>32}: {value:,}")
@@ -0,0 +1,266 @@
+'''
+The whole pipeline on one large synthetic deployment, with results as
+JSON, so runs can be kept and compared:
+
+* A PMSS sheet of `rules` rules over `schools` schools (see
+  `generators.school_sheet`), its YAML equivalent (with `yaml_rules`
+  rules, by default a tenth as many, since PyYAML is slow), an
+  environment, and a command line, each setting many keys.
+* Parsing the sheet (`load_pmss_file`, with each backend), loading
+  all four rulesets (`CombinedRuleset.load`), `Settings.get` cold
+  (first lookup of each context), hot (from the cache), and uncached,
+  `validate`, full and incremental reloads, and memory per rule.
+
+Other benchmark modules can be added to the run with `--modules`;
+their `run()` results are included, prefixed by the module name.
+
+Lower is better for every number we report, so `compare` flags any
+which grew by more than `--threshold` as a regression, and exits with
+an error if there were any.
+
+    python -m pmss.benchmarks.suite run [--rules N] [--schools N] [--output results.json]
+    python -m pmss.benchmarks.suite compare old.json new.json [--threshold 0.1]
+'''
+
+import argparse
+import contextlib
+import gc
+import importlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pmss.loadfile
+import pmss.pmsstypes
+import pmss.rulesets
+import pmss.schema
+import pmss.settings
+from pmss.benchmarks import generators
+
+KEYS = ("roster_source", "server_port")
+
+
+def _register(names):
+    for name in names:
+        if name not in pmss.schema.default_schema.fields_by_name:
+            pmss.schema.register_field(name=name, type=pmss.pmsstypes.TYPES.string)
+
+
+def _best(function, repeats):
+    '''
+    The fastest of `repeats` calls to `function()`, in seconds.
+    '''
+    best = float('inf')
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _contexts(schools, count=2000):
+    return [
+        {"types": ["roster"] if n % 3 == 0 else [], "classes": [f"class{n % 7}"], "attributes": {"school": f"school{(n * 7919) % schools}"}}
+        for n in range(count)
+    ]
+
+
+def _lookups(settings, contexts):
+    '''
+    Microseconds per `Settings.get`, over every key in every context.
+    '''
+    start = time.perf_counter()
+    for context in contexts:
+        for key in KEYS:
+            settings.get(key, **context)
+    return (time.perf_counter() - start) / (len(contexts) * len(KEYS)) * 1e6
+
+
+class _Deployment():
+    '''
+    The generated files, environment and command line.
+    '''
+    def __init__(self, directory, rules, yaml_rules, schools, settings_count):
+        self.names = generators.field_names(settings_count)
+        _register(KEYS + tuple(self.names))
+        self.pmss_filename = os.path.join(directory, 'sheet.pmss')
+        with open(self.pmss_filename, 'w') as f:
+            f.write(generators.school_sheet(rules=rules, schools=schools))
+        self.yaml_filename = os.path.join(directory, 'sheet.yaml')
+        with open(self.yaml_filename, 'w') as f:
+            f.write(generators.school_yaml(rules=yaml_rules, schools=schools))
+        self.env = generators.environment(self.names)
+        self.argv = generators.arguments(self.names)
+
+    def rulesets(self):
+        rulesets = [
+            pmss.rulesets.ArgsRuleset(argv=self.argv),
+            pmss.rulesets.SimpleEnvsRuleset(env=self.env),
+            pmss.rulesets.PMSSFileRuleset(self.pmss_filename, rulesetid="benchmark", backend='descent')
+        ]
+        try:
+            import yaml
+            rulesets.append(pmss.rulesets.YAMLFileRuleset(self.yaml_filename, rulesetid="benchmark-yaml"))
+        except ImportError:
+            pass
+        return rulesets
+
+
+def _memory_per_rule(filename):
+    gc.collect()
+    tracemalloc.start()
+    ruleset = pmss.rulesets.PMSSFileRuleset(filename, rulesetid="memory", backend='descent')
+    ruleset.load()
+    gc.collect()
+    memory, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rules = sum(len(selector_dict) for selector_dict in ruleset.results.values())
+    return memory / rules
+
+
+def _reload(filename, incremental, repeats):
+    ruleset = pmss.rulesets.PMSSFileRuleset(filename, rulesetid="reload", backend='descent', incremental=incremental)
+    ruleset.load()
+    with open(filename) as f:
+        text = f.read()
+    # Edit one block in the middle, as someone changing a setting would
+    middle = text.index("{", len(text) // 2)
+
+    def edit():
+        nonlocal text
+        text = text[:middle + 1] + " benchmark_setting0: edited;" + text[middle + 1:]
+        with open(filename, 'w') as f:
+            f.write(text)
+        ruleset.reload()
+    seconds = _best(edit, repeats)
+    with open(filename, 'w') as f:
+        f.write(text.replace(" benchmark_setting0: edited;", ""))
+    return seconds
+
+
+def run(rules=200000, schools=10000, settings_count=1000, repeats=3, modules=(), yaml_rules=None):
+    if yaml_rules is None:
+        yaml_rules = rules // 10
+    report = {
+        "parameters": {
+            "rules": rules, "yaml_rules": yaml_rules, "schools": schools,
+            "settings": settings_count, "repeats": repeats
+        },
+        "environment": {
+            "python": sys.version,
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "free_threaded": not getattr(sys, '_is_gil_enabled', lambda: True)()
+        },
+        "results": {}
+    }
+    results = report["results"]
+    with tempfile.TemporaryDirectory() as directory:
+        deployment = _Deployment(directory, rules, yaml_rules, schools, settings_count)
+        for backend in ('ply', 'descent'):
+            pmss.loadfile.load_pmss_string("* { warmup: up; }", provenance="warmup", backend=backend)
+            results[f"load_pmss_file_{backend}_seconds"] = _best(
+                lambda: pmss.loadfile.load_pmss_file(deployment.pmss_filename, provenance="benchmark", backend=backend),
+                repeats
+            )
+
+        results["combined_load_seconds"] = _best(
+            lambda: pmss.rulesets.CombinedRuleset(deployment.rulesets()).load(),
+            repeats
+        )
+        contexts = _contexts(schools)
+        settings = pmss.settings.Settings(deployment.rulesets(), cache_size=len(contexts) * len(KEYS))
+        results["settings_get_cold_microseconds"] = _lookups(settings, contexts)
+        results["settings_get_hot_microseconds"] = _lookups(settings, contexts)
+        uncached = pmss.settings.Settings(deployment.rulesets())
+        _lookups(uncached, contexts)
+        results["settings_get_uncached_microseconds"] = _lookups(uncached, contexts)
+        # `validate` takes the upper-case keys from the environment
+        # for different settings, so we leave that ruleset out. It
+        # also prints the keys it checks.
+        validated = pmss.settings.Settings([
+            ruleset for ruleset in deployment.rulesets()
+            if not isinstance(ruleset, pmss.rulesets.SimpleEnvsRuleset)
+        ])
+        with contextlib.redirect_stdout(io.StringIO()):
+            results["validate_seconds"] = _best(lambda: pmss.schema.validate(validated), repeats)
+
+        results["reload_seconds"] = _reload(deployment.pmss_filename, False, repeats)
+        results["incremental_reload_seconds"] = _reload(deployment.pmss_filename, True, repeats)
+        results["bytes_per_rule"] = _memory_per_rule(deployment.pmss_filename)
+
+    for name in modules:
+        module = importlib.import_module(f"pmss.benchmarks.{name}")
+        for key, value in module.run().items():
+            results[f"{name}.{key}"] = value
+    return report
+
+
+def compare(old, new, threshold=0.1):
+    '''
+    Compare two reports from `run()`, returning `[(name, old, new,
+    ratio)]` for each number in both, and the names of those which
+    regressed by more than `threshold`.
+    '''
+    rows = []
+    regressions = []
+    for name, new_value in new["results"].items():
+        old_value = old["results"].get(name)
+        if isinstance(new_value, bool) or not isinstance(new_value, (int, float)) or not isinstance(old_value, (int, float)):
+            continue
+        ratio = new_value / old_value if old_value else float('inf')
+        rows.append((name, old_value, new_value, ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m pmss.benchmarks.suite", description="Run or compare the pmss benchmark suite.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Run the suite, writing JSON")
+    run_parser.add_argument("--rules", type=int, default=200000)
+    run_parser.add_argument("--yaml-rules", type=int, help="Rules in the YAML file (default: a tenth of --rules)")
+    run_parser.add_argument("--schools", type=int, default=10000)
+    run_parser.add_argument("--settings", type=int, default=1000, help="Keys set in the environment and on the command line")
+    run_parser.add_argument("--repeats", type=int, default=3)
+    run_parser.add_argument("--modules", default="", help="Other benchmark modules to include, e.g. parsers,selectors")
+    run_parser.add_argument("--output", help="File to write the results to (default: standard output)")
+    compare_parser = commands.add_parser("compare", help="Compare two runs")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Fractional slow-down counted as a regression")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        modules = [name for name in args.modules.split(",") if name]
+        report = run(args.rules, args.schools, args.settings, args.repeats, modules, args.yaml_rules)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        return 0
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    rows, regressions = compare(old, new, args.threshold)
+    for name, old_value, new_value, ratio in rows:
+        flag = "  REGRESSION" if name in regressions else ""
+        print(f"{name:>40}: {old_value:>14,.3f} -> {new_value:>14,.3f} ({ratio:.2f}x){flag}")
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
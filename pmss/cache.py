@@ -0,0 +1,163 @@
+'''
+A small, bounded, least-recently-used cache for resolved settings.
+
+We don't use `functools.lru_cache` since contexts aren't hashable as
+passed in, and we need to be able to throw away entries whenever a
+ruleset changes underneath us.
+'''
+
+import collections
+import threading
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+MISSING = object()  # Returned by `get()` on a cache miss
+
+
+class LRUCache():
+    '''
+    Thread-safe LRU mapping with hit / miss counters.
+
+    `generation` is bumped on every `clear()` or `invalidate()`. A caller computing a
+    value should note the generation before it starts, and pass it to
+    `put()`, so a value computed from stale rulesets is never stored
+    after an invalidation.
+
+    Lookups don't wait on the lock. A hit only marks the entry as
+    recently used if no other thread holds the lock, so under heavy
+    contention, eviction order (and the counters) are approximate.
+    Writes are serialized.
+    '''
+    def __init__(self, maxsize=128):
+        if maxsize is None or maxsize < 1:
+            raise ValueError(f"Cache size must be a positive integer, not {maxsize}")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        # Plain dicts keep insertion order, and, unlike `OrderedDict`,
+        # are safe to read while another thread writes, with or
+        # without the GIL. Oldest entries come first.
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Return the cached value, or `MISSING` on a miss.
+        '''
+        value = self._data.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        if self._lock.acquire(blocking=False):
+            try:
+                # Move to the end, unless it was dropped meanwhile
+                if self._data.pop(key, MISSING) is not MISSING:
+                    self._data[key] = value
+            finally:
+                self._lock.release()
+        return value
+
+    def put(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                del self._data[next(iter(self._data))]
+
+    def clear(self):
+        with self._lock:
+            self._data = {}
+            self.generation += 1
+
+    def invalidate(self, keys):
+        '''
+        Drop the entries for settings in `keys`, where cache keys are
+        from `context_key()`.
+        '''
+        keys = set(keys)
+        with self._lock:
+            for cache_key in [cache_key for cache_key in self._data if cache_key[0] in keys]:
+                del self._data[cache_key]
+            self.generation += 1
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+
+def context_key(key, context):
+    '''
+    A hashable stand-in for `(key, context)`. Matching only depends on
+    membership in `types` / `classes` and on the attribute values, so
+    ordering and duplicates are normalized away.
+
+    Returns `None` for contexts we can't normalize safely (unhashable
+    values, or classes passed as a bare string), which the caller
+    should simply not cache.
+    '''
+    types = context.get('types', ())
+    classes = context.get('classes', ())
+    attributes = context.get('attributes', {})
+    if isinstance(types, str) or isinstance(classes, str) or not isinstance(attributes, dict):
+        return None
+    try:
+        normalized = (
+            key,
+            context.get('id'),
+            frozenset(types),
+            frozenset(classes),
+            frozenset(attributes.items())
+        )
+        hash(normalized)
+    except TypeError:
+        return None
+    return normalized
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=3)
+    for n in range(3):
+        cache.put(('key', n), n)
+    assert cache.get(('key', 0)) == 0  # Now the most recently used
+    cache.put(('key', 3), 3)
+    assert len(cache) == 3
+    assert cache.get(('key', 1)) is MISSING, "The least recently used entry should go first"
+    assert [cache.get(('key', n)) for n in (0, 2, 3)] == [0, 2, 3]
+    assert cache.info() == CacheInfo(hits=4, misses=1, maxsize=3, currsize=3)
+
+    # Values computed before an invalidation are never stored
+    generation = cache.generation
+    cache.invalidate(['key'])
+    assert len(cache) == 0
+    cache.put(('key', 0), 'stale', generation)
+    assert cache.get(('key', 0)) is MISSING
+    generation = cache.generation
+    cache.put(('other', 0), 'kept', generation)
+    cache.put(('key', 0), 'fresh', generation)
+    cache.invalidate(['key'])
+    assert cache.get(('key', 0)) is MISSING
+    assert cache.get(('other', 0)) == 'kept'
+    generation = cache.generation
+    cache.clear()
+    cache.put(('key', 0), 'stale', generation)
+    assert len(cache) == 0
+
+    for size in (0, None):
+        try:
+            LRUCache(size)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"Accepted a cache size of {size}")
+
+
+if __name__ == "__main__":
+    test_lru_cache()
+    print("All test cases passed successfully.")
@@ -0,0 +1,119 @@
+'''
+What changed when a ruleset reloaded, so caches downstream can drop
+just the affected keys, rather than everything.
+
+Results are `{key: {selector: value}}`, in source order (see
+`pmss.loadfile.rule_sheet`). A `ChangeSet` lists the `(key, selector)`
+entries which were added, removed, or given a new value, and the keys
+whose selectors are the same, but in a different order. Order matters
+since, between equally specific selectors, the later one wins.
+'''
+
+
+class ChangeSet():
+    def __init__(self, added=(), removed=(), changed=(), reordered=()):
+        self.added = frozenset(added)
+        self.removed = frozenset(removed)
+        self.changed = frozenset(changed)
+        self.reordered = frozenset(reordered)
+
+    def keys(self):
+        '''
+        Every key with any change.
+        '''
+        keys = set(self.reordered)
+        for entries in (self.added, self.removed, self.changed):
+            keys.update(key for key, selector in entries)
+        return keys
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed or self.reordered)
+
+    def __eq__(self, other):
+        if not isinstance(other, ChangeSet):
+            return NotImplemented
+        return (self.added, self.removed, self.changed, self.reordered) == \
+            (other.added, other.removed, other.changed, other.reordered)
+
+    def __repr__(self):
+        return (
+            f"ChangeSet(added={sorted(map(str, self.added))}, "
+            f"removed={sorted(map(str, self.removed))}, "
+            f"changed={sorted(map(str, self.changed))}, "
+            f"reordered={sorted(self.reordered)})"
+        )
+
+
+def diff(old_results, new_results, keys=None):
+    '''
+    The `ChangeSet` from `old_results` to `new_results`. If `keys` is
+    given, we only compare those; the caller knows nothing else
+    changed.
+    '''
+    if keys is None:
+        keys = set(old_results) | set(new_results)
+    added = []
+    removed = []
+    changed = []
+    reordered = []
+    for key in keys:
+        old = old_results.get(key, {})
+        new = new_results.get(key, {})
+        if old == new and list(old) == list(new):
+            continue
+        for selector, value in new.items():
+            if selector not in old:
+                added.append((key, selector))
+            elif old[selector] != value:
+                changed.append((key, selector))
+        removed.extend((key, selector) for selector in old if selector not in new)
+        # Selectors in both, but in a different relative order
+        if [selector for selector in old if selector in new] != [selector for selector in new if selector in old]:
+            reordered.append(key)
+    return ChangeSet(added, removed, changed, reordered)
+
+
+def test_diff():
+    import pmss.pmssselectors
+
+    dev = pmss.pmssselectors.ClassSelector('dev')
+    prod = pmss.pmssselectors.ClassSelector('prod')
+    everyone = pmss.pmssselectors.UniversalSelector()
+    old = {
+        'level': {everyone: 'info', dev: 'debug', prod: 'warning'},
+        'port': {everyone: '80'},
+        'gone': {dev: 'x'}
+    }
+
+    assert not diff(old, old)
+    assert diff(old, dict(old)) == ChangeSet()
+
+    new = {
+        # `dev` moved to the end, so it now wins ties with `prod`
+        'level': {everyone: 'info', prod: 'warning', dev: 'debug'},
+        'port': {everyone: '8080', dev: '8000'},
+        'host': {everyone: 'localhost'}
+    }
+    changes = diff(old, new)
+    assert changes == ChangeSet(
+        added=[('port', dev), ('host', everyone)],
+        removed=[('gone', dev)],
+        changed=[('port', everyone)],
+        reordered=['level']
+    ), changes
+    assert changes.keys() == {'level', 'port', 'host', 'gone'}
+
+    # Moving a selector only reorders; changing its value too is both
+    moved = {'level': {everyone: 'info', prod: 'warning', dev: 'trace'}}
+    assert diff({'level': old['level']}, moved) == ChangeSet(changed=[('level', dev)], reordered=['level'])
+    # New and removed selectors don't count as reordering the others
+    assert diff({'level': {dev: 'a', prod: 'b'}}, {'level': {everyone: 'c', dev: 'a'}}) == \
+        ChangeSet(added=[('level', everyone)], removed=[('level', prod)])
+
+    # With `keys`, other keys aren't compared
+    assert diff(old, new, keys=['port']) == ChangeSet(added=[('port', dev)], changed=[('port', everyone)])
+
+
+if __name__ == "__main__":
+    test_diff()
+    print("All test cases passed successfully.")
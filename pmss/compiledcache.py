@@ -0,0 +1,146 @@
+'''
+On-disk cache of parsed PMSS files, so short-lived processes can skip
+the lexer and parser for files which haven't changed.
+
+Each source file gets one cache file in the cache directory, named
+after a hash of its path and provenance. A cache file is:
+
+    MAGIC, format version (one byte), header (pickle), rules (pickle)
+
+The header records the file's size, modification time, and SHA-256,
+plus a fingerprint of the code which produced the rules (the pmss
+version, and the source of the parsers and selector modules).
+We only use the rules if the size, hash, and fingerprint all match,
+so editing the grammar, upgrading pmss, or touching the file with new
+contents all cause a re-parse. The modification time is recorded for
+debugging, but isn't trusted on its own.
+
+Caches are written to a temporary file and renamed into place, so
+concurrent workers never see half-written files. Anything unreadable
+is treated as a miss.
+
+Cache files are pickles: only point `cache_dir` at a directory which
+is as trusted as the configuration files themselves.
+'''
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+import pmss.loadfile
+import pmss.pmssdescent
+import pmss.pmsslex
+import pmss.pmssselectors
+import pmss.pmssyacc
+
+MAGIC = b'PMSSC'
+FORMAT_VERSION = 1
+
+_fingerprint = None
+
+
+def _pmss_version():
+    try:
+        import importlib.metadata
+        return importlib.metadata.version('pmss')
+    except Exception:
+        return 'unknown'
+
+
+def fingerprint():
+    '''
+    Hash of everything (other than the file itself) which affects the
+    parsed rules.
+    '''
+    global _fingerprint
+    if _fingerprint is None:
+        digest = hashlib.sha256()
+        digest.update(f'{FORMAT_VERSION}:{_pmss_version()}'.encode())
+        for module in (pmss.pmsslex, pmss.pmssyacc, pmss.pmssdescent, pmss.pmssselectors, pmss.loadfile):
+            with open(module.__file__, 'rb') as f:
+                digest.update(f.read())
+        _fingerprint = digest.hexdigest()
+    return _fingerprint
+
+
+def cache_path(cache_dir, filename, provenance):
+    name = hashlib.sha256(f'{os.path.abspath(filename)}\0{provenance}'.encode()).hexdigest()
+    return os.path.join(cache_dir, f'{name[:32]}.pmssc')
+
+
+def _read(path, expected_header):
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC) + 1) != MAGIC + bytes([FORMAT_VERSION]):
+                return None
+            header = pickle.load(f)
+            if not isinstance(header, dict) or any(
+                    header.get(field) != expected_header[field]
+                    for field in ('fingerprint', 'path', 'provenance', 'size', 'sha256')
+            ):
+                return None
+            return pickle.load(f)
+    except Exception:
+        # Missing, truncated, or from some other version of Python
+        return None
+
+
+def _write(path, header, rules):
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=directory, prefix='.pmssc-')
+    except OSError:
+        # A read-only cache directory is just a slow cache
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC + bytes([FORMAT_VERSION]))
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(rules, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+    except Exception:
+        try:
+            os.unlink(temporary)
+        except OSError:
+            pass
+
+
+def _hash_file(filename, chunk_size=1 << 20):
+    '''
+    `(size, mtime_ns, sha256)` of a file, reading it in chunks, so
+    huge files needn't fit in memory.
+    '''
+    digest = hashlib.sha256()
+    size = 0
+    with open(filename, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return size, stat.st_mtime_ns, digest.hexdigest()
+
+
+def load_pmss_file(filename, provenance, cache_dir, backend='ply'):
+    '''
+    Same result as `pmss.loadfile.load_pmss_file(filename, provenance)`,
+    but from the cache in `cache_dir` when the file hasn't changed.
+    '''
+    size, mtime_ns, sha256 = _hash_file(filename)
+    header = {
+        'fingerprint': fingerprint(),
+        'path': os.path.abspath(filename),
+        'provenance': provenance,
+        'size': size,
+        'mtime_ns': mtime_ns,
+        'sha256': sha256
+    }
+    path = cache_path(cache_dir, filename, provenance)
+    rules = _read(path, header)
+    if rules is None:
+        rules = pmss.loadfile.load_pmss_file(filename, provenance=provenance, backend=backend)
+        # Don't cache rules from a file which changed while we parsed it
+        if _hash_file(filename)[2] == sha256:
+            _write(path, header, rules)
+    return rules
@@ -0,0 +1,225 @@
+'''
+Read-only, precompiled snapshots of settings, for services which
+never reload their configuration once booted.
+
+`Settings.freeze()` flattens the stack of rulesets into one table per
+key. `CombinedRuleset.query` takes the best match from the first
+ruleset with any match. Since each ruleset lists its selectors in
+order of precedence, that is the same as the first match in the
+concatenation of every ruleset's list. Anything after a selector
+which always matches (e.g. `*`) can never win, so we drop it.
+
+Values are parsed once, up-front. Keys whose answer doesn't depend on
+the context (only `*` rules, or only a default) fold to constants, so
+reading them is a dictionary lookup. The rest use a `SelectorIndex`
+over the flattened list, and remember the answer for each context
+they've seen (up to `memo_size` contexts). Nothing ever changes under
+a snapshot, so that memo never needs invalidating.
+
+Nothing is checked for changes: a snapshot never sees file reloads,
+new rulesets, or fields registered after it was taken.
+'''
+
+import pmss.cache
+import pmss.pmssselectors
+import pmss.rulesets
+import pmss.schema
+import pmss.selectorindex
+
+_MISSING = object()
+
+
+class _Unparseable():
+    '''
+    Stands in for a value which failed to parse. We raise when (and
+    if) it's read, just like `Settings.get` would.
+    '''
+    def __init__(self, ruleset, key, match):
+        self.ruleset = ruleset
+        self.key = key
+        self.match = match
+
+    def reraise(self):
+        self.ruleset.parse(self.key, self.match)
+        raise RuntimeError(f"Value for `{self.key}` failed to parse when frozen, but not now.")
+
+
+def _always_matches(selector):
+    return all(
+        isinstance(simple, pmss.pmssselectors.UniversalSelector)
+        for simple in pmss.selectorindex.simple_selectors(selector)
+    )
+
+
+def _parse(ruleset, key, match):
+    try:
+        return ruleset.parse(key, match)
+    except ValueError:
+        return _Unparseable(ruleset, key, match)
+
+
+class _Table():
+    def __init__(self, selector_index, default):
+        self.selector_index = selector_index
+        self.default = default
+
+
+class FrozenSettings():
+    '''
+    The same interface as `Settings` for reading (`get`, `get_many`,
+    and `settings.key()`), over an immutable snapshot.
+    '''
+    def __init__(self, ruleset, memo_size=4096):
+        self.constants = {}
+        self.tables = {}
+        self.memo = {}
+        self.memo_size = memo_size
+        for key in pmss.schema.default_schema.fields_by_name:
+            self._compile(ruleset, key)
+
+    def _compile(self, ruleset, key):
+        entries = []
+        for subruleset in ruleset.rulesets:
+            candidates = subruleset.candidates(key)
+            if candidates is None:
+                raise ValueError(f"Ruleset `{subruleset.id()}` can't list its selectors, so can't be frozen.")
+            unconditional = False
+            for selector, value in candidates:
+                entries.append((selector, _parse(ruleset, key, (selector, value))))
+                if _always_matches(selector):
+                    unconditional = True
+                    break
+            if unconditional:
+                break
+        else:
+            default = _parse(ruleset, key, None)
+            if not entries and not isinstance(default, _Unparseable):
+                self.constants[key] = default
+                return
+            self.tables[key] = _Table(pmss.selectorindex.SelectorIndex.from_entries(entries), default)
+            return
+
+        if len(entries) == 1 and not isinstance(entries[0][1], _Unparseable):
+            self.constants[key] = entries[0][1]
+            return
+        # The last entry always matches, so we never need a default
+        self.tables[key] = _Table(pmss.selectorindex.SelectorIndex.from_entries(entries), None)
+
+    def get(self, key, *args, id=None, types=[], classes=[], attributes={}, default=None):
+        value = self.constants.get(key, _MISSING)
+        if value is _MISSING:
+            table = self.tables.get(key)
+            if table is None:
+                raise KeyError(f'Key `{key}` is not registered as a field.')
+            context = {
+                "id": id,
+                "types": types,
+                "classes": classes,
+                "attributes": attributes
+            }
+            memo_key = pmss.cache.context_key(key, context)
+            value = self.memo.get(memo_key, _MISSING)
+            if value is _MISSING:
+                match = table.selector_index.best_match(context)
+                value = table.default if match is None else match[1]
+                # Once full, we stop adding rather than evict, so reads need no lock
+                if memo_key is not None and len(self.memo) < self.memo_size:
+                    self.memo[memo_key] = value
+            if isinstance(value, _Unparseable):
+                value.reraise()
+        if value is None:
+            return default
+        return value
+
+    def get_many(self, keys, *args, id=None, types=[], classes=[], attributes={}):
+        results = {}
+        errors = {}
+        for key in keys:
+            try:
+                results[key] = self.get(key, id=id, types=types, classes=classes, attributes=attributes)
+            except ValueError as e:
+                errors[key] = e
+        if errors:
+            raise pmss.rulesets.ParseErrors(errors)
+        return results
+
+    def keys(self):
+        return list(self.constants) + list(self.tables)
+
+    def __getattr__(self, key):
+        '''
+        Enum-style access, as with `Settings`.
+        '''
+        if key in ('constants', 'tables', 'memo', 'memo_size'):
+            raise AttributeError(key)
+        if key in self.constants or key in self.tables:
+            def getter(**kwargs):
+                return self.get(key, **kwargs)
+            return getter
+
+        raise ValueError(f"Invalid Key: {key}")
+
+    def __dir__(self):
+        return sorted(self.keys())
+
+
+def test_frozen_matches_settings():
+    import random
+
+    import pmss.pmsstypes
+    import pmss.settings
+
+    rng = random.Random(1732)
+    fields = {
+        "test_frozen_string": (pmss.pmsstypes.TYPES.string, "fallback"),
+        "test_frozen_port": (pmss.pmsstypes.TYPES.port, None),
+        "test_frozen_constant": (pmss.pmsstypes.TYPES.string, None),
+        "test_frozen_missing": (pmss.pmsstypes.TYPES.port, 80)
+    }
+    for name, (field_type, default) in fields.items():
+        if name not in pmss.schema.default_schema.fields_by_name:
+            pmss.schema.register_field(name=name, type=field_type, default=default)
+
+    class Rules(pmss.rulesets.IndexedRuleset):
+        def __init__(self, results, rulesetid):
+            super().__init__(rulesetid=rulesetid)
+            self.rules = results
+
+        def load(self):
+            self.publish(self.rules)
+
+    def outcome(function, *args, **kwargs):
+        try:
+            return "value", function(*args, **kwargs)
+        except pmss.rulesets.ParseErrors as e:
+            return "errors", {key: str(error) for key, error in e.errors.items()}
+        except ValueError as e:
+            return "error", str(e)
+
+    for trial in range(30):
+        rulesets = []
+        for position in range(rng.randint(1, 3)):
+            ports = pmss.selectorindex._random_selector_dict(rng, rules=10)
+            for selector in ports:
+                # Some ports don't parse, so reading them raises
+                ports[selector] = rng.choice(["443", "8080", "not a port", "99999"])
+            results = {
+                "test_frozen_string": pmss.selectorindex._random_selector_dict(rng, rules=10),
+                "test_frozen_port": ports
+            }
+            if rng.random() < 0.3:
+                results["test_frozen_constant"] = {pmss.pmssselectors.UniversalSelector(): f"constant{position}"}
+            rulesets.append(Rules({key: rules for key, rules in results.items() if rules}, f"rules{position}"))
+        settings = pmss.settings.Settings(rulesets)
+        frozen = settings.freeze()
+
+        for lookup in range(30):
+            context = pmss.selectorindex._random_context(rng)
+            for key in fields:
+                assert outcome(frozen.get, key, **context) == outcome(settings.get, key, **context), (key, context)
+            assert outcome(frozen.get_many, list(fields), **context) == outcome(settings.get_many, list(fields), **context), context
+
+
+if __name__ == "__main__":
+    test_frozen_matches_settings()
+    print("All test cases passed successfully.")
@@ -25,6 +25,8 @@ _epilog = None
 _rulesets = None
 _exit_on_failure = True
 _interpolate = False
+_cache_size = None
+_load_workers = None
 
 initialized = False
 
@@ -39,10 +41,12 @@ def init(
     epilog=_epilog,
     rulesets=_rulesets,
     exit_on_failure=_exit_on_failure,
-    interpolate=_interpolate
+    interpolate=_interpolate,
+    cache_size=_cache_size,
+    load_workers=_load_workers
 ):
     global _prog, _system_name, _usage, _description, _epilog
-    global _rulesets, _exit_on_failure, _interpolate, settings
+    global _rulesets, _exit_on_failure, _interpolate, _cache_size, _load_workers, settings
     _prog = prog
     _system_name = system_name
     _usage = usage
@@ -59,10 +63,12 @@ def init(
 
     _interpolate = interpolate
     _rulesets = rulesets
+    _cache_size = cache_size
+    _load_workers = load_workers
 
     initialized = True
     if settings is None:
-        settings = pmss.settings.Settings(rulesets=rulesets)
+        settings = pmss.settings.Settings(rulesets=rulesets, cache_size=cache_size, load_workers=load_workers)
     else:
         print("Settings already initialized. Check if init isn't being called twice.")
 
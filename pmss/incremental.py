@@ -0,0 +1,158 @@
+'''
+Incremental re-parsing of PMSS sheets, for files which are edited
+often while we're running.
+
+A sheet is a sequence of top-level blocks. Blocks don't affect each
+other's rules, so when the text changes, we split it into blocks (which
+is much cheaper than parsing), skip the blocks at the start and end
+which didn't change, and parse only those in between. Blocks which
+merely moved are reused. We then rebuild the rules for just the keys
+which those blocks mention, and report exactly what changed, as a
+`pmss.changeset.ChangeSet`.
+
+This uses the `pmss.pmssdescent` parser.
+'''
+
+import pmss.changeset
+import pmss.pmssdescent
+import pmss.pmssselectors
+
+
+class IncrementalSheet():
+    '''
+    The parsed rules of one PMSS sheet, as `results` (the same
+    `{key: {selector: value}}` as `pmss.loadfile.load_pmss_string`),
+    kept up-to-date by `update()`.
+    '''
+    def __init__(self, provenance):
+        self.provenance = provenance
+        self.blocks = []     # [(text, {key: [(selector, value)]})], in source order
+        self.results = {}
+
+    def _parse(self, block, start, interned):
+        rules = {}
+        previous = previous_interned = None
+        for selector, key, value, line, column in pmss.pmssdescent.parse(block, start):
+            if selector is not previous:
+                previous = selector
+                previous_interned = pmss.pmssselectors.intern(selector, self.provenance, interned)
+            rules.setdefault(key, []).append((previous_interned, value.strip()))
+        return rules
+
+    def update(self, text):
+        '''
+        Re-parse the sheet from its new `text`, and return the
+        `ChangeSet` from the previous version. On a syntax error, we
+        raise, and keep the previous version.
+        '''
+        split = pmss.pmssdescent.split_blocks(text)
+        old = self.blocks
+        shortest = min(len(old), len(split))
+        prefix = 0
+        while prefix < shortest and old[prefix][0] == split[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < shortest - prefix and old[-1 - suffix][0] == split[-1 - suffix]:
+            suffix += 1
+
+        removed = old[prefix:len(old) - suffix]
+        previously_parsed = dict(removed)
+        interned = {}
+        inserted = []
+        start = pmss.pmssdescent._position(text, sum(map(len, split[:prefix])))
+        for block in split[prefix:len(split) - suffix]:
+            rules = previously_parsed.get(block)
+            if rules is None:
+                rules = self._parse(block, start, interned)
+            inserted.append((block, rules))
+            start = pmss.pmssdescent._position(block, len(block), start)
+        blocks = old[:prefix] + inserted + old[len(old) - suffix:]
+
+        affected = set()
+        for block, rules in removed + inserted:
+            affected.update(rules)
+        rebuilt = {key: {} for key in affected}
+        for block, rules in blocks:
+            for key, entries in rules.items():
+                if key not in affected:
+                    continue
+                selector_dict = rebuilt[key]
+                for selector, value in entries:
+                    # As in `rule_dict`: a repeated selector moves to the end
+                    selector_dict.pop(selector, None)
+                    selector_dict[selector] = value
+
+        # Keys stay in order of first appearance, as with a full parse
+        results = {}
+        for block, rules in blocks:
+            for key in rules:
+                if key not in results:
+                    results[key] = rebuilt[key] if key in affected else self.results[key]
+
+        changes = pmss.changeset.diff(self.results, results, affected)
+        self.blocks, self.results = blocks, results
+        return changes
+
+
+def test_update_matches_full_parse():
+    import random
+
+    import pmss.loadfile
+
+    rng = random.Random(1733)
+    pool = [
+        ".dev {\n    level: debug;\n}\n",
+        "/* comment */\n[school=mvs] {\n    level: info;\n    port: 8000;\n}\n",
+        "* {\n    port: 80;\n}\n",
+        ".dev {\n    level: trace;\n}\n",
+        "#alice.dev {\n    host: alice;\n}\n",
+        "[school^=mvs_] .dev {\n    port: 9000;\n    level: warning;\n}\n"
+    ]
+
+    def full(text):
+        return pmss.loadfile.load_pmss_string(text, provenance="test", backend='descent')
+
+    # A selector moved to the end now wins ties, and nothing else changed
+    sheet = IncrementalSheet("test")
+    sheet.update(pool[0] + ".prod {\n    level: warning;\n}\n")
+    changes = sheet.update(".prod {\n    level: warning;\n}\n" + pool[0])
+    assert changes == pmss.changeset.ChangeSet(reordered=['level']), changes
+    assert list(sheet.results['level'].values()) == ['warning', 'debug']
+
+    for trial in range(50):
+        sheet = IncrementalSheet("test")
+        blocks = []
+        previous = {}
+        for edit in range(20):
+            choice = rng.random()
+            if choice < 0.35 or not blocks:
+                blocks.insert(rng.randint(0, len(blocks)), rng.choice(pool))
+            elif choice < 0.55:
+                del blocks[rng.randrange(len(blocks))]
+            elif choice < 0.75:
+                # Move a block to the end
+                blocks.append(blocks.pop(rng.randrange(len(blocks))))
+            else:
+                position = rng.randrange(len(blocks))
+                blocks[position] = blocks[position].replace(";", f"{edit};", 1)
+            text = "".join(blocks)
+            expected = full(text)
+            changes = sheet.update(text)
+            assert pmss.loadfile._rule_list(sheet.results) == pmss.loadfile._rule_list(expected), text
+            assert changes == pmss.changeset.diff(previous, expected), (text, changes)
+            previous = expected
+
+    # Syntax errors keep the previous version
+    results = sheet.results
+    try:
+        sheet.update(text + ".broken {")
+    except pmss.pmssdescent.PMSSSyntaxError:
+        pass
+    else:
+        raise AssertionError("No syntax error")
+    assert sheet.results is results
+
+
+if __name__ == "__main__":
+    test_update_matches_full_parse()
+    print("All test cases passed successfully.")
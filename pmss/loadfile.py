@@ -2,6 +2,7 @@ import collections
 import io
 import re
 
+import pmss.pmssdescent
 import pmss.pmssyacc
 import pmss.pmsslex
 
@@ -30,16 +31,47 @@ def rule_sheet(parse_results, provenance):
     We convert a list with a selector / key / value hierarchy as
     returned by the parser into a dictionary of
     `{ key : { selector: value, selector: value }}`
+
+    Dictionaries are in source order. If a selector is repeated, the
+    later rule wins, and is moved to the later position.
+    '''
+    return rule_dict(flatten_rules(parse_results), provenance)
+
+
+def rule_dict(rules, provenance):
+    '''
+    Same as `rule_sheet`, but from flat `(selector, key, value)`
+    triples.
     '''
     d = collections.defaultdict(lambda: dict())
-    for selector, key, value in flatten_rules(parse_results):
-        selector.set_provenance(provenance)
+    interned = {}
+    # Rules from one block come with the same selector object
+    previous = previous_interned = None
+    for selector, key, value in rules:
+        if selector is not previous:
+            previous = selector
+            previous_interned = pmss.pmssselectors.intern(selector, provenance, interned)
+        selector = previous_interned
 
+        d[key].pop(selector, None)
         d[key][selector] = value.strip()
     return dict(d)
 
 
-def load_pmss_file(file, provenance, print_debug=False):
+def load_pmss_file(file, provenance, print_debug=False, cache_dir=None, backend='ply'):
+    '''
+    If `cache_dir` is given, parsed files are cached there (see
+    `pmss.compiledcache`). `backend` is as for `load_pmss_string`.
+    '''
+    if isinstance(file, str) and cache_dir is not None and not print_debug:
+        from pmss import compiledcache
+        return compiledcache.load_pmss_file(file, provenance=provenance, cache_dir=cache_dir, backend=backend)
+    if backend == 'streaming':
+        if isinstance(file, str):
+            with open(file, 'r') as f:
+                return _descent_rules(pmss.pmssdescent.parse_file(f), provenance, print_debug)
+        elif isinstance(file, io.TextIOBase):
+            return _descent_rules(pmss.pmssdescent.parse_file(file), provenance, print_debug)
     if isinstance(file, str):  # filename
         with open(file, 'r') as f:
             text = f.read()
@@ -49,19 +81,92 @@ def load_pmss_file(file, provenance, print_debug=False):
         raise ValueError(
             f"Incorrect type. Expected filename or file-like object: {file}"
         )
-    return load_pmss_string(text, provenance=provenance, print_debug=print_debug)
+    return load_pmss_string(text, provenance=provenance, print_debug=print_debug, backend=backend)
+
+
+def _descent_rules(parsed, provenance, print_debug):
+    '''
+    `rule_dict` over `(selector, key, value, line, column)` tuples from
+    `pmss.pmssdescent`, consumed as they're parsed.
+    '''
+    def rules():
+        for selector, key, value, line, column in parsed:
+            if print_debug:
+                print(f"{selector} {{ {key}: {value}; }}")
+            yield selector, key, value
+    return rule_dict(rules(), provenance)
+
+
+def load_pmss_string(text, provenance, print_debug=False, backend='ply'):
+    '''
+    Parse a PMSS sheet into `{ key : { selector: value }}`.
+
+    `backend` picks the parser:
 
+    * `'ply'`: the PLY grammar in `pmss.pmssyacc`
+    * `'descent'`: the faster, single-pass parser in `pmss.pmssdescent`
+    * `'streaming'`: the same parser, but for files, reading them one
+      top-level block at a time, so huge files needn't fit in memory
+
+    All give the same rules for valid sheets, and raise
+    `pmss.pmssdescent.PMSSSyntaxError` for invalid ones.
+    '''
+    if backend in ('descent', 'streaming'):
+        return _descent_rules(pmss.pmssdescent.parse(text), provenance, print_debug)
+    if backend != 'ply':
+        raise ValueError(f"Unknown PMSS parser backend: {backend}")
 
-def load_pmss_string(text, provenance, print_debug=False):
     no_comments = pmss.pmsslex.strip_comments(text)
-    result = pmss.pmssyacc.parser.parse(no_comments, lexer=pmss.pmsslex.lexer)
-    print(result)
+    result = pmss.pmssyacc.parse(no_comments)
     if print_debug:
         flatten_and_print_parse(result)
     rules = rule_sheet(result, provenance)
     return rules
 
 
+def _rule_list(rules):
+    '''
+    Parsed rules, in order, with their provenance, for comparing
+    backends.
+    '''
+    return [
+        (key, [(repr(selector), value) for selector, value in selector_dict.items()])
+        for key, selector_dict in rules.items()
+    ]
+
+
+def test_backends_agree():
+    import glob
+    import os
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    testdata = os.path.join(here, 'testdata')
+
+    for filename in sorted(glob.glob(os.path.join(testdata, 'errors', '*.pmss'))):
+        for backend in ('ply', 'descent', 'streaming'):
+            try:
+                load_pmss_file(filename, provenance="test", backend=backend)
+            except pmss.pmssdescent.PMSSSyntaxError:
+                continue
+            raise AssertionError(f"The `{backend}` backend parsed {filename} without an error")
+
+    # These come after the errors, so PLY also has to recover from them
+    sheets = sorted(glob.glob(os.path.join(testdata, 'sheets', '*.pmss')))
+    sheets += [
+        os.path.join(here, '..', 'creds.pmss.example'),
+        os.path.join(here, '..', 'example', 'lo.pmss')
+    ]
+    for filename in sheets:
+        if not os.path.exists(filename):
+            continue
+        expected = _rule_list(load_pmss_file(filename, provenance="test", backend='ply'))
+        for backend in ('descent', 'streaming'):
+            assert _rule_list(load_pmss_file(filename, provenance="test", backend=backend)) == expected, (filename, backend)
+        # Streaming, with blocks split across many small reads
+        with open(filename, 'r') as f:
+            assert _rule_list(_descent_rules(pmss.pmssdescent.parse_file(f, chunk_size=7), "test", False)) == expected, filename
+
+
 if __name__ == '__main__':
     rules = load_pmss_file("creds.pmss.example", provenance="test-script")
     print(rules)
@@ -69,3 +174,5 @@ if __name__ == '__main__':
     print(rules2)
     rules3 = load_pmss_string('* {foo:bar;}', provenance="test-script")
     print(rules2)
+    test_backends_agree()
+    print("All test cases passed successfully.")
@@ -0,0 +1,43 @@
+
+# parsetab.py
+# This file is automatically generated. Do not edit.
+# pylint: disable=W,C,R
+_tabversion = '3.10'
+
+_lr_method = 'LALR'
+
+_lr_signature = 'sheetATTRIBUTE_KV_SELECTOR CLASS_SELECTOR COLON COMPARISON IDENT LBRACE PSEUDO_CLASS_SELECTOR PSEUDO_ELEMENT_SELECTOR RBRACE SEMICOLON SIMPLE_ATTRIBUTE_SELECTOR UNIVERSAL_SELECTOR VALUE WHITESPACEsheet : key_value_pair\n             | emptyempty :key_value_pair : IDENT COLON VALUE SEMICOLONkey_value_pair : key_value_pair key_value_pair  selector : IDENT  selector : CLASS_SELECTOR  selector : UNIVERSAL_SELECTOR selector : selector selectorkey_value_pair : selector LBRACE key_value_pair RBRACE\n                      | selector LBRACE RBRACE selector : SIMPLE_ATTRIBUTE_SELECTORselector : ATTRIBUTE_KV_SELECTOR'
+    
+_lr_action_items = {'IDENT':([0,2,4,5,6,7,8,9,10,12,13,14,16,17,18,19,],[4,4,-6,14,-7,-8,-12,-13,4,14,4,-6,4,-11,-4,-10,]),'$end':([0,1,2,3,10,17,18,19,],[-3,0,-1,-2,-5,-11,-4,-10,]),'CLASS_SELECTOR':([0,2,4,5,6,7,8,9,10,12,13,14,16,17,18,19,],[6,6,-6,6,-7,-8,-12,-13,6,6,6,-6,6,-11,-4,-10,]),'UNIVERSAL_SELECTOR':([0,2,4,5,6,7,8,9,10,12,13,14,16,17,18,19,],[7,7,-6,7,-7,-8,-12,-13,7,7,7,-6,7,-11,-4,-10,]),'SIMPLE_ATTRIBUTE_SELECTOR':([0,2,4,5,6,7,8,9,10,12,13,14,16,17,18,19,],[8,8,-6,8,-7,-8,-12,-13,8,8,8,-6,8,-11,-4,-10,]),'ATTRIBUTE_KV_SELECTOR':([0,2,4,5,6,7,8,9,10,12,13,14,16,17,18,19,],[9,9,-6,9,-7,-8,-12,-13,9,9,9,-6,9,-11,-4,-10,]),'COLON':([4,],[11,]),'LBRACE':([4,5,6,7,8,9,12,14,],[-6,13,-7,-8,-12,-13,-9,-6,]),'RBRACE':([10,13,16,17,18,19,],[-5,17,19,-11,-4,-10,]),'VALUE':([11,],[15,]),'SEMICOLON':([15,],[18,]),}
+
+_lr_action = {}
+for _k, _v in _lr_action_items.items():
+   for _x,_y in zip(_v[0],_v[1]):
+      if not _x in _lr_action:  _lr_action[_x] = {}
+      _lr_action[_x][_k] = _y
+del _lr_action_items
+
+_lr_goto_items = {'sheet':([0,],[1,]),'key_value_pair':([0,2,10,13,16,],[2,10,10,16,10,]),'empty':([0,],[3,]),'selector':([0,2,5,10,12,13,16,],[5,5,12,5,12,5,5,]),}
+
+_lr_goto = {}
+for _k, _v in _lr_goto_items.items():
+   for _x, _y in zip(_v[0], _v[1]):
+       if not _x in _lr_goto: _lr_goto[_x] = {}
+       _lr_goto[_x][_k] = _y
+del _lr_goto_items
+_lr_productions = [
+  ("S' -> sheet","S'",1,None,None,None),
+  ('sheet -> key_value_pair','sheet',1,'p_sheet','pmssyacc.py',29),
+  ('sheet -> empty','sheet',1,'p_sheet','pmssyacc.py',30),
+  ('empty -> <empty>','empty',0,'p_empty','pmssyacc.py',38),
+  ('key_value_pair -> IDENT COLON VALUE SEMICOLON','key_value_pair',4,'p_key_value_pair','pmssyacc.py',43),
+  ('key_value_pair -> key_value_pair key_value_pair','key_value_pair',2,'p_key_value_pair_merge','pmssyacc.py',49),
+  ('selector -> IDENT','selector',1,'p_type_selector','pmssyacc.py',67),
+  ('selector -> CLASS_SELECTOR','selector',1,'p_class_selector','pmssyacc.py',72),
+  ('selector -> UNIVERSAL_SELECTOR','selector',1,'p_universal_selector','pmssyacc.py',77),
+  ('selector -> selector selector','selector',2,'p_selector_multi','pmssyacc.py',82),
+  ('key_value_pair -> selector LBRACE key_value_pair RBRACE','key_value_pair',4,'p_block','pmssyacc.py',87),
+  ('key_value_pair -> selector LBRACE RBRACE','key_value_pair',3,'p_block','pmssyacc.py',88),
+  ('selector -> SIMPLE_ATTRIBUTE_SELECTOR','selector',1,'p_simple_attribute_selector','pmssyacc.py',96),
+  ('selector -> ATTRIBUTE_KV_SELECTOR','selector',1,'p_attribute_kv_selector','pmssyacc.py',101),
+]
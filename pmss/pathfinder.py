@@ -4,7 +4,6 @@ paths.
 '''
 
 import os.path
-import pkg_resources
 import types
 import sys
 
@@ -53,6 +52,8 @@ def package_config_file(package, name):
         raise ValueError("Package {package} is not a module or a string")
         # Or maybe: return None
 
+    # `pkg_resources` is slow to import, so we only do so if needed
+    import pkg_resources
     return pkg_resources.resource_filename(package, name)
 
 
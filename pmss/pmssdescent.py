@@ -0,0 +1,393 @@
+'''
+A hand-written, single-pass parser for PMSS. This is an alternative to
+the PLY lexer and parser (`pmsslex` / `pmssyacc`), selected with
+`backend='descent'` in `pmss.loadfile`.
+
+The PLY pipeline strips comments with two regexps over the whole text,
+tokenizes, builds a nested parse tree, and then walks that tree again
+in `flatten_rules`. Here, we go over the text once: comments are
+skipped as we reach them, and we yield flat `(selector, key, value,
+line, column)` tuples directly, keeping the selectors of enclosing
+blocks on a stack. `parse_file` does the same for files too large to
+read into memory at once, one top-level block at a time.
+
+We accept the same language, and produce the same rules, as the PLY
+backend:
+
+* Selectors are type (`roster`), class (`.dev`), universal (`*`),
+  and attribute (`[school]`, `[school=middlesex]`) selectors, with
+  blocks nested to any depth.
+* A value is everything from the `:` to the next `;`, minus comments
+  (so `url: http://example.com;` is cut short by the `//`, just as it
+  is with PLY).
+* Characters which can't start a token are reported and skipped.
+
+Broken input raises `PMSSSyntaxError` with either backend (PLY's line
+and column are in the sheet with comments stripped; ours are in the
+original), and empty sheets give no rules. The one difference is that
+a comment directly between two characters of a token (`scho/**/ol`)
+separates them here. PLY's comment pass would join them.
+'''
+
+import re
+
+import pmss.pmssselectors
+
+_NAME = r'[a-zA-Z0-9_]+'
+_ATTRIBUTE_VALUE = r'''(?:"[^"/:{};\[\]\n]*"|'[^'/:{};\[\]\n]*'|[^\s"'/:{};\[\]]+)'''
+
+# Mirrors the token rules in `pmss.pmsslex`, in the order PLY tries
+# them. Whitespace before a token is skipped in the same match.
+_TOKEN = re.compile(rf'''
+    [\t\r\n\f ]*
+    (?:
+    (?P<end>$)
+  | (?P<comment>/\*[^*]*\*+(?:[^/*][^*]*\*+)*/)
+  | (?P<line_comment>//)
+  | (?P<colon>:)
+  | (?P<lbrace>\{{)
+  | (?P<rbrace>\}})
+  | (?P<attribute_value>\[(?P<kv_attribute>{_NAME})(?P<kv_operator>~=|\|=|\^=|\$=|\*=|=)(?P<kv_value>{_ATTRIBUTE_VALUE})\])
+  | (?P<attribute>\[(?P<attribute_name>{_NAME})\])
+  | (?P<comparison>~=|\|=|\^=|\$=|\*=|=)
+  | (?P<class_selector>\.{_NAME})
+  | (?P<ident>{_NAME})
+  | (?P<universal>\*)
+    )
+''', re.VERBOSE)
+
+_BLOCK_COMMENT = re.compile(r'/\*[^*]*\*+(?:[^/*][^*]*\*+)*/')
+_VALUE_CHUNK = re.compile(r'[^;/]+')
+_SIMPLE_VALUE = re.compile(r'([^;/]+);')
+
+
+class PMSSSyntaxError(ValueError):
+    '''
+    A syntax error in a PMSS sheet, with (1-based) `line` and `column`.
+    '''
+    def __init__(self, message, line, column):
+        super().__init__(f"{message} (line {line}, column {column})")
+        self.message = message
+        self.line = line
+        self.column = column
+
+    def __reduce__(self):
+        # So errors survive being sent back from another process
+        return (type(self), (self.message, self.line, self.column))
+
+
+_SIMPLE_SELECTORS = frozenset(['class_selector', 'universal', 'attribute', 'attribute_value'])
+_WHITESPACE = re.compile(r'[\t\r\n\f ]*')
+
+
+def _skip_whitespace(text, pos):
+    return _WHITESPACE.match(text, pos).end()
+
+
+def _position(text, pos, start=(1, 1)):
+    '''
+    Line and column of `text[pos]`, where `text` itself starts at
+    `start` (a `(line, column)` pair) in the file.
+    '''
+    newline = text.rfind('\n', 0, pos)
+    if newline == -1:
+        return start[0], start[1] + pos
+    return start[0] + text.count('\n', 0, pos), pos - newline
+
+
+def _error(text, pos, message, start=(1, 1)):
+    line, column = _position(text, pos, start)
+    return PMSSSyntaxError(message, line, column)
+
+
+def _line_comment_end(text, pos):
+    '''
+    Where a `//` comment at `pos` ends. This is usually the end of the
+    line, but a `/* */` comment inside it may run over several lines.
+    We treat that case the way `strip_comments` does.
+    '''
+    while True:
+        newline = text.find('\n', pos)
+        block = text.find('/*', pos, None if newline == -1 else newline)
+        if block == -1:
+            return len(text) if newline == -1 else newline
+        match = _BLOCK_COMMENT.match(text, block)
+        if match is None:
+            # Unterminated, so not a comment
+            return len(text) if newline == -1 else newline
+        pos = match.end()
+
+
+def _value(text, pos):
+    '''
+    Read a value starting just after a `:`. Returns the value, and the
+    position just after the `;` which ends it.
+    '''
+    match = _SIMPLE_VALUE.match(text, pos)
+    if match is not None:
+        return match.group(1), match.end()
+    pieces = []
+    length = len(text)
+    while pos < length:
+        match = _VALUE_CHUNK.match(text, pos)
+        if match is not None:
+            pieces.append(match.group())
+            pos = match.end()
+            continue
+        if text[pos] == ';':
+            return ''.join(pieces), pos + 1
+        # A `/`: maybe a comment
+        if text.startswith('/*', pos):
+            match = _BLOCK_COMMENT.match(text, pos)
+            if match is not None:
+                pos = match.end()
+                continue
+        elif text.startswith('//', pos):
+            pos = _line_comment_end(text, pos)
+            continue
+        pieces.append('/')
+        pos += 1
+    return None, pos
+
+
+def parse(text, start=(1, 1)):
+    '''
+    Yield `(selector, key, value, line, column)` for each rule in
+    `text`, in source order. The line and column are those of the key,
+    counting from `start` (for when `text` is part of a larger file).
+    Values aren't stripped, just as with the PLY backend.
+    '''
+    selectors = pmss.pmssselectors
+    null_selector = selectors.NullSelector()
+    parents = []             # Combined selectors of the enclosing blocks
+    parent = null_selector   # Combined selector of the current block
+    selector = None          # Selector we're reading, before its `{`
+    selector_pos = None
+    ident = None             # An identifier: either a key or a type selector
+    ident_pos = None
+    pos = 0
+    length = len(text)
+    line, counted = start[0], 0     # Line number at position `counted`
+    simple_selectors = {}    # Selectors are immutable, so we reuse them
+
+    while True:
+        match = _TOKEN.match(text, pos)
+        if match is None:
+            pos = _skip_whitespace(text, pos)
+            print("Illegal character '%s'" % text[pos])
+            pos += 1
+            continue
+        kind = match.lastgroup
+        token_start = match.start(kind)
+        pos = match.end()
+        if kind == 'end':
+            break
+        if kind == 'comment':
+            continue
+        if kind == 'line_comment':
+            pos = _line_comment_end(text, token_start)
+            continue
+
+        if ident is not None:
+            if kind == 'colon' and selector is None:
+                # `key: value;`
+                if not parents:
+                    raise _error(text, ident_pos, f"Rule for `{ident}` is not inside a block", start)
+                value, pos = _value(text, pos)
+                if not value:
+                    raise _error(text, ident_pos, f"Missing value for `{ident}`", start)
+                line += text.count('\n', counted, ident_pos)
+                counted = ident_pos
+                newline = text.rfind('\n', 0, ident_pos)
+                column = start[1] + ident_pos if newline == -1 else ident_pos - newline
+                yield parent, ident, value, line, column
+                ident = None
+                continue
+            # Otherwise, it was a type selector
+            simple = simple_selectors.get(ident)
+            if simple is None:
+                simple = simple_selectors[ident] = selectors.TypeSelector(ident)
+            if selector is None:
+                selector, selector_pos = simple, ident_pos
+            else:
+                selector = selector + simple
+            ident = None
+
+        if kind == 'ident':
+            ident, ident_pos = match.group(kind), token_start
+            continue
+
+        simple = None
+        if kind in _SIMPLE_SELECTORS:
+            token = match.group(kind)
+            simple = simple_selectors.get(token)
+            if simple is None:
+                if kind == 'class_selector':
+                    simple = selectors.ClassSelector(token)
+                elif kind == 'universal':
+                    simple = selectors.UniversalSelector()
+                elif kind == 'attribute':
+                    simple = selectors.AttributeSelector(attribute=match.group('attribute_name'), operator=None, value=None)
+                else:
+                    simple = selectors.AttributeSelector(
+                        match.group('kv_attribute'), match.group('kv_operator'), selectors.unquote(match.group('kv_value'))
+                    )
+                simple_selectors[token] = simple
+        if simple is not None:
+            if selector is None:
+                selector, selector_pos = simple, token_start
+            else:
+                selector = selector + simple
+            continue
+
+        if kind == 'lbrace':
+            if selector is None:
+                raise _error(text, token_start, "Expected a selector before `{`", start)
+            parents.append(parent)
+            parent = parent + selector
+            selector = None
+        elif kind == 'rbrace':
+            if selector is not None:
+                raise _error(text, selector_pos, "Expected `{` after selector", start)
+            if not parents:
+                raise _error(text, token_start, "Unmatched `}`", start)
+            parent = parents.pop()
+        elif kind == 'colon':
+            raise _error(text, token_start, "Unexpected `:` after a selector", start)
+        else:
+            raise _error(text, token_start, f"Unexpected `{match.group(kind)}`", start)
+
+    if ident is not None:
+        raise _error(text, ident_pos, f"Unexpected `{ident}` at end of file", start)
+    if selector is not None:
+        raise _error(text, selector_pos, "Expected `{` after selector", start)
+    if parents:
+        raise _error(text, length, "Missing `}` at end of file", start)
+
+
+_INITIAL_SPECIAL = re.compile(r'[{}:/]')
+_VALUE_SPECIAL = re.compile(r'[;/]')
+
+
+def _comment_end(text, pos, final):
+    '''
+    For a `/` at `pos`: the position just after the comment it starts,
+    `pos + 1` if it doesn't start one, or `None` if we can't tell
+    without more text.
+    '''
+    if pos + 1 >= len(text):
+        return pos + 1 if final else None
+    if text[pos + 1] == '*':
+        match = _BLOCK_COMMENT.match(text, pos)
+        if match is not None:
+            return match.end()
+        return pos + 1 if final else None
+    if text[pos + 1] == '/':
+        while True:
+            newline = text.find('\n', pos)
+            block = text.find('/*', pos, None if newline == -1 else newline)
+            if block != -1:
+                match = _BLOCK_COMMENT.match(text, block)
+                if match is not None:
+                    pos = match.end()
+                    continue
+                if not final:
+                    return None
+            if newline == -1:
+                return len(text) if final else None
+            return newline
+    return pos + 1
+
+
+def _scan(text, pos, depth, in_value, final, cuts):
+    '''
+    Track braces, values, and comments from `pos` onwards, to find
+    where top-level blocks end. Appends the position just after each
+    complete top-level block to `cuts`. Returns `(pos, depth,
+    in_value)`, where `pos` is where to carry on once there's more
+    text.
+    '''
+    while True:
+        match = (_VALUE_SPECIAL if in_value else _INITIAL_SPECIAL).search(text, pos)
+        if match is None:
+            return len(text), depth, in_value
+        pos = match.start()
+        char = text[pos]
+        if char == '/':
+            end = _comment_end(text, pos, final)
+            if end is None:
+                return pos, depth, in_value
+            pos = end
+            continue
+        pos += 1
+        if in_value:
+            in_value = False  # `;`
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth <= 0:
+                # An unmatched `}` also ends a block, so `parse` reports it
+                depth = 0
+                cuts.append(pos)
+        else:
+            in_value = True   # `:`
+
+
+def parse_chunks(chunks):
+    '''
+    Same as `parse`, for text arriving in pieces (e.g. read from a
+    file a megabyte at a time). We hold on to text only until the
+    top-level block it's in is complete, so memory use depends on the
+    size of the largest block, rather than of the whole sheet.
+    '''
+    buffer = ''
+    scanned = 0
+    depth = 0
+    in_value = False
+    start = (1, 1)
+    chunks = iter(chunks)
+    final = False
+    while not final:
+        chunk = next(chunks, None)
+        if chunk is None:
+            final = True
+        else:
+            buffer += chunk
+        cuts = []
+        scanned, depth, in_value = _scan(buffer, scanned, depth, in_value, final, cuts)
+        cut = len(buffer) if final else (cuts[-1] if cuts else 0)
+        if not cut:
+            continue
+        segment = buffer[:cut]
+        yield from parse(segment, start)
+        start = _position(segment, cut, start)
+        buffer = buffer[cut:]
+        scanned -= cut
+
+
+def parse_file(file, chunk_size=1 << 18):
+    '''
+    `parse_chunks` over a text file object, read `chunk_size`
+    characters at a time.
+    '''
+    return parse_chunks(iter(lambda: file.read(chunk_size), ''))
+
+
+def split_blocks(text):
+    '''
+    Split a sheet into the texts of its top-level blocks, each with any
+    whitespace and comments before it. The last entry holds anything
+    after the last block, so joining them gives back `text`. This is
+    much faster than parsing, so callers can find which blocks changed
+    between two versions of a sheet, and parse just those.
+    '''
+    cuts = []
+    _scan(text, 0, 0, False, True, cuts)
+    blocks = []
+    previous = 0
+    for cut in cuts:
+        blocks.append(text[previous:cut])
+        previous = cut
+    blocks.append(text[previous:])
+    return blocks
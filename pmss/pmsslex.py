@@ -1,5 +1,12 @@
-from ply import lex, yacc
+'''
+Lexer for PMSS. The PLY lexer is built on first use (see
+`get_lexer()`), so importing pmss doesn't pay for compiling the
+token regexps unless we actually parse a file.
+'''
+
 import re
+import sys
+import threading
 
 tokens = (
     "WHITESPACE",
@@ -30,12 +37,15 @@ def t_WHITESPACE(t):
 
 
 t_IDENT = r"[a-zA-Z0-9_]+"
-t_COMPARISON = r'(=|~=|\|=|^=|\$=|\*=)'
+ATTRIBUTE_OPERATOR = r'(?:=|~=|\|=|\^=|\$=|\*=)'
+t_COMPARISON = '(' + ATTRIBUTE_OPERATOR + ')'
+# Values in attribute selectors: bare, or quoted, if they have spaces
+ATTRIBUTE_VALUE = r'''(?:"[^"/:{};\[\]\n]*"|'[^'/:{};\[\]\n]*'|[^\s"'/:{};\[\]]+)'''
 # Possible TODO:
 # * Many of these should move into the parser.
 t_CLASS_SELECTOR = r"\." + t_IDENT
 t_SIMPLE_ATTRIBUTE_SELECTOR = r"\[" + t_IDENT + "\]"
-t_ATTRIBUTE_KV_SELECTOR = r"\[" + t_IDENT + "=" + t_IDENT + "\]"
+t_ATTRIBUTE_KV_SELECTOR = r"\[" + t_IDENT + ATTRIBUTE_OPERATOR + ATTRIBUTE_VALUE + r"\]"
 t_UNIVERSAL_SELECTOR = r"[*]"
 t_PSEUDO_CLASS_SELECTOR = r"\:" + t_IDENT
 t_PSEUDO_ELEMENT_SELECTOR = r"\:\:" + t_IDENT
@@ -80,8 +90,28 @@ def t_value_error(t):
     print("Illegal character '%s'" % t.value[0])
     t.lexer.skip(1)
 
-# Build the lexer
-lexer = lex.lex()
+_lexer = None
+_lexer_lock = threading.Lock()
+
+
+def get_lexer():
+    '''
+    The shared lexer, built the first time it's needed.
+    '''
+    global _lexer
+    if _lexer is None:
+        with _lexer_lock:
+            if _lexer is None:
+                from ply import lex
+                _lexer = lex.lex(module=sys.modules[__name__])
+    return _lexer
+
+
+def __getattr__(name):
+    # `pmss.pmsslex.lexer` is built lazily
+    if name == 'lexer':
+        return get_lexer()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def strip_comments(text):
@@ -94,6 +124,7 @@ def strip_comments(text):
 
 # Test the lexer
 def test_lexer(input_string):
+    lexer = get_lexer()
     lexer.input(input_string)
     while True:
         token = lexer.token()
@@ -1,12 +1,107 @@
 import json
+import re
+import warnings
+
+_set = object.__setattr__
+
+# Attribute values which can be written without quotes. Anything else
+# (e.g. with spaces) is quoted, e.g. `[name~="a b"]`.
+_UNQUOTED_VALUE = re.compile(r'[^\s"\'/:{};\[\]]+')
+
+
+def unquote(value):
+    '''
+    An attribute value as written in a sheet, without its quotes.
+    '''
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return value
+
+
+def _attribute_test(operator, expected):
+    '''
+    A function of an attribute's value in a context, returning whether
+    `[attribute<operator><expected>]` matches, as in CSS. Other than
+    `=`, operators only match strings, and `^=`, `$=`, `*=` and `~=`
+    never match an empty (or, for `~=`, multi-word) `expected`.
+    '''
+    if operator == '=':
+        return lambda actual: expected == actual
+    if operator == '~=':
+        if not expected or expected.split() != [expected]:
+            return lambda actual: False
+        return lambda actual: isinstance(actual, str) and expected in actual.split()
+    if operator == '|=':
+        dashed = expected + '-'
+        return lambda actual: isinstance(actual, str) and (actual == expected or actual.startswith(dashed))
+    if operator == '^=':
+        if not expected:
+            return lambda actual: False
+        return lambda actual: isinstance(actual, str) and actual.startswith(expected)
+    if operator == '$=':
+        if not expected:
+            return lambda actual: False
+        return lambda actual: isinstance(actual, str) and actual.endswith(expected)
+    if operator == '*=':
+        if not expected:
+            return lambda actual: False
+        return lambda actual: isinstance(actual, str) and expected in actual
+    raise ValueError(f"Unknown attribute operator: {operator}")
 
 
 class Selector():
+    '''
+    Selectors are immutable once constructed. They're used as
+    dictionary keys in every ruleset, and we hold a lot of them, so we
+    use `__slots__`, and compute the hash once, on construction.
+    (Computing it on first use was no faster, even though the parser
+    builds intermediate selectors which are never hashed: the first
+    lookup then had to catch an `AttributeError`.)
+
+    Subclasses set their own fields with `_set`, before calling
+    `Selector.__init__`, since the hash depends on them.
+    '''
+    __slots__ = ('provenance', '_hash')
+
     def __init__(self, provenance=None):
-        self.provenance = provenance
+        _set(self, 'provenance', provenance)
+        _set(self, '_hash', hash(str(provenance) + ":" + str(self)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def _args(self):
+        '''
+        Constructor arguments, other than provenance. Used to copy and
+        to pickle selectors.
+        '''
+        raise NotImplementedError('This should be defined on a subclass')
+
+    def __reduce__(self):
+        return (type(self), self._args() + (self.provenance,))
 
     def set_provenance(self, provenance):
-        self.provenance = provenance
+        '''
+        Deprecated, since selectors are immutable: this can't change
+        `self`, and returns `with_provenance(provenance)` instead.
+        '''
+        warnings.warn(
+            "Selectors are immutable; use `selector = selector.with_provenance(provenance)`",
+            DeprecationWarning,
+            stacklevel=2
+        )
+        return self.with_provenance(provenance)
+
+    def with_provenance(self, provenance):
+        '''
+        A copy of this selector, with a different provenance.
+        '''
+        if provenance == self.provenance:
+            return self
+        return type(self)(*self._args(), provenance=provenance)
 
     def css_specificity(self):
         '''
@@ -30,38 +125,43 @@ class Selector():
         if isinstance(self, CompoundSelector):
             self_selectors = self.selectors
         else:
-            self_selectors = [self]
+            self_selectors = (self,)
 
         if isinstance(other, CompoundSelector):
             other_selectors = other.selectors
         else:
-            other_selectors = [other]
+            other_selectors = (other,)
 
         return CompoundSelector(self_selectors + other_selectors)
 
     def __str__(self):
-        raise UnimplementedError("This function should always be overridden.")
+        raise NotImplementedError("This function should always be overridden.")
 
     def __repr__(self):
         return f"<{self.__class__.__name__} {self} / {self.provenance}>"
 
     def __hash__(self):
-        return hash(str(self.provenance) + ":" + str(self))
+        return self._hash
 
     def __ne__(self, other):
         return not self == other
 
     def match(self, id=None, types=[], classes=[], attributes={}):
-        raise UnimplementedError("This function should always be overridden.")
+        raise NotImplementedError("This function should always be overridden.")
 
 
 class ClassSelector(Selector):
     # e.g. `.foo`
+    __slots__ = ('class_name',)
+
     def __init__(self, class_name, provenance=None):
-        super().__init__(provenance=provenance)
         if class_name[0] == ".":
             class_name = class_name[1:]
-        self.class_name = class_name
+        _set(self, 'class_name', class_name)
+        super().__init__(provenance=provenance)
+
+    def _args(self):
+        return (self.class_name,)
 
     def css_specificity(self):
         return 10
@@ -75,8 +175,7 @@ class ClassSelector(Selector):
 
         return self.class_name == other.class_name
 
-    def __hash__(self):
-        return super().__hash__()
+    __hash__ = Selector.__hash__
 
     def match(self, id=None, types=[], classes=[], attributes={}):
         if self.class_name in classes:
@@ -86,11 +185,16 @@ class ClassSelector(Selector):
 
 class TypeSelector(Selector):
     # e.g. `div`
+    __slots__ = ('element_type',)
+
     def __init__(self, element_type, provenance=None):
-        super().__init__(provenance=provenance)
         if element_type is None:
             raise AttributeError("Element type should be a string")
-        self.element_type = element_type
+        _set(self, 'element_type', element_type)
+        super().__init__(provenance=provenance)
+
+    def _args(self):
+        return (self.element_type,)
 
     def __str__(self):
         return self.element_type
@@ -101,8 +205,7 @@ class TypeSelector(Selector):
 
         return self.element_type == other.element_type
 
-    def __hash__(self):
-        return super().__hash__()
+    __hash__ = Selector.__hash__
 
     def css_specificity(self):
         return 1
@@ -115,11 +218,16 @@ class TypeSelector(Selector):
 
 class IDSelector(Selector):
     # e.g. `#bar`
+    __slots__ = ('id_name',)
+
     def __init__(self, id_name, provenance=None):
-        super().__init__(provenance=provenance)
         if id_name[0] == "#":
             id_name = id_name[1:]
-        self.id_name = id_name
+        _set(self, 'id_name', id_name)
+        super().__init__(provenance=provenance)
+
+    def _args(self):
+        return (self.id_name,)
 
     def __str__(self):
         return f"#{self.id_name}"
@@ -130,8 +238,7 @@ class IDSelector(Selector):
 
         return self.id_name == other.id_name
 
-    def __hash__(self):
-        return super().__hash__()
+    __hash__ = Selector.__hash__
 
     def css_specificity(self):
         return 100
@@ -144,9 +251,14 @@ class IDSelector(Selector):
 
 class PseudoClassSelector(Selector):
     # e.g. `:hover`
+    __slots__ = ('pseudo_class',)
+
     def __init__(self, pseudo_class, provenance=None):
+        _set(self, 'pseudo_class', pseudo_class)
         super().__init__(provenance=provenance)
-        self.pseudo_class = pseudo_class
+
+    def _args(self):
+        return (self.pseudo_class,)
 
     def __str__(self):
         return f":{self.pseudo_class}"
@@ -157,8 +269,7 @@ class PseudoClassSelector(Selector):
 
         return self.pseudo_class == other.pseudo_class
 
-    def __hash__(self):
-        return super().__hash__()
+    __hash__ = Selector.__hash__
 
     def css_specificity(self):
         return 10
@@ -169,9 +280,14 @@ class PseudoClassSelector(Selector):
 
 class PseudoElementSelector(Selector):
     # e.g. `::before`
+    __slots__ = ('pseudo_element',)
+
     def __init__(self, pseudo_element, provenance=None):
+        _set(self, 'pseudo_element', pseudo_element)
         super().__init__(provenance=provenance)
-        self.pseudo_element = pseudo_element
+
+    def _args(self):
+        return (self.pseudo_element,)
 
     def __str__(self):
         return f"::{self.pseudo_element}"
@@ -182,8 +298,7 @@ class PseudoElementSelector(Selector):
 
         return self.pseudo_element == other.pseudo_element
 
-    def __hash__(self):
-        return super().__hash__()
+    __hash__ = Selector.__hash__
 
     def css_specificity(self):
         return 10
@@ -198,16 +313,27 @@ class AttributeSelector(Selector):
     # https://developer.mozilla.org/en-US/docs/Learn/CSS/Building_blocks/Selectors/Attribute_selectors
     #
     # Note that we treat [biff] (an attribute exists) as operator and value simply being None
+    #
+    # The test for the operator is built once, here, rather than on
+    # every match.
+    __slots__ = ('attribute', 'operator', 'value', '_test')
+
     def __init__(self, attribute, operator, value, provenance=None):
+        _set(self, 'attribute', attribute)
+        _set(self, 'operator', operator)
+        _set(self, 'value', value)
+        _set(self, '_test', None if operator is None else _attribute_test(operator, value))
         super().__init__(provenance=provenance)
-        self.attribute = attribute
-        self.operator = operator
-        self.value = value
+
+    def _args(self):
+        return (self.attribute, self.operator, self.value)
 
     def __str__(self):
         if self.operator is None:
             return f"[{self.attribute}]"
-        return f"[{self.attribute}{self.operator}{self.value}]"
+        if isinstance(self.value, str) and _UNQUOTED_VALUE.fullmatch(self.value):
+            return f"[{self.attribute}{self.operator}{self.value}]"
+        return f"[{self.attribute}{self.operator}{json.dumps(self.value)}]"
 
     def __eq__(self, other):
         if not isinstance(other, AttributeSelector):
@@ -215,8 +341,7 @@ class AttributeSelector(Selector):
 
         return self.attribute == other.attribute and self.operator == other.operator and self.value == other.value
 
-    def __hash__(self):
-        return super().__hash__()
+    __hash__ = Selector.__hash__
 
     def css_specificity(self):
         return 10
@@ -226,18 +351,25 @@ class AttributeSelector(Selector):
             return False
         if self.operator is None:
             return True
-        if self.operator != '=':
-            raise NotImplementedError("TODO: Implement non-equality operators in AttributeSelector")
-        if self.value == attributes[self.attribute]:
-            return True
-        return False
+        return self._test(attributes[self.attribute])
+
+    def match_value(self, value):
+        '''
+        Whether a context whose attribute has this value would match.
+        '''
+        return self.operator is None or self._test(value)
 
 
 class CompoundSelector(Selector):
     # e.g. '.foo.bar [baz=biff] [bam] blah
+    __slots__ = ('selectors', '_specificity')
+
     def __init__(self, selectors, provenance=None):
+        _set(self, 'selectors', tuple(selectors))
         super().__init__(provenance=provenance)
-        self.selectors = selectors
+
+    def _args(self):
+        return (self.selectors,)
 
     def __str__(self):
         return " ".join(map(str, self.selectors))
@@ -251,27 +383,34 @@ class CompoundSelector(Selector):
         return all(s1 == s2 for s1, s2 in zip(self.selectors, other.selectors))
 
     def css_specificity(self):
-        return sum(s.css_specificity() for s in self.selectors)
+        try:
+            return self._specificity
+        except AttributeError:
+            _set(self, '_specificity', sum(s.css_specificity() for s in self.selectors))
+            return self._specificity
 
-    def __hash__(self):
-        return super().__hash__()
+    __hash__ = Selector.__hash__
 
     def match(self, *args, **kwargs):
         return all([s.match(*args, **kwargs) for s in self.selectors])
 
 
 class NullSelector(CompoundSelector):
+    __slots__ = ()
+
     def __init__(self, provenance=None):
         super().__init__([])
 
+    def _args(self):
+        return ()
+
     def __str__(self):
         return '---'
 
     def __eq__(self, other):
         return isinstance(other, NullSelector)
 
-    def __hash__(self):
-        return super().__hash__()
+    __hash__ = Selector.__hash__
 
     def css_specificity(self):
         return 0
@@ -281,9 +420,14 @@ class NullSelector(CompoundSelector):
 
 
 class UniversalSelector(Selector):
+    __slots__ = ()
+
     def __init__(self, provenance=None):
         super().__init__(provenance=provenance)
 
+    def _args(self):
+        return ()
+
     def css_specificity(self):
         return 0
 
@@ -293,13 +437,44 @@ class UniversalSelector(Selector):
     def __eq__(self, other):
         return isinstance(other, UniversalSelector)
 
-    def __hash__(self):
-        return super().__hash__()
+    __hash__ = Selector.__hash__
 
     def match(self, *args, **kwargs):
         return True
 
 
+def intern(selector, provenance, table):
+    '''
+    Return a selector equal to `selector`, with the given provenance,
+    shared with every other equal selector passed in with the same
+    `table` (a dictionary). Since selectors are immutable, a sheet
+    with a thousand `[school=...] .class` blocks only needs one
+    instance of each `[school=...]`.
+
+    Selectors within a compound selector keep their own provenance.
+    '''
+    if type(selector) is CompoundSelector:
+        # Most entries are compound selectors, so we keep their keys
+        # small: the tuple of (interned) children, which the interned
+        # selector holds on to anyway.
+        children = tuple([intern(child, child.provenance, table) for child in selector.selectors])
+        compounds = table.get((CompoundSelector, provenance))
+        if compounds is None:
+            compounds = table[(CompoundSelector, provenance)] = {}
+        interned = compounds.get(children)
+        # Children compare equal regardless of their provenance, so we
+        # check it's really the same children
+        if interned is None or not all(a is b for a, b in zip(interned.selectors, children)):
+            interned = compounds[children] = CompoundSelector(children, provenance=provenance)
+        return interned
+    args = selector._args()
+    key = (type(selector), args, provenance)
+    interned = table.get(key)
+    if interned is None:
+        interned = table[key] = type(selector)(*args, provenance=provenance)
+    return interned
+
+
 sort_hierarchy = [
     AttributeSelector,
     UniversalSelector,
@@ -404,6 +579,22 @@ def test_selector_classes():
         attributes={ATTRIBUTE_KEY: ELEMENT_TYPE}
     )
 
+
+def test_provenance():
+    import pickle
+
+    selector = ClassSelector('test_class') + AttributeSelector('foo', '=', 'bar')
+    moved = selector.with_provenance('test.pmss')
+    assert moved == selector and moved.provenance == 'test.pmss' and selector.provenance is None
+    assert hash(moved) == hash(pickle.loads(pickle.dumps(moved)))
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        assert selector.set_provenance('test.pmss') == moved
+    assert [warning.category for warning in caught] == [DeprecationWarning]
+    assert selector.provenance is None
+
+
 if __name__ == "__main__":
     test_selector_classes()
+    test_provenance()
     print("All test cases passed successfully.")
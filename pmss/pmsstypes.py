@@ -19,7 +19,6 @@ languages. TSVx has some thoughts about this.
 
 import configparser
 import collections
-import doctest
 import datetime
 import enum
 import functools
@@ -29,6 +28,8 @@ import re
 
 _TYPES_DICT = collections.defaultdict(dict)
 
+_MISSING = object()
+
 class DictEnum:
     def __init__(self, d):
         self.d = d
@@ -98,7 +99,8 @@ def parser(
         max=None,
         parent=None,
         choices=None,
-        transform=TransformType.Decorator
+        transform=TransformType.Decorator,
+        memo_size=None
 ):
     '''We want to be able to call the parser as both a
     decorator and call it without including a function.
@@ -110,30 +112,20 @@ def parser(
 
     Additionally, we use a closure so we can validate (check
     the regex, min, max, choices, etc.) the output of
-    whatever function is used for the parser.
+    whatever function is used for the parser. See `_compile`.
+
+    If `memo_size` is given, up to that many conversions of string
+    values are remembered. Only use this when the conversion depends
+    on nothing but the value, and returns something immutable.
 
     NOTE: the `transform` parameter will do nothing (gets
     overwritten) when this function is called as a decorator
     '''
     def validate_value(value_function):
-        def new_func(value, **kwargs):
-            if validation_regexp and isinstance(value, str):
-                if not re.match(validation_regexp, value):
-                    raise ValueError(f"Value '{value}' does not match the required pattern {validation_regexp})")
-            if parent:
-                value = _TYPES_DICT[parent]['parser'](value)
-            parsed = value_function(value, **kwargs)
-            if min is not None and parsed < min:
-                raise ValueError(f"Value '{value}' ('{parsed}') is less than {min}")
-            if max is not None and parsed > max:
-                raise ValueError(f"Value '{value}' ('{parsed}') is more than {max}")
-            if choices is not None and value not in choices:
-                raise ValueError(f"Value '{value}' ('{parsed}') is not a valid option for {type_name}. Available choices: {choices}")
-            return parsed
-        return new_func
+        return _compile(type_name, value_function, validation_regexp, min, max, parent, choices, memo_size)
 
     def inner(func):
-        _TYPES_DICT[type_name]['parser'] = validate_value(func)
+        _register(type_name, validate_value(func))
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             return func(*args, **kwargs)
@@ -143,9 +135,82 @@ def parser(
         transformation_func = transform if transform is not None else lambda val: val
         if not callable(transformation_func):
             raise TypeError('The transform paramter must be a callable function.')
-        _TYPES_DICT[type_name]['parser'] = validate_value(transformation_func)
+        _register(type_name, validate_value(transformation_func))
     return inner
 
+
+def _register(type_name, type_parser):
+    _TYPES_DICT[type_name]['parser'] = type_parser
+    # Memoized conversions may have gone through the old parser, as
+    # a parent. Registration is rare, so we just forget them all.
+    for info in _TYPES_DICT.values():
+        memo = getattr(info.get('parser'), 'memo', None)
+        if memo is not None:
+            memo.clear()
+
+
+def _compile(type_name, value_function, validation_regexp, min, max, parent, choices, memo_size):
+    '''
+    Build the parser for a type once, when it's registered: the
+    regexp is compiled, and `choices` made into a set. Checks which
+    don't apply are left out entirely, so a type with none of them is
+    just `value_function`.
+
+    The parent's parser is looked up on each call, so a type may be
+    registered before its parent, and picks up a parent which is
+    registered again.
+    '''
+    pattern = re.compile(validation_regexp) if validation_regexp else None
+    choice_set = None
+    if choices is not None:
+        try:
+            choice_set = frozenset(choices)
+        except TypeError:
+            choice_set = None  # Unhashable choices; check the list as given
+    bounded = min is not None or max is not None
+
+    if pattern is None and not parent and not bounded and choices is None and not memo_size:
+        return value_function
+
+    def new_func(value, **kwargs):
+        if pattern is not None and isinstance(value, str) and pattern.match(value) is None:
+            raise ValueError(f"Value '{value}' does not match the required pattern {validation_regexp})")
+        if parent:
+            value = _TYPES_DICT[parent]['parser'](value)
+        parsed = value_function(value, **kwargs)
+        if bounded:
+            if min is not None and parsed < min:
+                raise ValueError(f"Value '{value}' ('{parsed}') is less than {min}")
+            if max is not None and parsed > max:
+                raise ValueError(f"Value '{value}' ('{parsed}') is more than {max}")
+        if choices is not None:
+            try:
+                valid = value in (choice_set if choice_set is not None else choices)
+            except TypeError:
+                valid = value in choices
+            if not valid:
+                raise ValueError(f"Value '{value}' ('{parsed}') is not a valid option for {type_name}. Available choices: {choices}")
+        return parsed
+
+    if not memo_size:
+        return new_func
+
+    memo = {}
+
+    def memoized(value, **kwargs):
+        # Only plain strings: `1`, `1.0`, and `True` are equal as keys
+        if kwargs or type(value) is not str:
+            return new_func(value, **kwargs)
+        parsed = memo.get(value, _MISSING)
+        if parsed is _MISSING:
+            parsed = new_func(value)
+            if len(memo) < memo_size:
+                memo[value] = parsed
+        return parsed
+    memoized.memo = memo
+    return memoized
+
+
 @parser("string")
 def _convert_to_string(value):
     return str(value)
@@ -225,7 +290,7 @@ TIME_UNIT_ALIASES = {
     'ms': ['millisecond', 'milliseconds']
 }
 
-@parser("timedelta")
+@parser("timedelta", memo_size=1024)
 def _convert_to_timedelta(value):
     """
     Return a timedelta object translating from other types if necessary.
@@ -320,7 +385,8 @@ def _convert_to_int(value):
 @parser("port",
         parent="integer",
         min=0,
-        max=65535)
+        max=65535,
+        memo_size=1024)
 def _validate_port(value):
     return value
 
@@ -370,6 +436,25 @@ def _convert_to_password(value):
         raise ValueError(f"Insecure security token {value}. Entropy: {entropy(value)}. Required: >3")
     return value
 
+def test_parent_lookup():
+    for name in ("test_child", "test_parent"):
+        _TYPES_DICT.pop(name, None)
+    try:
+        # Children may come first, and memoize
+        parser("test_child", parent="test_parent", memo_size=16, transform=lambda value: value + "!")
+        parser("test_parent", transform=lambda value: value.upper())
+        assert parse("a", TYPES.test_child) == "A!"
+        assert parse("a", TYPES.test_child) == "A!"
+        # Registering the parent again changes its children
+        parser("test_parent", transform=lambda value: value.lower())
+        assert parse("A", TYPES.test_child) == "a!"
+        assert parse("a", TYPES.test_child) == "a!"
+    finally:
+        for name in ("test_child", "test_parent"):
+            _TYPES_DICT.pop(name, None)
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
+    test_parent_lookup()
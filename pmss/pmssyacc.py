@@ -1,11 +1,48 @@
-import ply.yacc as yacc
-from pmss.pmsslex import lexer, tokens
+'''
+Grammar for PMSS. The parser is built on first use (see
+`get_parser()`), from the precomputed tables in `pmss/parsetab.py`.
+
+If you change the grammar, regenerate the tables with:
+
+    python -m pmss.pmssyacc
+
+Until then, PLY notices the tables are stale and rebuilds them in
+memory (slowly, and without writing any files).
+'''
+
+from pmss.pmsslex import tokens
+import pmss.pmssdescent
+import pmss.pmsslex
 import pmss.pmssselectors
 import collections
+import os
+import re
+import sys
+import threading
+
+_ATTRIBUTE_KV = re.compile(r"\[(" + pmss.pmsslex.t_IDENT + ")(" + pmss.pmsslex.ATTRIBUTE_OPERATOR + r")(.*)\]", re.DOTALL)
+
+start = 'sheet'
+
+
+def p_sheet(p):
+    '''sheet : key_value_pair
+             | empty'''
+    for item in p[1]:
+        if not isinstance(item[0], pmss.pmssselectors.Selector):
+            raise pmss.pmssdescent._error(p.lexer.lexdata, item[2], f"Rule for `{item[0]}` is not inside a block")
+    p[0] = p[1]
+
+
+def p_empty(p):
+    'empty :'
+    p[0] = []
+
 
 def p_key_value_pair(p):
     'key_value_pair : IDENT COLON VALUE SEMICOLON'
-    p[0] = [[p[1], p[3]]]
+    # With where it starts, to report rules outside blocks
+    p[0] = [[p[1], p[3], p.lexpos(1)]]
 
 
 def p_key_value_pair_merge(p):
@@ -15,17 +52,15 @@ def p_key_value_pair_merge(p):
 
 
 def p_error(p):
-    print("Syntax error in input!")
-    print(p)
-    if not p:
-        print("End of File!")
-        return
-
-    while True:
-        tok = yacc.token() 
-        if not tok or tok.type == 'SEMICOLON': 
-            break
-    yacc.errok()
+    '''
+    We don't try to recover from syntax errors: as with the descent
+    parser, the sheet raises `PMSSSyntaxError`. Lines and columns are
+    in the sheet as we parse it, with comments stripped.
+    '''
+    if p is None:
+        text = pmss.pmsslex.get_lexer().lexdata
+        raise pmss.pmssdescent._error(text, len(text), "Unexpected end of file")
+    raise pmss.pmssdescent._error(p.lexer.lexdata, p.lexpos, f"Unexpected `{p.value.strip()}`")
 
 
 def p_type_selector(p):
@@ -64,10 +99,62 @@ def p_simple_attribute_selector(p):
 
 def p_attribute_kv_selector(p):
     '''selector : ATTRIBUTE_KV_SELECTOR'''
-    operator = '='
-    attribute = p[1].split("=")[0][1:]
-    value = p[1].split("=")[1][:-1]
-    p[0] = pmss.pmssselectors.AttributeSelector(attribute, operator, value)
-
-
-parser = yacc.yacc()
+    attribute, operator, value = _ATTRIBUTE_KV.fullmatch(p[1]).groups()
+    p[0] = pmss.pmssselectors.AttributeSelector(attribute, operator, pmss.pmssselectors.unquote(value))
+
+
+_parser = None
+_parser_lock = threading.Lock()
+
+
+def get_parser():
+    '''
+    The shared parser, built the first time it's needed.
+    '''
+    global _parser
+    if _parser is None:
+        with _parser_lock:
+            if _parser is None:
+                import ply.yacc as yacc
+                _parser = yacc.yacc(
+                    module=sys.modules[__name__],
+                    tabmodule='pmss.parsetab',
+                    write_tables=False,
+                    debug=False
+                )
+    return _parser
+
+
+# PLY's lexer and parser keep their state on themselves, and we share
+# one of each, so only one thread can use them at once
+_parse_lock = threading.Lock()
+
+
+def parse(text):
+    '''
+    Parse a sheet (with comments already stripped) with the shared
+    lexer and parser. Safe to call from several threads.
+    '''
+    with _parse_lock:
+        lexer = pmss.pmsslex.get_lexer()
+        # A syntax error can leave the lexer inside a value
+        lexer.begin('INITIAL')
+        return get_parser().parse(text, lexer=lexer)
+
+
+def __getattr__(name):
+    # `pmss.pmssyacc.parser` is built lazily
+    if name == 'parser':
+        return get_parser()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+if __name__ == '__main__':
+    # Regenerate pmss/parsetab.py after changing the grammar
+    import ply.yacc as yacc
+    yacc.yacc(
+        module=sys.modules[__name__],
+        tabmodule='parsetab',
+        outputdir=os.path.dirname(os.path.abspath(__file__)),
+        debug=False
+    )
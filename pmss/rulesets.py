@@ -10,15 +10,25 @@ import collections
 import enum
 import errno
 import itertools
+import json
 import os
 import sys
+import threading
+import time
 import traceback
-import yaml
 
+import pmss.cache
+import pmss.changeset
+import pmss.incremental
 import pmss.pmssselectors
 import pmss.loadfile
+import pmss.pmssdescent
+import pmss.schema
+import pmss.selectorindex
+import pmss.stats
+import pmss.trace
+import pmss.watcher
 
-from pmss.util import command_line_args
 
 RULESET_IDS = enum.Enum('RULESET_IDS', ['ENV', 'SourceConfigFile', 'SystemConfigFile', 'UserConfigFile', 'EnvironmentVariables', 'CommandLineArgs'])
 
@@ -40,24 +50,141 @@ def _convert_keys_to_str(d):
 
 
 class Ruleset():
+    # Whether `check_changes()` and queries may block on I/O. If so,
+    # `pmss.asyncsettings.AsyncSettings` runs them on a thread.
+    blocking = True
+    # How long the last load took, if it was started by `_load()`
+    load_started = None
+    load_seconds = None
+    # Whether `CombinedRuleset.check_types` converts our rules when we
+    # validate. Rulesets which don't keep their rules in memory turn
+    # this off, since it would mean reading every rule into Python.
+    check_types_up_front = True
+    # Held while (re)loading, by rulesets which can reload themselves,
+    # e.g. when their file changes (see `FileRuleset`)
+    reload_lock = None
+
     def __init__(self, rulesetid):
         self.loaded = False
         self.rulesetid = rulesetid
+        self.listeners = []
 
     def load(self):
         '''Load settings into your ruleset component.
-        Upon successful load, set `self.loaded = True`.
+        Upon successful load, set `self.loaded = True`, and call
+        `self.notify_listeners()`.
         '''
         raise NotImplementedError('This should always be called on a subclass')
 
+    def loader(self):
+        '''For loading in another process: `(function, args)`, where
+        `function(*args)` does the slow part of `load()`, and returns
+        something picklable to pass to `finish_load()`. `None` if the
+        ruleset can only load in-process.
+        '''
+        return None
+
+    def finish_load(self, loaded):
+        '''Complete a `load()` from the result of `loader()`.
+        '''
+        raise NotImplementedError('Only rulesets with a `loader()` can be finished')
+
+    def check_changes(self):
+        '''Reload, if the underlying source changed. Most rulesets
+        never change once loaded.
+        '''
+        pass
+
+    def add_listener(self, listener):
+        '''`listener(ruleset, changes)` is called whenever the ruleset
+        (re)loads. `changes` is a `pmss.changeset.ChangeSet` if the
+        ruleset knows exactly what changed, or `None` if anything may
+        have. This is how e.g. `CombinedRuleset` knows to drop cached
+        values.
+        '''
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def notify_listeners(self, changes=None):
+        # Loads end by notifying us
+        if self.load_started is not None:
+            self.load_seconds = time.perf_counter() - self.load_started
+            self.load_started = None
+        for listener in list(self.listeners):
+            listener(self, changes)
+
     def query(self, *args, **kwargs):
         '''This method should return list of matching selectors
-        where each item in the list is `(selector, value)` pair.
+        where each item in the list is `(selector, value)` pair, in
+        the order the rules were declared (so, by default, the later of
+        two equally specific matches wins; see `best_match`).
         Additionally these methods should check that the data
         is loaded with `self.loaded` before trying to query data.
         '''
         raise NotImplementedError('This should always be called on a subclass')
 
+    def best_match(self, key, context):
+        '''Return the winning `(selector, value)` pair for `key`, or
+        `None`. Subclasses which keep their selectors in order of
+        precedence should override this to stop at the first match.
+        '''
+        return _most_specific(self.query(key, context))
+
+    def candidates(self, key):
+        '''Return every `(selector, value)` pair for `key`, in order of
+        precedence (so the first one to match a context wins), or
+        `None` if this ruleset can't enumerate its selectors. This lets
+        callers evaluate selectors themselves, e.g. over many contexts
+        at once.
+        '''
+        return None
+
+    def selector_index(self, key):
+        '''Return a `SelectorIndex` over `candidates(key)`, or `None` if
+        this ruleset can't enumerate its selectors. Rulesets which keep
+        an index should return it, rather than building a new one.
+        '''
+        candidates = self.candidates(key)
+        if candidates is None:
+            return None
+        return pmss.selectorindex.SelectorIndex.from_entries(candidates)
+
+    def best_matches(self, keys, context):
+        '''Return `{key: (selector, value)}` for each of `keys` with a
+        match. Subclasses can override this to share work between keys.
+        '''
+        matches = {}
+        for key in keys:
+            match = self.best_match(key, context)
+            if match:
+                matches[key] = match
+        return matches
+
+    def _best_match(self, key, context):
+        '''`best_match()`, for callers which just called
+        `check_changes()`. Rulesets which check for changes on every
+        lookup override this, and `_best_matches()`, to skip it.
+        '''
+        return self.best_match(key, context)
+
+    def _best_matches(self, keys, context):
+        return self.best_matches(keys, context)
+
+    def _traced_match(self, key, context, checked):
+        '''`(match, selector_index)`, for `pmss.trace`: `best_match()`
+        (or `_best_match()`, if we `checked` for changes just before),
+        and the `SelectorIndex` it was answered from, to list the
+        candidates. The index is `None` where listing them would mean
+        more I/O, or a reload mid-trace: rulesets which may block only
+        give their match.
+        '''
+        match = self._best_match(key, context) if checked else self.best_match(key, context)
+        if self.blocking:
+            return match, None
+        return match, self.selector_index(key)
+
     def keys(self):
         '''This method should return a list of all
         available keys in the ruleset.
@@ -67,6 +194,12 @@ class Ruleset():
     def id(self):
         return type(self).__name__
 
+    def approximate_memory(self):
+        '''Roughly how many bytes our rules take up, or `None` if we
+        can't tell (e.g. they're not in memory).
+        '''
+        return None
+
     def debug_dump(self):
         '''
         This should never be called directly.
@@ -74,46 +207,233 @@ class Ruleset():
         return f"[borked / {self.id()}]"
 
 
-class FileRuleset(Ruleset):
+def _most_specific(matches):
+    '''
+    The winner of a list of `[selector, value]` matches, in source
+    order: the most specific and, of equal specificity, the later
+    (as with `pmss.selectorindex.precedence_order`).
+    '''
+    best = None
+    for match in matches or ():
+        if best is None or pmss.pmssselectors.css_selector_key(match[0]) <= pmss.pmssselectors.css_selector_key(best[0]):
+            best = match
+    return best
+
+
+def _load(ruleset):
+    '''
+    `ruleset.load()`, timed (see `Ruleset.load_seconds`). For rulesets
+    with a `reload_lock`, this holds it, so a load can't publish an
+    older snapshot over a reload which finished first.
+    '''
+    if ruleset.reload_lock is None:
+        _timed_load(ruleset)
+    else:
+        with ruleset.reload_lock:
+            _timed_load(ruleset)
+
+
+def _timed_load(ruleset):
+    ruleset.load_started = time.perf_counter()
+    ruleset.load()
+
+
+def _indexed_best_matches(index, keys, context):
+    '''
+    `best_matches` for rulesets with a `{key: SelectorIndex}` index,
+    sharing selector match results between keys.
+    '''
+    matched = {}
+    matches = {}
+    for key in keys:
+        selector_index = index.get(key)
+        if selector_index is None:
+            continue
+        match = selector_index.best_match(context, matched)
+        if match:
+            matches[key] = match
+    return matches
+
+
+# The rules of an `IndexedRuleset`, as published by one load
+Snapshot = collections.namedtuple('Snapshot', ['results', 'index', 'timestamp'])
+
+EMPTY_SNAPSHOT = Snapshot({}, {}, None)
+
+
+class IndexedRuleset(Ruleset):
+    '''
+    A ruleset held in memory, as a `Snapshot` of its `results`
+    (`{key: {selector: value}}`), a `{key: SelectorIndex}` index over
+    them, and the `timestamp` of their source, if any.
+
+    Snapshots are never modified once published. A load builds a new
+    one, and `publish()` swaps it in with a single assignment, so
+    reads take no locks: each takes `self.snapshot` once, and sees
+    either the old rules or the new ones, never a mix, however many
+    threads are reading while we reload.
+    '''
+    def __init__(self, rulesetid):
+        super().__init__(rulesetid=rulesetid)
+        self.snapshot = EMPTY_SNAPSHOT
+
+    @property
+    def results(self):
+        return self.snapshot.results
+
+    @property
+    def index(self):
+        return self.snapshot.index
+
+    @property
+    def timestamp(self):
+        return self.snapshot.timestamp
+
+    def publish(self, results, index=None, timestamp=None, changes=None):
+        '''
+        Make `results` (and their `index`, built if not given) the
+        current rules, and tell our listeners.
+        '''
+        if index is None:
+            index = pmss.selectorindex.index_results(results)
+        self.snapshot = Snapshot(results, index, timestamp)
+        self.loaded = True
+        self.notify_listeners(changes)
+
+    def _loaded_snapshot(self):
+        self.check_changes()
+        return self._current_snapshot()
+
+    def _current_snapshot(self):
+        if not self.loaded:
+            raise RuntimeError(f'Please `load()` data from ruleset `{self.rulesetid} before trying to `query()`.')
+        return self.snapshot
+
+    def query(self, key, context):
+        # In order of precedence, rather than declaration, since we
+        # override `best_match`
+        selector_index = self._loaded_snapshot().index.get(key)
+        # Item not in ruleset
+        if selector_index is None:
+            return []
+        return selector_index.query(context)
+
+    def best_match(self, key, context):
+        self.check_changes()
+        return self._best_match(key, context)
+
+    def best_matches(self, keys, context):
+        self.check_changes()
+        return self._best_matches(keys, context)
+
+    def _best_match(self, key, context):
+        selector_index = self._current_snapshot().index.get(key)
+        if selector_index is None:
+            return None
+        return selector_index.best_match(context)
+
+    def _best_matches(self, keys, context):
+        return _indexed_best_matches(self._current_snapshot().index, keys, context)
+
+    def _traced_match(self, key, context, checked):
+        # One snapshot for both, so the candidates are those the match
+        # came from, even if we reload meanwhile
+        snapshot = self._current_snapshot() if checked else self._loaded_snapshot()
+        selector_index = snapshot.index.get(key, pmss.selectorindex.EMPTY)
+        return selector_index.best_match(context), selector_index
+
+    def candidates(self, key):
+        return self.selector_index(key).entries
+
+    def selector_index(self, key):
+        return self._loaded_snapshot().index.get(key, pmss.selectorindex.EMPTY)
+
+    def keys(self):
+        self.check_changes()
+        return self.snapshot.results.keys()
+
+    def approximate_memory(self):
+        return pmss.stats.approximate_size(self.snapshot)
+
+
+class FileRuleset(IndexedRuleset):
+    '''
+    `watch` controls reloading when the file changes:
+
+    * `False`: never.
+    * `True`: in the background, from the shared `pmss.watcher`
+      thread. Reads never touch the filesystem.
+    * A `pmss.watcher.Watcher`: the same, but with that watcher.
+    * `'stat'`: check the modification time on every read.
+
+    Reloads publish a new snapshot (see `IndexedRuleset`), so a reader
+    on another thread sees either the old file or the new one. With
+    `'stat'`, the first reader to notice a change reloads; readers
+    arriving meanwhile carry on with the old snapshot, rather than
+    waiting.
+    '''
     def __init__(self, filename, rulesetid=None, watch=False):
         super().__init__(rulesetid=rulesetid)
         self.filename = filename
-        self.timestamp = None
-        self.results = {}
         self.watch = watch
+        self.watcher = None
+        self.reload_lock = threading.Lock()
         if not os.path.isfile(filename):
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), pathname)
+        if watch is True:
+            self.watcher = pmss.watcher.default_watcher()
+        elif isinstance(watch, pmss.watcher.Watcher):
+            self.watcher = watch
+        if self.watcher is not None:
+            self.watcher.watch(filename, self.file_changed)
+
+    @property
+    def blocking(self):
+        # Only `'stat'` touches the filesystem on reads
+        return self.watch == 'stat'
 
     def check_changes(self):
-        if not self.watch:
+        if self.watch != 'stat':
             return
-        if self.timestamp != os.stat(self.filename).st_mtime:
-            try:
-                self.load()
-            except:
-                print("Could not reload PMSS file.")
-                print("This probably means there was a syntax error in the file.")
-                print("Continuing with the old file")
-                print("Error:")
-                print(traceback.format_exc())
+        if self.timestamp == os.stat(self.filename).st_mtime:
+            return
+        if not self.reload_lock.acquire(blocking=False):
+            return
+        try:
+            # Another thread may have reloaded since we looked
+            if self.timestamp != os.stat(self.filename).st_mtime:
+                self._reload()
+        finally:
+            self.reload_lock.release()
 
-    def query(self, key, context):
-        self.check_changes()
-        if not self.loaded:
-            raise RuntimeError(f'Please `load()` data from ruleset `{self.rulesetid} before trying to `query()`.')
-        selector_dict = self.results.get(key)
-        # Item not in PMSS file
-        if selector_dict is None:
-            return []
-        return_list = []
-        for selector, value in selector_dict.items():
-            if selector.match(**context):
-                return_list.append([selector, value])
-        return return_list
+    def file_changed(self, path):
+        '''
+        Called from the watcher thread when our file may have changed.
+        '''
+        if self.loaded:
+            self.reload()
 
-    def keys(self):
-        self.check_changes()
-        return self.results.keys()
+    def reload(self):
+        with self.reload_lock:
+            self._reload()
+
+    def _reload(self):
+        try:
+            _timed_load(self)
+        except:
+            print("Could not reload PMSS file.")
+            print("This probably means there was a syntax error in the file.")
+            print("Continuing with the old file")
+            print("Error:")
+            print(traceback.format_exc())
+
+    def close(self):
+        '''
+        Stop watching the file.
+        '''
+        if self.watcher is not None:
+            self.watcher.unwatch(self.filename, self.file_changed)
+            self.watcher = None
 
     def id(self):
         if self.rulesetid:
@@ -125,10 +445,72 @@ class FileRuleset(Ruleset):
         return self.results
 
 class PMSSFileRuleset(FileRuleset):
+    '''
+    `cache_dir` is an optional directory for caching parsed files
+    between processes (see `pmss.compiledcache`). `backend` selects
+    the parser (see `pmss.loadfile.load_pmss_string`).
+
+    With `incremental=True`, reloads only re-parse the top-level blocks
+    which changed (see `pmss.incremental`), and tell listeners exactly
+    which rules changed. This always uses the `descent` parser, and
+    ignores `backend` and `cache_dir`.
+    '''
+    def __init__(self, filename, rulesetid=None, watch=False, cache_dir=None, backend='ply', incremental=False):
+        self.cache_dir = cache_dir
+        self.backend = backend
+        self.sheet = None
+        super().__init__(filename, rulesetid=rulesetid, watch=watch)
+        if incremental:
+            self.sheet = pmss.incremental.IncrementalSheet(self.id())
+
     def load(self):
-        self.timestamp = os.stat(self.filename).st_mtime
-        self.results = pmss.loadfile.load_pmss_file(self.filename, provenance=self.id())
-        self.loaded = True
+        if self.sheet is not None:
+            return self._load_incremental()
+        self.finish_load(_read_pmss_file(self.filename, self.id(), self.cache_dir, self.backend))
+
+    def loader(self):
+        if self.sheet is not None:
+            return None
+        return _read_pmss_file, (self.filename, self.id(), self.cache_dir, self.backend)
+
+    def finish_load(self, loaded):
+        timestamp, results = loaded
+        self.publish(results, timestamp=timestamp)
+
+    def _load_incremental(self):
+        timestamp = os.stat(self.filename).st_mtime
+        with open(self.filename, 'r') as f:
+            text = f.read()
+        changes = self.sheet.update(text)
+        results = self.sheet.results
+        index = dict(self.index)
+        for key in changes.keys():
+            if key in results:
+                index[key] = pmss.selectorindex.SelectorIndex(results[key])
+            else:
+                index.pop(key, None)
+        self.publish(results, index, timestamp, changes if self.loaded else None)
+
+
+def _read_pmss_file(filename, provenance, cache_dir, backend):
+    '''
+    The slow part of `PMSSFileRuleset.load()`, which can run in
+    another process: `(timestamp, results)`.
+    '''
+    timestamp = os.stat(filename).st_mtime
+    return timestamp, pmss.loadfile.load_pmss_file(filename, provenance=provenance, cache_dir=cache_dir, backend=backend)
+
+
+def _read_yaml_file(filename):
+    '''
+    The slow part of `YAMLFileRuleset.load()`: `(timestamp, data)`.
+    '''
+    # Imported here, so programs which don't use YAML don't pay for it
+    import yaml
+
+    timestamp = os.stat(filename).st_mtime
+    with open(filename, 'r') as f:
+        return timestamp, yaml.safe_load(f)
 
 
 class YAMLFileRuleset(FileRuleset):
@@ -137,26 +519,29 @@ class YAMLFileRuleset(FileRuleset):
     Observer. Not clear if this belongs here or in Learning
     Observer. It depends on whether we can make this generic.
     '''
-    def recurse(self, keys, key, value):
+    def recurse(self, keys, key, value, results):
         '''
         '''
         if isinstance(value, dict):
             for k in value:
-                self.recurse(keys+[key] if key else keys, k, value[k])
+                self.recurse(keys+[key] if key else keys, k, value[k], results)
         else:
             selectors = [pmss.pmssselectors.TypeSelector(k, provenance=self.id()) for k in keys]
             selector = pmss.pmssselectors.CompoundSelector(selectors, provenance=self.id())
-            self.results[key][selector] = value
+            results[key][selector] = value
 
     def load(self):
-        self.timestamp = os.stat(self.filename).st_mtime
-        with open(self.filename, 'r') as f:
-            settings = yaml.safe_load(f)
+        self.finish_load(_read_yaml_file(self.filename))
 
-        self.results = collections.defaultdict(dict)
-        self.recurse([], None, settings)
-        self.results = dict(self.results)
-        self.loaded = True
+    def loader(self):
+        return _read_yaml_file, (self.filename,)
+
+    def finish_load(self, loaded):
+        timestamp, settings = loaded
+        results = collections.defaultdict(dict)
+        self.recurse([], None, settings, results)
+        results = dict(results)
+        self.publish(results, timestamp=timestamp)
 
 
 class SimpleEnvsRuleset(Ruleset):
@@ -174,6 +559,8 @@ class SimpleEnvsRuleset(Ruleset):
     * Handle case sensitivity cleanly
     * Handle default
     '''
+    blocking = False
+
     def __init__(
             self,
             rulesetid=RULESET_IDS.EnvironmentVariables,
@@ -186,17 +573,19 @@ class SimpleEnvsRuleset(Ruleset):
         self.env = env
 
     def load(self):
+        schema = pmss.schema.default_schema
         if self.default_keys:
-            possible_keys = [k.upper() for k in set([field["name"] for field in pmss.schema.fields])]
+            possible_keys = set(name.upper() for name in schema.fields_by_name)
 
             for key in self.env:
                 if key in possible_keys:
                     self.extracted[key] = self.env[key]
-        mapped_keys = dict([(f['env'], f['name']) for f in pmss.schema.fields if f['env']])
         for key in self.env:
-            if key in mapped_keys:
-                self.extracted[mapped_keys[key].upper()] = self.env[key]
+            field = schema.fields_by_env.get(key)
+            if field is not None:
+                self.extracted[field['name'].upper()] = self.env[key]
         self.loaded = True
+        self.notify_listeners()
 
     def query(self, key, context):
         if not self.loaded:
@@ -206,12 +595,18 @@ class SimpleEnvsRuleset(Ruleset):
 
         return False
 
+    def candidates(self, key):
+        return self.query(key, {}) or []
+
     def keys(self):
         return self.extracted.keys()
 
     def id(self):
         return "SimpleEnvsRuleset"
 
+    def approximate_memory(self):
+        return pmss.stats.approximate_size(self.extracted)
+
     def debug_dump(self):
         return _convert_keys_to_str(self.extracted)
 
@@ -240,14 +635,15 @@ def _group_arguments(args):
 
 # We roughly follow:
 #   https://docs.python.org/3/library/argparse.html#argparse.ArgumentParser
-class ArgsRuleset(Ruleset):
+class ArgsRuleset(IndexedRuleset):
     # --foo=bar
     # --selector:foo=bar
     # --dev (enable class dev, if registered as one of the classes which can be enabled / disabled via commandline)
+    blocking = False
+
     def __init__(self, rulesetid=RULESET_IDS.CommandLineArgs, argv=sys.argv):
         super().__init__(rulesetid=rulesetid)
         self.argv = argv
-        self.results = {}
 
     def load(self):
         '''Manually parse command line arguments.
@@ -268,75 +664,606 @@ class ArgsRuleset(Ruleset):
         grouped_args = _group_arguments(args)
 
         # parse grouped args into results
+        results = {}
         for k, garg in grouped_args:
             garg = list(garg)
-            print(k, garg)
             flag_split = garg[0].split('=')
             flag = flag_split[0]
             # TODO check if ':' in flag to parse selector
             selector = pmss.pmssselectors.UniversalSelector(provenance=self.id())
-            name = None
-            value = None
-            for field in pmss.schema.fields:
-                if flag in command_line_args(field):
-                    name = field['name']
-                    if len(flag_split) > 1:
-                        value = flag_split[1]
-                        break
-                    if field['type'] == pmss.pmsstypes.TYPES.boolean:
-                        value = True
-                        break
-                    value = garg[1:] if len(garg) > 2 else garg[1:][0]
-                    # check if field is required or set default
-                    if value is None and field['required']:
-                        raise RuntimeError(f'Field `{name}` required, but no value provided.')
-                    elif value is None:
-                        value = field['default']
-
-                    break
-            if name is None:
+            field = pmss.schema.default_schema.fields_by_flag.get(flag)
+            if field is None:
                 raise RuntimeError(f'Could not locate field with flag `{flag}`.')
-            if name not in self.results:
-                self.results[name] = {}
-            self.results[name][selector] = value
+            name = field['name']
+            if len(flag_split) > 1:
+                value = flag_split[1]
+            elif field['type'] == pmss.pmsstypes.TYPES.boolean:
+                value = True
+            else:
+                value = garg[1:] if len(garg) > 2 else garg[1:][0]
+                # check if field is required or set default
+                if value is None and field['required']:
+                    raise RuntimeError(f'Field `{name}` required, but no value provided.')
+                elif value is None:
+                    value = field['default']
+            if name not in results:
+                results[name] = {}
+            results[name][selector] = value
+        self.publish(results)
+
+    def debug_dump(self):
+        return _convert_keys_to_str(self.results)
+
+
+_SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pmss_keys (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS pmss_selectors (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    spec TEXT NOT NULL UNIQUE,    -- JSON, to rebuild the selector
+    text TEXT NOT NULL,           -- As written in PMSS
+    specificity INTEGER NOT NULL,
+    checked INTEGER NOT NULL,     -- Has parts SQL can't match, so check in Python too
+    -- The rarest component, which we find the selector by
+    bucket_kind TEXT NOT NULL,
+    bucket_name TEXT NOT NULL,
+    bucket_value TEXT
+);
+CREATE INDEX IF NOT EXISTS pmss_selectors_bucket ON pmss_selectors(bucket_kind, bucket_name, bucket_value);
+CREATE TABLE IF NOT EXISTS pmss_components (
+    selector_id INTEGER NOT NULL REFERENCES pmss_selectors(id),
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS pmss_components_selector ON pmss_components(selector_id);
+CREATE INDEX IF NOT EXISTS pmss_components_frequency ON pmss_components(kind, name, value);
+CREATE TABLE IF NOT EXISTS pmss_rules (
+    key_id INTEGER NOT NULL REFERENCES pmss_keys(id),
+    selector_id INTEGER NOT NULL REFERENCES pmss_selectors(id),
+    value TEXT NOT NULL,
+    PRIMARY KEY (selector_id, key_id)
+);
+CREATE INDEX IF NOT EXISTS pmss_rules_key ON pmss_rules(key_id);
+CREATE TABLE IF NOT EXISTS pmss_version (version INTEGER NOT NULL);
+INSERT INTO pmss_version SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM pmss_version);
+CREATE TRIGGER IF NOT EXISTS pmss_rules_inserted AFTER INSERT ON pmss_rules
+    BEGIN UPDATE pmss_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS pmss_rules_updated AFTER UPDATE ON pmss_rules
+    BEGIN UPDATE pmss_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS pmss_rules_deleted AFTER DELETE ON pmss_rules
+    BEGIN UPDATE pmss_version SET version = version + 1; END;
+'''
+
+# As in `pmss.selectorindex`, we find candidate selectors by their
+# rarest component (their bucket), then check the context supplies all
+# their other components. The context and keys are passed as JSON, so
+# the text of the query never changes, and SQLite keeps it prepared.
+# Both queries need SQLite's JSON functions (`json_each`), which are
+# built in from SQLite 3.38, and in most builds before that.
+# `MATERIALIZED` (see `_sqlite_match_query`) needs SQLite 3.35.
+_SQLITE_MATCH = '''
+WITH context(kind, name, value) AS {materialized}(
+    SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]'), json_extract(value, '$[2]')
+    FROM json_each(:context)
+)
+SELECT k.name, s.id, s.spec, s.checked, r.value
+FROM context
+JOIN pmss_selectors s
+    ON s.bucket_kind = context.kind AND s.bucket_name = context.name AND s.bucket_value IS context.value
+JOIN pmss_rules r ON r.selector_id = s.id
+JOIN pmss_keys k ON k.id = r.key_id
+WHERE k.name IN (SELECT value FROM json_each(:keys))
+AND NOT EXISTS (
+    SELECT 1 FROM pmss_components c
+    WHERE c.selector_id = s.id AND NOT EXISTS (
+        SELECT 1 FROM context AS supplied
+        WHERE supplied.kind = c.kind AND supplied.name = c.name AND supplied.value IS c.value
+    )
+)
+ORDER BY s.specificity DESC, r.rowid DESC
+'''
+
+_SQLITE_CANDIDATES = '''
+SELECT k.name, s.id, s.spec, s.checked, r.value
+FROM pmss_rules r
+JOIN pmss_keys k ON k.id = r.key_id
+JOIN pmss_selectors s ON s.id = r.selector_id
+WHERE k.name IN (SELECT value FROM json_each(:keys))
+ORDER BY s.specificity DESC, r.rowid DESC
+'''
+
+
+_sqlite_match = None
+
+
+def _sqlite_match_query():
+    '''
+    `_SQLITE_MATCH` for the SQLite we're linked against. Where we can,
+    we ask for the context to be materialized, so it's decoded once,
+    rather than for every candidate. Older SQLite doesn't know the
+    keyword, and plans the query as it sees fit.
+    '''
+    global _sqlite_match
+    if _sqlite_match is None:
+        import sqlite3
+        materialized = 'MATERIALIZED ' if sqlite3.sqlite_version_info >= (3, 35, 0) else ''
+        _sqlite_match = _SQLITE_MATCH.format(materialized=materialized)
+    return _sqlite_match
+
+
+def _selector_spec(selector):
+    '''
+    A JSON-able description of a selector: `[class name, *arguments]`
+    for a simple selector, or a list of those for a compound one.
+    '''
+    if type(selector) is pmss.pmssselectors.CompoundSelector:
+        return [_selector_spec(child) for child in selector.selectors]
+    return [type(selector).__name__, *selector._args()]
+
+
+def _selector_from_spec(spec, provenance):
+    if not spec or isinstance(spec[0], list):
+        return pmss.pmssselectors.CompoundSelector(
+            [_selector_from_spec(child, provenance) for child in spec], provenance=provenance
+        )
+    return getattr(pmss.pmssselectors, spec[0])(*spec[1:], provenance=provenance)
+
+
+# Kinds of components whose name is `(attribute, value)`
+_VALUE_KINDS = frozenset(['attribute_value', 'attribute_dash', 'attribute_word', 'attribute_prefix', 'attribute_suffix'])
+
+# Contexts list every prefix and suffix of their attribute values, so
+# this bounds them to around a hundred kilobytes of JSON
+_MAX_ATTRIBUTE_LENGTH = 256
+
+
+def _selector_components(selector):
+    '''
+    `(components, checked)`: the `(kind, name, value)` rows a context
+    must supply for `selector` to match, and whether it also has parts
+    (e.g. pseudo-classes) which we can only check in Python. Selectors
+    which constrain nothing get a `*` component, which every context
+    supplies.
+    '''
+    components = []
+    checked = False
+    for simple in pmss.selectorindex.simple_selectors(selector):
+        if isinstance(simple, pmss.pmssselectors.UniversalSelector):
+            continue
+        key = pmss.selectorindex.component_key(simple)
+        if key is None:
+            checked = True
+        elif key[0] == 'attribute_substring':
+            # Contexts can't list all their substrings, so we only
+            # require the attribute, and check the rest in Python
+            components.append(('attribute', key[1][0], None))
+            checked = True
+        elif key[0] in _VALUE_KINDS:
+            components.append((key[0], key[1][0], key[1][1]))
+        else:
+            components.append((key[0], key[1], None))
+    if not components:
+        components.append(('*', '', None))
+    return components, checked
+
+
+def _attribute_components(name, value):
+    '''
+    The components an attribute's (string) value supplies: itself,
+    and what the other operators (besides `*=`) could match in it.
+    '''
+    components = [('attribute_value', name, value), ('attribute_dash', name, value)]
+    components.extend(('attribute_dash', name, value[:end]) for end in range(len(value)) if value[end] == '-')
+    components.extend(('attribute_word', name, word) for word in value.split())
+    components.extend(('attribute_prefix', name, value[:end]) for end in range(1, len(value) + 1))
+    components.extend(('attribute_suffix', name, value[start:]) for start in range(len(value)))
+    return components
+
+
+def _context_components(id=None, types=[], classes=[], attributes={}):
+    '''
+    The components a context supplies, or `None` for contexts we can't
+    express in SQL (e.g. `classes` given as a string, or attribute
+    values too long to list every prefix and suffix of), which we
+    match in Python instead. Selector names and values are always
+    strings, so anything else in the context can't match them.
+    '''
+    if isinstance(types, str) or isinstance(classes, str) or not isinstance(attributes, dict):
+        return None
+    components = {('*', '', None)}
+    if isinstance(id, str):
+        components.add(('id', id, None))
+    components.update(('type', name, None) for name in types if isinstance(name, str))
+    components.update(('class', name, None) for name in classes if isinstance(name, str))
+    for name, value in attributes.items():
+        if isinstance(name, str):
+            components.add(('attribute', name, None))
+            if isinstance(value, str):
+                if len(value) > _MAX_ATTRIBUTE_LENGTH:
+                    return None
+                components.update(_attribute_components(name, value))
+    return list(components)
+
+
+class SQLiteRuleset(Ruleset):
+    '''
+    Rules stored in an SQLite database, e.g. per-school overrides
+    edited by administrators. The schema (see `_SQLITE_SCHEMA`) is
+    created on `load()` if needed.
+
+    Rules aren't loaded into Python. Keys, selectors, and the
+    components of each selector are stored normalized, and indexed,
+    so matching a context is one query. Only the rules which match
+    come back. This scales to hundreds of thousands of rules.
+
+    Each thread gets its own connection. Rules can be changed with
+    `set_rule()`, `delete_rule()`, and `add_rules()`, or by any other
+    process writing to the same tables. `check_changes()` uses
+    `PRAGMA data_version` to notice changes from other connections
+    cheaply, and tells listeners, so cached values are dropped. For
+    many readers alongside a writer, put the database in WAL mode.
+    '''
+    # Values are typed as they're queried; checking them all when we
+    # validate would read every rule out of the database
+    check_types_up_front = False
+
+    def __init__(self, database, rulesetid=None):
+        super().__init__(rulesetid=rulesetid)
+        self.database = database
+        self.local = threading.local()
+        self.version = None
+        self.selectors = {}     # Selector id to selector, so we only rebuild each once
+
+    def id(self):
+        if self.rulesetid:
+            return self.rulesetid
+        return f"{super().id()}:{self.database}"
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            import sqlite3
+            connection = sqlite3.connect(self.database, uri=self.database.startswith('file:'))
+            self.local.connection = connection
+            self.local.data_version = None
+        return connection
+
+    def _version(self, connection):
+        return connection.execute('SELECT version FROM pmss_version').fetchone()[0]
+
+    def load(self):
+        import sqlite3
+
+        connection = self._connection()
+        try:
+            connection.execute("SELECT value FROM json_each('[]')").fetchall()
+        except sqlite3.OperationalError as e:
+            raise RuntimeError(
+                f"SQLiteRuleset needs SQLite's JSON functions, which SQLite {sqlite3.sqlite_version} was built without"
+            ) from e
+        with connection:
+            connection.executescript(_SQLITE_SCHEMA)
+        self.local.data_version = connection.execute('PRAGMA data_version').fetchone()[0]
+        self.version = self._version(connection)
+        self.selectors = {}
         self.loaded = True
+        self.notify_listeners()
 
-    def query(self, key, context):
-        '''The internal `results` have the same structure as PMSSRuleset,
-        so the `self.query` is identical.
+    def check_changes(self):
+        if not self.loaded:
+            return
+        connection = self._connection()
+        data_version = connection.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self.local.data_version:
+            return
+        # Some other connection committed. `data_version` is only
+        # comparable within one connection, so check the shared
+        # version, which our triggers bump, to see if we already know.
+        self.local.data_version = data_version
+        version = self._version(connection)
+        if version != self.version:
+            self.version = version
+            self.selectors = {}
+            self.notify_listeners()
+
+    def close(self):
+        '''
+        Close this thread's connection.
+        '''
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def _selector(self, selector_id, spec):
+        selector = self.selectors.get(selector_id)
+        if selector is None:
+            if len(self.selectors) >= 65536:
+                self.selectors = {}
+            selector = self.selectors[selector_id] = _selector_from_spec(json.loads(spec), self.id())
+        return selector
+
+    def _matches(self, keys, context):
         '''
+        `{key: [[selector, value], ...]}` of the rules for `keys`
+        matching `context`, best match first.
+        '''
+        if not self.loaded:
+            raise RuntimeError(f'Please `load()` data from ruleset `{self.rulesetid} before trying to `query()`.')
+        components = _context_components(**context)
+        parameters = {'keys': json.dumps(list(keys))}
+        if components is None:
+            cursor = self._connection().execute(_SQLITE_CANDIDATES, parameters)
+        else:
+            parameters['context'] = json.dumps(components)
+            cursor = self._connection().execute(_sqlite_match_query(), parameters)
+        matches = {}
+        for key, selector_id, spec, checked, value in cursor:
+            selector = self._selector(selector_id, spec)
+            if (checked or components is None) and not selector.match(**context):
+                continue
+            matches.setdefault(key, []).append([selector, value])
+        return matches
+
+    def query(self, key, context):
+        return self._matches([key], context).get(key, [])
+
+    def best_match(self, key, context):
+        matches = self._matches([key], context).get(key)
+        return matches[0] if matches else None
+
+    def best_matches(self, keys, context):
+        return {key: matches[0] for key, matches in self._matches(keys, context).items()}
+
+    def candidates(self, key):
         if not self.loaded:
             raise RuntimeError(f'Please `load()` data from ruleset `{self.rulesetid} before trying to `query()`.')
-        selector_dict = self.results.get(key, {})
-        return_list = []
-        for selector, value in selector_dict.items():
-            if selector.match(**context):
-                return_list.append([selector, value])
-        return return_list
+        cursor = self._connection().execute(_SQLITE_CANDIDATES, {'keys': json.dumps([key])})
+        return [(self._selector(selector_id, spec), value) for name, selector_id, spec, checked, value in cursor]
 
     def keys(self):
-        return self.results.keys()
+        return [name for (name,) in self._connection().execute(
+            'SELECT name FROM pmss_keys k WHERE EXISTS (SELECT 1 FROM pmss_rules r WHERE r.key_id = k.id)'
+        )]
+
+    def _selector_id(self, connection, selector, known, frequency):
+        spec = json.dumps(_selector_spec(selector))
+        selector_id = known.get(spec)
+        if selector_id is not None:
+            return selector_id
+        row = connection.execute('SELECT id FROM pmss_selectors WHERE spec = ?', (spec,)).fetchone()
+        if row is None:
+            components, checked = _selector_components(selector)
+            bucket = min(components, key=lambda component: (
+                frequency(component), pmss.selectorindex._KIND_PRIORITY.get(component[0], len(pmss.selectorindex._KIND_PRIORITY))
+            ))
+            selector_id = connection.execute(
+                '''INSERT INTO pmss_selectors (spec, text, specificity, checked, bucket_kind, bucket_name, bucket_value)
+                VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                (spec, str(selector), selector.css_specificity(), checked, *bucket)
+            ).lastrowid
+            connection.executemany(
+                'INSERT INTO pmss_components (selector_id, kind, name, value) VALUES (?, ?, ?, ?)',
+                [(selector_id, kind, name, value) for kind, name, value in components]
+            )
+        else:
+            selector_id = row[0]
+        known[spec] = selector_id
+        return selector_id
+
+    def _key_id(self, connection, key, known):
+        key_id = known.get(key)
+        if key_id is None:
+            connection.execute('INSERT OR IGNORE INTO pmss_keys (name) VALUES (?)', (key,))
+            key_id = known[key] = connection.execute('SELECT id FROM pmss_keys WHERE name = ?', (key,)).fetchone()[0]
+        return key_id
+
+    def add_rules(self, results):
+        '''
+        Add `{key: {selector: value}}` rules (e.g. from
+        `pmss.loadfile.load_pmss_string`) in one transaction. As in a
+        sheet, a rule for an existing selector replaces it, and moves
+        it after the others.
+        '''
+        connection = self._connection()
+        selector_ids = {}
+        key_ids = {}
+        added = []
+        changed = []
+
+        # How common each component is, to pick buckets. We count the
+        # new selectors, plus those already stored.
+        batch = collections.Counter(
+            component
+            for selector in set(itertools.chain.from_iterable(results.values()))
+            for component in set(_selector_components(selector)[0])
+        )
+        stored = {}
+
+        def frequency(component):
+            if component not in stored:
+                stored[component] = connection.execute(
+                    'SELECT count(*) FROM pmss_components WHERE kind = ? AND name = ? AND value IS ?', component
+                ).fetchone()[0]
+            return stored[component] + batch[component]
+
+        with connection:
+            for key, selector_dict in results.items():
+                key_id = self._key_id(connection, key, key_ids)
+                for selector, value in selector_dict.items():
+                    selector_id = self._selector_id(connection, selector, selector_ids, frequency)
+                    existing = connection.execute(
+                        'SELECT value FROM pmss_rules WHERE selector_id = ? AND key_id = ?', (selector_id, key_id)
+                    ).fetchone()
+                    connection.execute(
+                        'INSERT OR REPLACE INTO pmss_rules (key_id, selector_id, value) VALUES (?, ?, ?)',
+                        (key_id, selector_id, value)
+                    )
+                    if existing is None:
+                        added.append((key, selector))
+                    else:
+                        changed.append((key, selector))
+            self.version = self._version(connection)
+        # Replacing a rule moves it, so it may now win ties
+        reordered = set(key for key, selector in changed)
+        self.notify_listeners(pmss.changeset.ChangeSet(added=added, changed=changed, reordered=reordered))
+
+    def set_rule(self, key, selector, value):
+        '''
+        Set the value of `key` for `selector` (a `Selector`, or PMSS
+        selector text such as `'[school=middlesex] .dev'`).
+        '''
+        if isinstance(selector, str):
+            selector = _parse_selector(selector)
+        self.add_rules({key: {selector: value}})
+
+    def delete_rule(self, key, selector):
+        '''
+        Remove the rule for `key` and `selector`, if there is one.
+        '''
+        if isinstance(selector, str):
+            selector = _parse_selector(selector)
+        connection = self._connection()
+        spec = json.dumps(_selector_spec(selector))
+        with connection:
+            deleted = connection.execute(
+                '''DELETE FROM pmss_rules
+                WHERE key_id = (SELECT id FROM pmss_keys WHERE name = ?)
+                AND selector_id = (SELECT id FROM pmss_selectors WHERE spec = ?)''',
+                (key, spec)
+            ).rowcount
+            self.version = self._version(connection)
+        if deleted:
+            self.notify_listeners(pmss.changeset.ChangeSet(removed=[(key, selector)]))
 
     def debug_dump(self):
-        return _convert_keys_to_str(self.results)
+        dump = {}
+        cursor = self._connection().execute('''
+            SELECT k.name, s.id, s.spec, r.value
+            FROM pmss_rules r
+            JOIN pmss_keys k ON k.id = r.key_id
+            JOIN pmss_selectors s ON s.id = r.selector_id
+            ORDER BY k.name, s.specificity DESC, r.rowid DESC
+        ''')
+        for key, selector_id, spec, value in cursor:
+            dump.setdefault(key, {})[str(self._selector(selector_id, spec))] = value
+        return dump
+
+
+def _parse_selector(text):
+    rules = list(pmss.pmssdescent.parse(f"{text} {{ selector: _; }}"))
+    if len(rules) != 1:
+        raise ValueError(f"Not a selector: {text}")
+    return rules[0][0]
 
 
-class SQLiteRuleset(Ruleset):
-    pass
+id_counter = 0
 
 
-id_counter = 0
+class ParseErrors(ValueError):
+    '''
+    Several keys failed to parse in one `query_many()`. `errors`
+    maps each key to its exception.
+    '''
+    def __init__(self, errors):
+        self.errors = errors
+        details = '\n'.join(
+            f'  {key}: {error.__cause__ or error}' for key, error in errors.items()
+        )
+        super().__init__(f'Unable to parse values for {len(errors)} key(s):\n{details}')
+
+
+class LoadErrors(RuntimeError):
+    '''
+    Some rulesets failed in a parallel `CombinedRuleset.load()`.
+    `errors` maps each ruleset's id to its exception. The other
+    rulesets did load.
+    '''
+    def __init__(self, errors):
+        self.errors = errors
+        details = '\n'.join(f'  {id}: {error!r}' for id, error in errors.items())
+        super().__init__(f'Unable to load {len(errors)} ruleset(s):\n{details}')
+
+
+def _components(selector):
+    '''
+    The simple selectors a context must match for `selector` to,
+    keyed so they compare equal across rulesets (selectors hash and
+    print with their provenance).
+    '''
+    return frozenset(
+        pmss.selectorindex.component_key(simple) or str(simple)
+        for simple in pmss.selectorindex.simple_selectors(selector)
+        if not isinstance(simple, pmss.pmssselectors.UniversalSelector)
+    )
+
+
+def _shadowed(components, covered):
+    '''
+    Whether a rule with `components` can never win, since an earlier
+    ruleset has a rule for the same key whose components are a subset
+    of them (so matches every context this one does). `covered` is a
+    set of the components of those earlier rules. Subsets of large
+    selectors are too many to try, so we only look for the most
+    general rules; that only means checking more than we need to.
+    '''
+    if not covered:
+        return False
+    if len(components) > 6:
+        return frozenset() in covered or components in covered
+    return any(
+        frozenset(subset) in covered
+        for size in range(len(components) + 1)
+        for subset in itertools.combinations(components, size)
+    )
 
 
 class CombinedRuleset(Ruleset):
-    def __init__(self, rulesets, id=None):
+    '''
+    Rulesets are consulted in order; the first one with a matching
+    selector wins.
+
+    If `cache_size` is given, resolved values are kept in an LRU cache
+    keyed on `(key, context)`, along with the rule they came from, so
+    `stats` can count winners for cache hits too. The cache is dropped whenever one of
+    our rulesets reloads, or rulesets are added or deleted. Rulesets
+    which report exactly what changed only drop the affected keys.
+
+    While a ruleset reloads, there's a moment after it has its new
+    rules, but before we drop cached values, in which one lookup can
+    see a new value, and a later one the cached old value. Once the
+    reload finishes, old values are never returned again.
+
+    Whether or not we cache resolved values, each rule's value is
+    converted to its field's type only once (see `parse()`).
+
+    If `stats` (a `pmss.stats.Stats`) is given, we record lookups,
+    resolutions, parse failures, and loads in it.
+
+    `add_ruleset()` and `delete_ruleset()` replace the `rulesets` list
+    with a new one, rather than modifying it, so lookups can walk it
+    without locks while another thread changes the stack.
+    Deleting a `FileRuleset` closes it, so its file is no longer
+    watched.
+    '''
+    def __init__(self, rulesets, id=None, cache_size=None, stats=None):
         global id_counter
-        self.rulesets = rulesets
+        self.rulesets = list(rulesets)
+        self.lock = threading.Lock()  # Serializes changes to `rulesets`
+        self.listeners = []
         if id is None:
             self.rulesetid = f"{super().id()}:{id_counter}"
             id_counter = id_counter+1
         else:
             self.rulesetid = id
+        self.cache = pmss.cache.LRUCache(cache_size) if cache_size else None
+        self.typed = {}
+        self.stats = stats
+        for ruleset in self.rulesets:
+            ruleset.add_listener(self.ruleset_changed)
 
     def id(self):
         return self.rulesetid
@@ -346,22 +1273,135 @@ class CombinedRuleset(Ruleset):
             self.add_ruleset(ruleset, holdoff=True)
 
     def add_ruleset(self, ruleset, holdoff=False):
-        self.rulesets.append(ruleset)
+        with self.lock:
+            self.rulesets = self.rulesets + [ruleset]
+        ruleset.add_listener(self.ruleset_changed)
+        self._changed(None)
         if not holdoff:
             self.load()
         return ruleset.id()
 
     def delete_ruleset(self, id):
-        for ruleset in self.rulesets:
-            if ruleset.id() == id:
-                self.rulesets.remove(ruleset)
-                return id
-        raise KeyError("Ruleset not found")
+        with self.lock:
+            for position, ruleset in enumerate(self.rulesets):
+                if ruleset.id() == id:
+                    self.rulesets = self.rulesets[:position] + self.rulesets[position + 1:]
+                    break
+            else:
+                raise KeyError("Ruleset not found")
+        ruleset.remove_listener(self.ruleset_changed)
+        if isinstance(ruleset, FileRuleset):
+            # Otherwise its watcher keeps watching, and reloading it
+            ruleset.close()
+        self._changed(None)
+        return id
+
+    def ruleset_changed(self, ruleset, changes=None):
+        '''
+        Called when one of our rulesets reloads.
+        '''
+        if self.stats is not None and ruleset is not self:
+            self.stats.loaded(ruleset)
+        self._changed(changes)
 
-    def load(self):
+    def _changed(self, changes):
+        '''
+        Drop typed and cached values affected by `changes` (everything,
+        if `None`), and tell our listeners.
+        '''
+        if changes is None:
+            self.typed = {}
+        else:
+            keys = changes.keys()
+            for typed_key in list(self.typed):
+                if typed_key[0] in keys:
+                    self.typed.pop(typed_key, None)
+        if self.cache is not None:
+            if changes is None:
+                self.cache.clear()
+            else:
+                self.cache.invalidate(keys)
+        self.notify_listeners(changes)
+
+    def cache_info(self):
+        '''
+        `(hits, misses, maxsize, currsize)`, as with `functools.lru_cache`,
+        or `None` if caching is disabled.
+        '''
+        if self.cache is None:
+            return None
+        return self.cache.info()
+
+    def check_changes(self):
         for ruleset in self.rulesets:
-            ruleset.load()
+            ruleset.check_changes()
+
+    def load(self, workers=None, processes=False):
+        '''
+        Load all of our rulesets.
+
+        By default, they load one after another. With `workers`, up to
+        that many load at once, on threads, so slow sources (network
+        file systems, databases) overlap. With `processes=True` as
+        well, rulesets which can (see `Ruleset.loader()`) are parsed in
+        a pool of processes instead, which helps when parsing big files
+        is the bottleneck. The PLY parser parses one sheet at a time
+        (see `pmss.pmssyacc.parse`), so with the default backend threads
+        only overlap reading files.
+
+        Precedence is always the order of `self.rulesets`, whichever
+        finishes first. When loading in parallel, a failure doesn't
+        stop the other rulesets loading; we raise one `LoadErrors`
+        once they're done.
+        '''
+        if not workers:
+            for ruleset in self.rulesets:
+                _load(ruleset)
+        else:
+            self._load_parallel(self.rulesets, workers, processes)
         self.loaded = True
+        self.ruleset_changed(self)
+
+    def _load_parallel(self, rulesets, workers, processes):
+        import concurrent.futures
+
+        errors = {}
+        locked = []
+        process_pool = concurrent.futures.ProcessPoolExecutor(workers) if processes else None
+        try:
+            with concurrent.futures.ThreadPoolExecutor(workers) as thread_pool:
+                jobs = []
+                for ruleset in rulesets:
+                    loader = ruleset.loader() if process_pool is not None else None
+                    if loader is None:
+                        jobs.append((ruleset, thread_pool.submit(_load, ruleset), False))
+                    else:
+                        function, args = loader
+                        # Held until we publish the result, as in `_load()`
+                        if ruleset.reload_lock is not None:
+                            ruleset.reload_lock.acquire()
+                            locked.append(ruleset.reload_lock)
+                        ruleset.load_started = time.perf_counter()
+                        jobs.append((ruleset, process_pool.submit(function, *args), True))
+                # Finish in order, so errors are reported in order
+                for ruleset, future, remote in jobs:
+                    try:
+                        loaded = future.result()
+                        if remote:
+                            ruleset.finish_load(loaded)
+                    except Exception as e:
+                        errors[ruleset.id()] = e
+                    finally:
+                        if remote and ruleset.reload_lock is not None:
+                            locked.remove(ruleset.reload_lock)
+                            ruleset.reload_lock.release()
+        finally:
+            for lock in locked:
+                lock.release()
+            if process_pool is not None:
+                process_pool.shutdown()
+        if errors:
+            raise LoadErrors(errors)
 
     def keys(self):
         keys_set = set()
@@ -369,36 +1409,213 @@ class CombinedRuleset(Ruleset):
             keys_set.update(ruleset.keys())
         return list(keys_set)
 
-    def query(self, key, context=None):
+    def query(self, key, context=None, trace=None, record=True):
         '''
         We don't want this. We want query(). But we are mid-refactor.
+
+        If a `pmss.trace.Trace` is given, each step is recorded in it.
+        On a cache hit, we still run the cascade, to show in the trace
+        where the cached value came from. `record` is as for
+        `resolve()`.
+        '''
+        if self.stats is None or not record:
+            return self._query(key, context, trace, record)
+        start = time.perf_counter()
+        try:
+            return self._query(key, context, trace, record)
+        finally:
+            self.stats.queried(key, time.perf_counter() - start)
+
+    def _query(self, key, context, trace, record):
+        if context is None:
+            context = {}
+        if self.cache is None:
+            return self.resolve(key, context, trace, record)
+
+        # File rulesets may reload here, which clears the cache. We
+        # only check once: `_resolve()` is told not to again.
+        if trace is not None:
+            start = time.perf_counter()
+        self.check_changes()
+        if trace is not None:
+            trace.step("check_changes", time.perf_counter() - start)
+        cache_key = pmss.cache.context_key(key, context)
+        if cache_key is None:
+            return self._resolve(key, context, trace, checked=True, record=record)
+        if trace is not None:
+            start = time.perf_counter()
+        cached = self.cache.get(cache_key)
+        if trace is not None:
+            trace.step("cache", time.perf_counter() - start, hit=cached is not pmss.cache.MISSING)
+        if cached is not pmss.cache.MISSING:
+            value, match = cached
+            if self.stats is not None and record:
+                self.stats.resolved(key, match, cached=True)
+            if trace is not None:
+                self._trace_cached(key, context, trace)
+            return value
+        generation = self.cache.generation
+        match = self._cascade(key, context, trace, checked=True)
+        if self.stats is not None and record:
+            self.stats.resolved(key, match)
+        value = self.parse(key, match, trace, record)
+        self.cache.put(cache_key, (value, match), generation)
+        return value
+
+    def _trace_cached(self, key, context, trace):
         '''
+        Fill in `trace` for a value served from the cache, with the
+        cascade it came from. That's not part of the lookup, so its
+        time isn't either.
+        '''
+        start = time.perf_counter()
+        trace.cached = True
+        try:
+            self._resolve(key, context, trace, checked=True, record=False)
+        except ValueError:
+            # The trace has the error; the cached value is still what
+            # we return
+            pass
+        trace.overhead += time.perf_counter() - start
+
+    def query_many(self, keys, context=None):
+        '''
+        Resolve several keys for one context, returning `{key: value}`.
+
+        We make one pass over the rulesets, asking each for all the
+        keys not yet matched, so rulesets can share selector matches
+        between keys. If any values fail to parse, we raise a single
+        `ParseErrors` listing all of them.
+        '''
+        if self.stats is None:
+            return self._query_many(keys, context)
+        start = time.perf_counter()
+        try:
+            return self._query_many(keys, context)
+        finally:
+            # Keys share the work, so we can only time the batch
+            self.stats.queried_many(list(dict.fromkeys(keys)), time.perf_counter() - start)
+
+    def _query_many(self, keys, context):
         if context is None:
             context = {}
-        best_matches = []
+        keys = list(dict.fromkeys(keys))
+        results = {}
+        pending = keys
+        if self.cache is not None:
+            self.check_changes()
+            generation = self.cache.generation
+            cache_keys = {key: pmss.cache.context_key(key, context) for key in keys}
+            pending = []
+            for key in keys:
+                cached = pmss.cache.MISSING
+                if cache_keys[key] is not None:
+                    cached = self.cache.get(cache_keys[key])
+                if cached is pmss.cache.MISSING:
+                    pending.append(key)
+                else:
+                    results[key], match = cached
+                    if self.stats is not None:
+                        self.stats.resolved(key, match, cached=True)
+
+        matches = {}
+        remaining = pending
         for ruleset in self.rulesets:
-            subquery = ruleset.query(key, context)
-            if not subquery:
+            if not remaining:
+                break
+            if self.cache is not None:
+                # We checked for changes above
+                matches.update(ruleset._best_matches(remaining, context))
+            else:
+                matches.update(ruleset.best_matches(remaining, context))
+            remaining = [key for key in remaining if key not in matches]
+
+        errors = {}
+        for key in pending:
+            if self.stats is not None:
+                self.stats.resolved(key, matches.get(key))
+            try:
+                results[key] = self.parse(key, matches.get(key))
+            except ValueError as e:
+                errors[key] = e
                 continue
-            # sort list based on selector priority to get best match
-            subquery = sorted(subquery, key=lambda x: pmss.pmssselectors.css_selector_key(x[0]))
-            best_local_match = subquery[0]
-            best_matches.append((ruleset.rulesetid, best_local_match))
-            break
-        # Find the matching field so we know how to parse
-        for field in pmss.schema.fields:
-            if field["name"] == key:
-                field_type = field['type']
+            if self.cache is not None and cache_keys[key] is not None:
+                self.cache.put(cache_keys[key], (results[key], matches.get(key)), generation)
+        if errors:
+            raise ParseErrors(errors)
+        return {key: results[key] for key in keys}
+
+    def resolve(self, key, context, trace=None, record=True):
+        '''
+        Run the full cascade for `key`, bypassing any cache. With
+        `record=False`, this isn't counted in `stats`, e.g. for lookups
+        we make for ourselves, rather than for a caller.
+        '''
+        return self._resolve(key, context, trace, checked=False, record=record)
+
+    def _resolve(self, key, context, trace, checked, record=True):
+        '''
+        `resolve()`. If we `checked` for changes just before, rulesets
+        aren't asked to again.
+        '''
+        match = self._cascade(key, context, trace, checked)
+        if self.stats is not None and record:
+            self.stats.resolved(key, match)
+        return self.parse(key, match, trace, record)
+
+    def _cascade(self, key, context, trace, checked):
+        '''
+        The winning `(selector, value)` pair for `key`, or `None`.
+        '''
+        # The first ruleset with any matching selector wins. Each
+        # ruleset hands back its own most specific match.
+        match = None
+        for ruleset in self.rulesets:
+            if trace is not None:
+                start = time.perf_counter()
+                match, selector_index = ruleset._traced_match(key, context, checked)
+                trace.ruleset(ruleset, match, time.perf_counter() - start, selector_index)
+            elif checked:
+                match = ruleset._best_match(key, context)
+            else:
+                match = ruleset.best_match(key, context)
+            if match:
                 break
-        if len(best_matches) == 0:
+        return match
+
+    def parse(self, key, match, trace=None, record=True):
+        '''
+        Convert the winning `(selector, value)` pair for `key` (or the
+        field's default, if `match` is `None`) to the field's type.
+
+        Typed values are kept in `self.typed`, keyed on `(key,
+        selector)`. Selectors carry the provenance of their ruleset, so
+        this is one entry per rule. Each entry remembers the field and
+        the raw value it was parsed from, and is recomputed if either
+        changed (e.g. the field was registered again). `record` is as
+        for `resolve()`.
+        '''
+        # Find the matching field so we know how to parse
+        field = pmss.schema.default_schema.fields_by_name.get(key)
+        if field is None:
+            raise KeyError(f'Key `{key}` is not registered as a field.')
+        field_type = field['type']
+        if not match:
             # No matches, grab the field's default.
+            selector = None
             best_match = field.get('default', None)
         else:
-            # Here's what we are indexing into:
-            # [0] grab the first item (best match)
-            # [1] get the match (index 0 at this layer is the rulesetid)
-            # [1] get the value (index 0 at this layer is the selector)
-            best_match = best_matches[0][1][1]
+            # `match` is a `(selector, value)` pair
+            selector, best_match = match[0], match[1]
+
+        if trace is not None:
+            start = time.perf_counter()
+            trace.winner = None if selector is None else pmss.trace.describe(selector)
+        typed = self.typed.get((key, selector))
+        if typed is not None and typed[0] is field and typed[1] == best_match:
+            if trace is not None:
+                trace.step("convert", time.perf_counter() - start, type=field_type, raw=best_match, value=typed[2], memoized=True)
+            return typed[2]
 
         # Sometimes it makes sense to default to None which conflicts
         # with the specified data type. For example, ports should
@@ -406,9 +1623,238 @@ class CombinedRuleset(Ruleset):
         # to manually go find one instead. I'm not sure the correct
         # layer of abstraction to make this.
         try:
-            return pmss.pmsstypes.parse(best_match, field_type)
+            value = pmss.pmsstypes.parse(best_match, field_type)
         except Exception as e:
+            if self.stats is not None and record:
+                self.stats.parse_failed(key)
+            if trace is not None:
+                trace.step("convert", time.perf_counter() - start, type=field_type, raw=best_match, error=str(e))
             raise ValueError(f'Unable to parse value for key `{key}`. See above exception for more details.') from e
+        self.typed[(key, selector)] = (field, best_match, value)
+        if trace is not None:
+            trace.step("convert", time.perf_counter() - start, type=field_type, raw=best_match, value=value, memoized=False)
+        return value
+
+    def check_types(self):
+        '''
+        Convert every value for every registered key which a query
+        could return to its field's type, so type errors show up when
+        we validate, rather than in the middle of a request. Typed
+        values are kept for later queries. Raises `ParseErrors` if any
+        fail.
+
+        Rules shadowed by an earlier ruleset (see `_shadowed`) can
+        never be returned, so they're not checked. Neither are
+        rulesets which can't list their rules (see
+        `Ruleset.candidates`), nor those which don't keep them in
+        memory (see `Ruleset.check_types_up_front`).
+        '''
+        errors = {}
+        earlier = {}  # {key: components of the rules in earlier rulesets}
+        for ruleset in self.rulesets:
+            if not ruleset.check_types_up_front:
+                continue
+            for key in ruleset.keys():
+                if key not in pmss.schema.default_schema.fields_by_name:
+                    continue
+                candidates = ruleset.candidates(key)
+                if candidates is None:
+                    continue
+                covered = earlier.setdefault(key, set())
+                components = [_components(selector) for selector, value in candidates]
+                for match, selector_components in zip(candidates, components):
+                    if _shadowed(selector_components, covered):
+                        continue
+                    try:
+                        self.parse(key, match)
+                    except ValueError as e:
+                        errors.setdefault(key, e)
+                # Rules don't shadow others in the same ruleset: those
+                # with fewer components are less specific
+                covered.update(components)
+        if errors:
+            raise ParseErrors(errors)
 
     def debug_dump(self):
         return {ruleset.id(): ruleset.debug_dump() for ruleset in self.rulesets}
+
+
+def _sheet_rules(rulesets):
+    '''
+    The parsed rules of each of `rulesets`, for comparing loads.
+    '''
+    return [(ruleset.id(), pmss.loadfile._rule_list(ruleset.snapshot.results)) for ruleset in rulesets]
+
+
+def test_parallel_load_matches_sequential():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = []
+        for n in range(8):
+            filename = os.path.join(directory, f"sheet{n}.pmss")
+            with open(filename, 'w') as f:
+                for rule in range(300):
+                    f.write(f".school{rule} [role=role{n}] {{\n    key{rule % 7}: value{n}_{rule};\n}}\n")
+            filenames.append(filename)
+
+        def load(workers):
+            rulesets = [PMSSFileRuleset(filename, rulesetid=f"sheet{n}") for n, filename in enumerate(filenames)]
+            CombinedRuleset(rulesets).load(workers=workers)
+            return _sheet_rules(rulesets)
+
+        expected = load(None)
+        # Switch threads often, so parses overlap
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for attempt in range(3):
+                assert load(len(filenames)) == expected
+        finally:
+            sys.setswitchinterval(interval)
+
+
+def test_reloads_under_concurrent_reads():
+    import tempfile
+
+    import pmss.pmsstypes
+
+    keys = ("test_reload_first", "test_reload_second")
+    for key in keys:
+        if key not in pmss.schema.default_schema.fields_by_name:
+            pmss.schema.register_field(name=key, type=pmss.pmsstypes.TYPES.integer)
+
+    def write(filename, version):
+        # Explicit modification times, so `'stat'` sees every version
+        rules = "".join(f"    {key}: {version};\n" for key in keys)
+        with open(filename + '.tmp', 'w') as f:
+            f.write(f"* {{\n{rules}}}\n.reader {{\n{rules}}}\n")
+        os.utime(filename + '.tmp', ns=(version, version))
+        os.replace(filename + '.tmp', filename)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'versions.pmss')
+        extra_filename = os.path.join(directory, 'extra.pmss')
+        write(extra_filename, 0)
+        for cache_size in (None, 128):
+            write(filename, 1)
+            combined = CombinedRuleset([PMSSFileRuleset(filename, watch='stat')], cache_size=cache_size)
+            combined.load()
+            stop = threading.Event()
+            errors = []
+
+            def read():
+                latest = 0
+                try:
+                    while not stop.is_set():
+                        values = combined.query_many(keys, {"classes": ["reader"]})
+                        first, second = (values[key] for key in keys)
+                        if cache_size is None:
+                            # Without a cache, both come from one snapshot,
+                            # and never an older one
+                            assert first == second, f"Mixed versions: {values}"
+                            assert first >= latest, f"Went back from version {latest} to {first}"
+                            latest = first
+                        else:
+                            assert 1 <= min(first, second), values
+                except Exception as e:
+                    errors.append(e)
+
+            def change_stack():
+                try:
+                    while not stop.is_set():
+                        # Reloads everything, racing the readers' `'stat'`
+                        # reloads, and changes the stack under them
+                        combined.add_ruleset(PMSSFileRuleset(extra_filename, rulesetid="extra"))
+                        combined.delete_ruleset("extra")
+                except Exception as e:
+                    errors.append(e)
+
+            def load():
+                try:
+                    while not stop.is_set():
+                        combined.load()
+                except Exception as e:
+                    errors.append(e)
+
+            interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-5)
+            threads = [threading.Thread(target=target) for target in (read, read, read, change_stack, load)]
+            try:
+                for thread in threads:
+                    thread.start()
+                for version in range(2, 200):
+                    write(filename, version)
+            finally:
+                stop.set()
+                for thread in threads:
+                    thread.join()
+                sys.setswitchinterval(interval)
+            assert not errors, errors[0]
+            assert combined.query("test_reload_first", {}) == 199
+
+
+def test_cache_invalidation():
+    import tempfile
+
+    import pmss.pmsstypes
+    import pmss.schema
+
+    keys = ("test_cache_first", "test_cache_second")
+    for key in keys:
+        if key not in pmss.schema.default_schema.fields_by_name:
+            pmss.schema.register_field(name=key, type=pmss.pmsstypes.TYPES.integer)
+
+    def write(filename, version, first, second):
+        with open(filename, 'w') as f:
+            f.write(f"* {{\n    test_cache_first: {first};\n    test_cache_second: {second};\n}}\n")
+            for n in range(10):
+                f.write(f"[n={n}] {{\n    test_cache_first: {first + n};\n}}\n")
+        os.utime(filename, ns=(version, version))
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'cached.pmss')
+        for incremental in (False, True):
+            write(filename, 1, 1, 2)
+            combined = CombinedRuleset(
+                [PMSSFileRuleset(filename, watch='stat', incremental=incremental)],
+                cache_size=4
+            )
+            combined.load()
+            assert combined.query("test_cache_first", {}) == 1
+            assert combined.query("test_cache_second", {}) == 2
+            assert combined.query("test_cache_first", {}) == 1
+            assert combined.cache_info()[:2] == (1, 2)
+
+            # A reload drops what it changed, or everything if it
+            # can't tell
+            write(filename, 2, 10, 2)
+            assert combined.query("test_cache_first", {}) == 10
+            assert combined.query("test_cache_second", {}) == 2
+            hits = 1 if incremental else 0
+            assert combined.cache_info()[:2] == (1 + hits, 4 - hits)
+
+            # Eviction is at `cache_size`, least recently used first
+            for n in range(10):
+                assert combined.query("test_cache_first", {"attributes": {"n": str(n)}}) == 10 + n
+                assert combined.cache_info().currsize == min(n + 3, 4)
+            hits, misses = combined.cache_info()[:2]
+            assert combined.query("test_cache_first", {"attributes": {"n": "6"}}) == 16
+            assert combined.cache_info()[:2] == (hits + 1, misses)
+            assert combined.query("test_cache_first", {"attributes": {"n": "5"}}) == 15
+            assert combined.cache_info()[:2] == (hits + 1, misses + 1)
+            # That evicted 7, not 6, which we'd just used
+            assert combined.query("test_cache_first", {"attributes": {"n": "6"}}) == 16
+            assert combined.query("test_cache_first", {"attributes": {"n": "7"}}) == 17
+            assert combined.cache_info()[:2] == (hits + 2, misses + 2)
+
+            # Changing the stack drops everything
+            combined.delete_ruleset(combined.rulesets[0].id())
+            assert combined.cache_info().currsize == 0
+
+
+if __name__ == "__main__":
+    test_parallel_load_matches_sequential()
+    test_reloads_under_concurrent_reads()
+    test_cache_invalidation()
+    print("All test cases passed successfully.")
@@ -20,12 +20,44 @@ class Schema:
     95% of the time, we expect to be operating on `default_schema`, and
     the use-case of more than one Schema object is pretty rare. As a result,
     a simple, global, `register_field` (and friends) may make sense.
+
+    Alongside the lists, we keep dictionaries so lookups by name,
+    canonical key, environment variable, or command-line flag don't
+    need to scan every field. These are kept up-to-date by
+    `register_field` (and friends). If a name is registered twice, the
+    later registration wins.
     '''
     def __init__(self, fields, classes, attributes):
         self.fields = fields
         self.classes = classes
         self.attributes = attributes
 
+        self.fields_by_name = {}
+        self.fields_by_canonical_key = {}
+        self.fields_by_env = {}
+        self.fields_by_flag = {}
+        self.classes_by_name = {}
+        self.attributes_by_name = {}
+
+        for field in fields:
+            _index_field(self, field)
+        for class_ in classes:
+            self.classes_by_name[class_['name']] = class_
+        for attribute in attributes:
+            self.attributes_by_name[attribute['name']] = attribute
+
+
+def _index_field(schema, field):
+    schema.fields_by_name[field['name']] = field
+    schema.fields_by_canonical_key[pmss.util.canonical_key(field['name'])] = field
+    env = field.get('env')
+    if isinstance(env, str):
+        env = [env]
+    for variable in env or []:
+        schema.fields_by_env[variable] = field
+    for flag in pmss.util.command_line_args(field):
+        schema.fields_by_flag[flag] = field
+
 
 default_schema = Schema(fields=fields, classes=classes, attributes=attributes)
 
@@ -65,7 +97,7 @@ def register_field(
     if required and default:
         raise ValueError(f"Required parameters shouldn't have a default! {name}")
 
-    schema.fields.append({
+    field = {
         "name": name,
         "type": type,
         "command_line_flags": command_line_flags,
@@ -74,7 +106,9 @@ def register_field(
         "default": default,
         "env": env,
         "context": context
-    })
+    }
+    schema.fields.append(field)
+    _index_field(schema, field)
 
 
 def register_class(
@@ -91,11 +125,13 @@ def register_class(
     .dev {}
     .prod {}
     '''
-    schema.classes.append({
+    class_ = {
         "name": name,
         "command_line_flags": command_line_flags,
         "description": description
-    })
+    }
+    schema.classes.append(class_)
+    schema.classes_by_name[name] = class_
 
 
 def register_attribute(
@@ -109,11 +145,13 @@ def register_attribute(
     For example, `'username'` would let us use a selector
     `[username=bob]`
     '''
-    schema.attributes.append({
+    attribute = {
         "name": name,
         "type": type,
         "description": description
-    })
+    }
+    schema.attributes.append(attribute)
+    schema.attributes_by_name[name] = attribute
 
 
 register_field(
@@ -182,6 +220,7 @@ def validate(settings):
       different cases).
     - Check all registered fields exist
     - Check no unregistered variables exist, unless prefixed with `_`
+    - Check every value converts to its field's type
     - Interpolate everything
     '''
     # check that each key is accessed the same way
@@ -206,21 +245,23 @@ def validate(settings):
             raise RuntimeError(error_msg)
 
     # check if any missing required fields
-    available_fields = []
     for field in fields:
         cleaned = pmss.util.canonical_key(field['name'])
-        available_fields.append(cleaned)
         if field['required'] and cleaned not in available_keys:
             error_msg = f'Required field `{field["name"]}` not found in available rulesets.'
             raise KeyError(error_msg)
 
     # check for any extra keys
+    available_fields = default_schema.fields_by_canonical_key
     for key in available_keys:
         k = available_keys[key].popitem()[0]
         if not k.startswith('_') and key not in available_fields:
             error_msg = f'Key `{k}` is not registered as a field.'
             raise KeyError(error_msg)
 
+    # check that values parse, caching the typed values for later
+    settings.ruleset.check_types()
+
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,516 @@
+'''
+Indexes over the selectors for a single key, so a query only has to
+`match()` the handful of selectors which could possibly apply to a
+context, rather than every selector in the ruleset.
+
+This is the same trick CSS engines use: each selector is filed into a
+bucket under one of its simple selectors (an ID, a class, a type, or
+an attribute), and a lookup only visits the buckets named by the
+context. We file each selector under its rarest component, so large
+sheets with thousands of `[school=...]` blocks end up with thousands
+of tiny buckets.
+
+Entries are stored in order of precedence: most specific first and,
+for equal specificity, the one declared last in the source first (as
+in CSS). Since candidates come back in that order, the first one which
+matches is the winner, and we never need to sort at query time.
+
+Attribute operators other than `=` (e.g. `[email$=@district.org]`)
+can't be found by a dictionary lookup on the context's value, so each
+attribute they test gets an `_OperatorIndex`, which finds every rule
+the value could match in one pass over the value, however many rules
+there are: a trie of prefixes for `^=` and `|=`, a trie of reversed
+suffixes for `$=`, the value's words for `~=`, and an Aho-Corasick
+automaton over all the substrings for `*=`.
+
+Results are identical to a linear scan: every candidate still goes
+through `selector.match()`.
+'''
+
+import collections
+
+import pmss.pmssselectors
+
+# Ties between equally rare components go to the most selective kind
+_KIND_PRIORITY = {
+    'id': 0,
+    'attribute_value': 1,
+    'attribute_dash': 2,
+    'attribute_word': 3,
+    'attribute_prefix': 4,
+    'attribute_suffix': 5,
+    'attribute_substring': 6,
+    'class': 7,
+    'type': 8,
+    'attribute': 9
+}
+
+# The bucket kind for each attribute operator, other than `=`
+OPERATOR_KINDS = {
+    '|=': 'attribute_dash',
+    '~=': 'attribute_word',
+    '^=': 'attribute_prefix',
+    '$=': 'attribute_suffix',
+    '*=': 'attribute_substring'
+}
+_OPERATOR_BUCKETS = frozenset(OPERATOR_KINDS.values())
+
+
+def simple_selectors(selector):
+    '''
+    Flatten a (possibly nested) compound selector into its simple
+    selectors.
+    '''
+    if isinstance(selector, pmss.pmssselectors.CompoundSelector):
+        for child in selector.selectors:
+            yield from simple_selectors(child)
+    else:
+        yield selector
+
+
+def component_key(selector):
+    '''
+    The bucket a simple selector can be indexed under, or `None` if
+    it places no indexable constraint on the context (e.g. `*`).
+    '''
+    if isinstance(selector, pmss.pmssselectors.IDSelector):
+        return ('id', selector.id_name)
+    if isinstance(selector, pmss.pmssselectors.ClassSelector):
+        return ('class', selector.class_name)
+    if isinstance(selector, pmss.pmssselectors.TypeSelector):
+        return ('type', selector.element_type)
+    if isinstance(selector, pmss.pmssselectors.AttributeSelector):
+        if selector.operator is None:
+            return ('attribute', selector.attribute)
+        if selector.operator == '=':
+            return ('attribute_value', (selector.attribute, selector.value))
+        kind = OPERATOR_KINDS.get(selector.operator)
+        # Operands which never match anything are left to `match()`
+        if kind is None or not isinstance(selector.value, str):
+            return None
+        if kind == 'attribute_word' and selector.value.split() != [selector.value]:
+            return None
+        if kind != 'attribute_dash' and not selector.value:
+            return None
+        return (kind, (selector.attribute, selector.value))
+    return None
+
+
+def _indexable(selector):
+    '''
+    The component keys for a selector, or `None` if some component
+    must always be checked by hand (e.g. pseudo-classes).
+    '''
+    keys = []
+    for simple in simple_selectors(selector):
+        if isinstance(simple, pmss.pmssselectors.UniversalSelector):
+            continue
+        key = component_key(simple)
+        if key is None:
+            return None
+        keys.append(key)
+    return keys
+
+
+def precedence_order(selector_dict):
+    '''
+    The `(selector, value)` pairs of a `{selector: value}` dictionary
+    (in source order) sorted so the winning rule comes first.
+    '''
+    items = list(selector_dict.items())
+    order = sorted(
+        range(len(items)),
+        key=lambda position: (-items[position][0].css_specificity(), -position)
+    )
+    return [items[position] for position in order]
+
+
+def _add_to_trie(trie, needle, positions):
+    '''
+    Tries are nested `{character: node}` dictionaries. Positions of
+    the rules for a needle are kept under `None` in its node.
+    '''
+    node = trie
+    for character in needle:
+        node = node.setdefault(character, {})
+    node.setdefault(None, []).extend(positions)
+
+
+def _walk_trie(trie, characters, found):
+    '''
+    Add the positions under every needle which `characters` starts
+    with to `found`.
+    '''
+    node = trie
+    for character in characters:
+        node = node.get(character)
+        if node is None:
+            return
+        if None in node:
+            found.extend(node[None])
+
+
+class _Automaton():
+    '''
+    Aho-Corasick: finds every needle occurring in a text in one pass.
+    States are numbered; 0 is the root.
+    '''
+    def __init__(self, needles):
+        self.goto = [{}]
+        self.outputs = [[]]
+        for needle, positions in needles.items():
+            state = 0
+            for character in needle:
+                next_state = self.goto[state].get(character)
+                if next_state is None:
+                    next_state = self.goto[state][character] = len(self.goto)
+                    self.goto.append({})
+                    self.outputs.append([])
+                state = next_state
+            self.outputs[state].extend(positions)
+
+        # Breadth first, so each state's failure (its longest proper
+        # suffix which is also a prefix of some needle) is done before
+        # we need it. Each state also outputs everything its failure
+        # does.
+        self.fail = [0] * len(self.goto)
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and character not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(character, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    def search(self, text, found):
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        state = 0
+        for character in text:
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            if outputs[state]:
+                found.extend(outputs[state])
+
+
+class _OperatorIndex():
+    '''
+    Candidates among the rules testing one attribute with operators
+    other than `=`, for a (string) value of that attribute.
+    '''
+    def __init__(self):
+        self.prefixes = {}     # Trie, for `^=`, and `|=` (as `value-`)
+        self.suffixes = {}     # Trie, of reversed needles, for `$=`
+        self.substrings = {}   # {needle: positions}, for `*=`
+        self.automaton = None
+        self.words = {}        # {word: positions}, for `~=`
+        self.dashes = {}       # {value: positions}, for `|=` matching exactly
+
+    def add(self, kind, needle, positions):
+        if kind == 'attribute_prefix':
+            _add_to_trie(self.prefixes, needle, positions)
+        elif kind == 'attribute_dash':
+            _add_to_trie(self.prefixes, needle + '-', positions)
+            self.dashes[needle] = positions
+        elif kind == 'attribute_suffix':
+            _add_to_trie(self.suffixes, reversed(needle), positions)
+        elif kind == 'attribute_substring':
+            self.substrings[needle] = positions
+        elif kind == 'attribute_word':
+            self.words[needle] = positions
+
+    def compile(self):
+        if self.substrings:
+            self.automaton = _Automaton(self.substrings)
+
+    def candidates(self, value, found):
+        if self.prefixes:
+            _walk_trie(self.prefixes, value, found)
+        if self.suffixes:
+            _walk_trie(self.suffixes, reversed(value), found)
+        if self.automaton is not None:
+            self.automaton.search(value, found)
+        if self.words:
+            for word in value.split():
+                found.extend(self.words.get(word, ()))
+        if self.dashes:
+            found.extend(self.dashes.get(value, ()))
+
+
+class SelectorIndex():
+    '''
+    Index of the `{selector: value}` dictionary for one key.
+    '''
+    def __init__(self, selector_dict):
+        self._build(precedence_order(selector_dict))
+
+    @classmethod
+    def from_entries(cls, entries):
+        '''
+        Index a list of `(selector, value)` pairs which is already in
+        order of precedence.
+        '''
+        selector_index = cls.__new__(cls)
+        selector_index._build(list(entries))
+        return selector_index
+
+    def _build(self, entries):
+        self.entries = entries
+        self.buckets = collections.defaultdict(list)
+        self.always = []
+
+        components = [_indexable(selector) for selector, value in self.entries]
+        frequency = collections.Counter(
+            key for keys in components if keys for key in set(keys)
+        )
+
+        for position, keys in enumerate(components):
+            if not keys:
+                # Universal, empty, or not indexable: always a candidate
+                self.always.append(position)
+                continue
+            rarest = min(keys, key=lambda k: (frequency[k], _KIND_PRIORITY[k[0]]))
+            self.buckets[rarest].append(position)
+        self.buckets = dict(self.buckets)
+
+        # {attribute: _OperatorIndex}, over the buckets which can't be
+        # looked up by the context's value
+        self.operators = {}
+        for (kind, name), positions in self.buckets.items():
+            if kind in _OPERATOR_BUCKETS:
+                attribute, needle = name
+                if attribute not in self.operators:
+                    self.operators[attribute] = _OperatorIndex()
+                self.operators[attribute].add(kind, needle, positions)
+        for operator_index in self.operators.values():
+            operator_index.compile()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def candidates(self, id=None, types=[], classes=[], attributes={}):
+        '''
+        Positions of all entries which might match the context, in
+        order of precedence. Falls back to every entry for unusual
+        contexts (e.g. `classes` given as a string) so we never change
+        semantics.
+        '''
+        if isinstance(types, str) or isinstance(classes, str) or not isinstance(attributes, dict):
+            return range(len(self.entries))
+
+        buckets = self.buckets
+        found = list(self.always)
+        try:
+            if id is not None:
+                found.extend(buckets.get(('id', id), ()))
+            for class_name in classes:
+                found.extend(buckets.get(('class', class_name), ()))
+            for element_type in types:
+                found.extend(buckets.get(('type', element_type), ()))
+            for attribute, value in attributes.items():
+                found.extend(buckets.get(('attribute', attribute), ()))
+                found.extend(buckets.get(('attribute_value', (attribute, value)), ()))
+            if self.operators:
+                for attribute, value in attributes.items():
+                    operator_index = self.operators.get(attribute)
+                    # Other operators only ever match strings
+                    if operator_index is not None and isinstance(value, str):
+                        operator_index.candidates(value, found)
+        except TypeError:
+            # Something unhashable in the context
+            return range(len(self.entries))
+        return sorted(set(found))
+
+    def query(self, context):
+        '''
+        Same result as checking every selector against the context:
+        a list of `[selector, value]` pairs, best match first.
+        '''
+        entries = self.entries
+        return_list = []
+        for position in self.candidates(**context):
+            selector, value = entries[position]
+            if selector.match(**context):
+                return_list.append([selector, value])
+        return return_list
+
+    def best_match(self, context, matched=None):
+        '''
+        The winning `[selector, value]` pair for the context, or `None`.
+
+        `matched` is an optional `{selector: bool}` dictionary of match
+        results for this same context, shared between lookups of
+        several keys. Rules in one block share their selector, so this
+        saves re-matching it for each key.
+        '''
+        entries = self.entries
+        for position in self.candidates(**context):
+            selector, value = entries[position]
+            if matched is None:
+                is_match = selector.match(**context)
+            else:
+                is_match = matched.get(selector)
+                if is_match is None:
+                    is_match = matched[selector] = selector.match(**context)
+            if is_match:
+                return [selector, value]
+        return None
+
+
+EMPTY = SelectorIndex({})
+
+
+def index_results(results):
+    '''
+    Build indexes for a ruleset's `{key: {selector: value}}` results.
+    '''
+    return {key: SelectorIndex(selector_dict) for key, selector_dict in results.items()}
+
+
+_TEST_OPERATORS = [None, '=', '~=', '|=', '^=', '$=', '*=']
+_TEST_VALUES = ['', 'mvs', 'mvs_east', 'en', 'en-us', 'a b', 'east']
+
+
+def _random_selector(rng):
+    '''
+    A random selector, simple or compound, for tests: IDs, classes,
+    types, attributes with every operator, pseudo-classes, and `*`.
+    '''
+    def attribute_selector():
+        operator = rng.choice(_TEST_OPERATORS)
+        value = None if operator is None else rng.choice(_TEST_VALUES)
+        return pmss.pmssselectors.AttributeSelector('school', operator, value)
+
+    simple_selectors = [
+        lambda: pmss.pmssselectors.IDSelector(rng.choice(['alice', 'bob'])),
+        lambda: pmss.pmssselectors.ClassSelector(rng.choice(['dev', 'prod', 'roster'])),
+        lambda: pmss.pmssselectors.TypeSelector(rng.choice(['roster', 'grade'])),
+        attribute_selector,
+        lambda: pmss.pmssselectors.PseudoClassSelector('hover'),
+        lambda: pmss.pmssselectors.UniversalSelector()
+    ]
+    parts = [rng.choice(simple_selectors)() for count in range(rng.randint(1, 3))]
+    return parts[0] if len(parts) == 1 else pmss.pmssselectors.CompoundSelector(parts)
+
+
+def _random_context(rng):
+    '''
+    A random context for tests, for the selectors from `_random_selector`.
+    '''
+    return {
+        "id": rng.choice([None, 'alice', 'bob']),
+        # Strings, rather than lists, are matched by substring
+        "types": rng.choice([[], ['roster'], ['roster', 'grade'], 'roster', 'rost']),
+        "classes": rng.choice([[], ['dev'], ['dev', 'prod'], ['roster'], 'dev', 'prodev']),
+        "attributes": rng.choice([
+            {},
+            {'school': rng.choice(_TEST_VALUES)},
+            {'school': rng.choice(_TEST_VALUES), 'district': 'x'},
+            {'school': 3},
+            {'school': ['mvs']},   # Unhashable
+            {'school': {'mvs': 1}}
+        ])
+    }
+
+
+def _random_selector_dict(rng, rules=40):
+    '''
+    `{selector: value}` of up to `rules` random rules, in source order.
+    Values are their position, so ties can be told apart.
+    '''
+    selector_dict = {}
+    for position in range(rng.randint(0, rules)):
+        selector = _random_selector(rng)
+        # A repeated selector moves to the end, as in `rule_sheet`
+        selector_dict.pop(selector, None)
+        selector_dict[selector] = str(position)
+    return selector_dict
+
+
+def _linear_scan(selector_dict, context):
+    # Most specific first; of equal specificity, the later rule
+    matches = [
+        (position, selector, value)
+        for position, (selector, value) in enumerate(selector_dict.items())
+        if selector.match(**context)
+    ]
+    matches.sort(key=lambda match: (-match[1].css_specificity(), -match[0]))
+    return [[selector, value] for position, selector, value in matches]
+
+
+def test_index_matches_linear_scan():
+    import random
+
+    rng = random.Random(1729)
+    for trial in range(200):
+        selector_dict = _random_selector_dict(rng)
+        selector_index = SelectorIndex(selector_dict)
+        for lookup in range(20):
+            context = _random_context(rng)
+            expected = _linear_scan(selector_dict, context)
+            assert selector_index.query(context) == expected, context
+            assert selector_index.best_match(context) == (expected[0] if expected else None), context
+            assert selector_index.best_match(context, {}) == (expected[0] if expected else None), context
+
+
+def test_sqlite_matches_index():
+    import os
+    import random
+    import tempfile
+
+    import pmss.rulesets
+
+    def rules(matches):
+        # SQLite gives back its own selectors, so compare their specs
+        return [(pmss.rulesets._selector_spec(selector), value) for selector, value in matches]
+
+    rng = random.Random(1730)
+    with tempfile.TemporaryDirectory() as directory:
+        for trial in range(30):
+            database = os.path.join(directory, f"rules{trial}.db")
+            ruleset = pmss.rulesets.SQLiteRuleset(database)
+            ruleset.load()
+            selector_dict = _random_selector_dict(rng)
+            ruleset.add_rules({'key': selector_dict})
+
+            # Edits from another connection, which we only see through
+            # `check_changes()`
+            other = pmss.rulesets.SQLiteRuleset(database)
+            other.load()
+            changes = []
+            ruleset.add_listener(lambda changed, change: changes.append(change))
+            edits = rng.randint(0, 5)
+            for edit in range(edits):
+                if selector_dict and rng.random() < 0.5:
+                    selector = rng.choice(list(selector_dict))
+                    del selector_dict[selector]
+                    other.delete_rule('key', selector)
+                else:
+                    selector = _random_selector(rng)
+                    selector_dict.pop(selector, None)
+                    selector_dict[selector] = f"edit{edit}"
+                    other.set_rule('key', selector, f"edit{edit}")
+            ruleset.check_changes()
+            assert len(changes) == (1 if edits else 0), changes
+
+            for lookup in range(20):
+                context = _random_context(rng)
+                expected = rules(_linear_scan(selector_dict, context))
+                assert rules(ruleset.query('key', context)) == expected, context
+                best_match = ruleset.best_match('key', context)
+                assert rules([best_match] if best_match else []) == expected[:1], context
+                best_matches = ruleset.best_matches(['key', 'missing'], context)
+                assert rules(best_matches.values()) == expected[:1], context
+            ruleset.close()
+            other.close()
+
+
+if __name__ == "__main__":
+    test_index_matches_linear_scan()
+    test_sqlite_matches_index()
+    print("All test cases passed successfully.")
@@ -12,6 +12,11 @@ import pmss.pathfinder
 import pmss.pmssselectors
 import pmss.schema
 import pmss.rulesets
+import pmss.frozen
+import pmss.stats
+import pmss.trace
+import pmss.subscriptions
+import pmss.vectorized
 
 from pmss.rulesets import *
 
@@ -33,17 +38,25 @@ class Settings():
     1. We can pass parameters if we have e.g. specific classes, ids, attributes, etc.
     2. We want to be explicit that this might e.g. query a setting database
 
-    We probably want also want an `async_settings` object for use in
-    asynchronous code in the future.
+    For asynchronous code, see `pmss.AsyncSettings`.
     '''
     def __init__(
             self,
-            rulesets=None
+            rulesets=None,
+            cache_size=None,  # Keep up to this many resolved values in an LRU cache
+            load_workers=None,  # Load up to this many rulesets at once (see `CombinedRuleset.load`)
+            load_processes=False,
+            instrument=False,  # Record lookups and loads, for `stats()`
+            exporter=None  # Also send them here (see `pmss.stats`); implies `instrument`
     ):
         if rulesets is None:
             rulesets = pmss.functional.default_rulesets(self)
-        self.ruleset = CombinedRuleset(rulesets)
-        self.ruleset.load()
+        stats = None
+        if instrument or exporter is not None:
+            stats = pmss.stats.Stats(exporter)
+        self.ruleset = CombinedRuleset(rulesets, cache_size=cache_size, stats=stats)
+        self.ruleset.load(workers=load_workers, processes=load_processes)
+        self.subscriptions = pmss.subscriptions.Subscriptions(self.ruleset)
 
     def get(self, key, *args, id=None, types=[], classes=[], attributes={}, default=None):
         results = self.ruleset.query(key, {
@@ -56,23 +69,131 @@ class Settings():
             return default
         return results
 
+    def explain(self, key, *args, id=None, types=[], classes=[], attributes={}, cache=True):
+        '''
+        Look up `key` as `get()` does, but return a `pmss.trace.Trace`
+        report of how we got there, as a dictionary:
+
+        * `steps`: in order, each with the `seconds` it took. Checking
+          for changes and the cache (if enabled), then each ruleset
+          consulted, with its candidate selectors (provenance,
+          specificity, and whether each matched, in order of
+          precedence) and its best match, then the conversion of the
+          winning value to the field's type.
+        * `winner`: the winning selector, or `None` for the default.
+        * `cached`: whether `get()` would have served the value from the
+          cache. The ruleset and conversion steps are filled in
+          anyway, but aren't part of `seconds`.
+        * `value`, or the `error` if the value didn't parse.
+        * `seconds`: the whole lookup.
+
+        With `cache=False`, we skip the cache, to time the cascade for
+        values which are already cached. Explaining a lookup doesn't
+        count towards `stats()`.
+        '''
+        context = {
+            "id": id,
+            "types": types,
+            "classes": classes,
+            "attributes": attributes
+        }
+        trace = pmss.trace.Trace(key, context)
+        try:
+            if cache:
+                value = self.ruleset.query(key, context, trace=trace, record=False)
+            else:
+                value = self.ruleset.resolve(key, context, trace=trace, record=False)
+        except ValueError as e:
+            return trace.report(error=str(e))
+        return trace.report(value=value)
+
+    def get_many(self, keys, *args, id=None, types=[], classes=[], attributes={}):
+        '''
+        Look up several keys with the same context, returning a
+        dictionary of `{key: value}`. This is faster than calling
+        `get()` for each key. If some values can't be parsed, this
+        raises one `pmss.rulesets.ParseErrors` covering all of them.
+        '''
+        return self.ruleset.query_many(keys, {
+            "id": id,
+            "types": types,
+            "classes": classes,
+            "attributes": attributes
+        })
+
+    def subscribe(self, key, callback, *args, id=None, types=[], classes=[], attributes={}, loop=None):
+        '''
+        Call `callback(value)` whenever the value of `key`, with this
+        context, changes, e.g. because a file reloaded. Callbacks run
+        on a shared dispatcher thread or, if `loop` is given, on that
+        asyncio event loop (see `pmss.subscriptions`). Returns a
+        subscription, with the current `value`, and a `cancel()`
+        method.
+        '''
+        return self.subscriptions.subscribe(key, callback, {
+            "id": id,
+            "types": types,
+            "classes": classes,
+            "attributes": attributes
+        }, loop=loop)
+
+    def get_batch(self, key, batch):
+        '''
+        Look up `key` for every context in a `pmss.ContextBatch`,
+        returning a NumPy array of values. This gives the same results
+        as calling `get()` for each context, but is much faster for
+        large batches. Requires NumPy.
+        '''
+        return pmss.vectorized.resolve(self.ruleset, key, batch)
+
+    def freeze(self, memo_size=4096):
+        '''
+        Return a read-only `pmss.frozen.FrozenSettings` snapshot, with
+        every value parsed up-front and the rulesets flattened into one
+        table per key. Reads are much faster, but the snapshot never
+        sees reloads, or fields registered after it was taken.
+        '''
+        return pmss.frozen.FrozenSettings(self.ruleset, memo_size=memo_size)
+
     def __getattr__(self, key):
         '''
         Enum-style access to pmss.schema.fields.
         '''
-        for field in pmss.schema.fields:
-            if field["name"] == key:
-                def getter(**kwargs):
-                    return self.get(key, **kwargs)
-                return getter
+        if key in pmss.schema.default_schema.fields_by_name:
+            def getter(**kwargs):
+                return self.get(key, **kwargs)
+            return getter
 
         raise ValueError(f"Invalid Key: {key}")
 
     def __dir__(self):
-        return sorted(set([field["name"] for field in pmss.schema.fields]))
+        return sorted(pmss.schema.default_schema.fields_by_name)
 
     def __hasattr__(self, key):
         return key in dir(self)
 
+    def cache_info(self):
+        '''
+        Hit / miss counters for the resolution cache, or `None` if
+        caching is disabled.
+        '''
+        return self.ruleset.cache_info()
+
+    def stats(self):
+        '''
+        Per-key lookup counts, winning rulesets, defaults served,
+        parse failures and latency histograms, the latency of batched
+        lookups (`get_many`), and per-ruleset load
+        counts, load times and approximate memory, as a dictionary.
+        Winners and defaults count cache hits too.
+        `None` unless created with `instrument=True`.
+        '''
+        if self.ruleset.stats is None:
+            return None
+        report = self.ruleset.stats.report(self.ruleset.rulesets)
+        cache_info = self.ruleset.cache_info()
+        report["cache"] = cache_info._asdict() if cache_info is not None else None
+        return report
+
     def debug_dump(self):
         return self.ruleset.debug_dump()
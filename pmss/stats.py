@@ -0,0 +1,233 @@
+'''
+Optional instrumentation for `CombinedRuleset`: which keys are
+queried, which ruleset wins, how often we fall back to defaults, parse
+failures, lookup latency, and how long rulesets take to load.
+
+It's off unless a `Stats` is passed in (see `Settings(instrument=True)`).
+When off, lookups pay a single `is not None` check.
+
+An `exporter` gets every event as it happens, as `exporter(event,
+fields)`, for forwarding to e.g. Prometheus or statsd:
+
+* `"query"`: `{"key", "seconds"}`, for each lookup.
+* `"query_many"`: `{"keys", "seconds"}`, for each batch of lookups
+  (`CombinedRuleset.query_many`). Keys in a batch share their work,
+  so we only time the batch; they count as queried, but aren't in
+  their keys' latency histograms.
+* `"resolve"`: `{"key", "ruleset", "cached"}`, for each value looked
+  up, whether resolved or served from the cache (`cached`). `ruleset`
+  is `None` if we used the field's default. Winners and defaults are
+  counted either way.
+* `"parse_error"`: `{"key"}`.
+* `"load"`: `{"ruleset", "seconds"}`, for each load or reload.
+  `seconds` is `None` if the ruleset doesn't time its loads.
+'''
+
+import sys
+import threading
+
+HISTOGRAM_BUCKETS = 24  # Powers of two of microseconds; the last bucket is 2**22us (~4s) and up
+
+
+def _bucket(seconds):
+    return min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+
+
+def _histogram(counts):
+    '''
+    `{"<1": n, "<2": n, "<4": n, ...}`, in microseconds, leaving out
+    empty buckets.
+    '''
+    labels = [f"<{2 ** bucket}" for bucket in range(HISTOGRAM_BUCKETS - 1)] + [f">={2 ** (HISTOGRAM_BUCKETS - 2)}"]
+    return {label: count for label, count in zip(labels, counts) if count}
+
+
+def approximate_size(root):
+    '''
+    Bytes used by `root` and everything it refers to, by
+    `sys.getsizeof`. Objects shared with other rulesets (e.g. interned
+    strings) are counted in full, so this is an overestimate.
+    '''
+    seen = set()
+    total = 0
+    stack = [root]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, (str, bytes, int, float, bool, type(None))):
+            continue
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        else:
+            if hasattr(item, '__dict__'):
+                stack.append(item.__dict__)
+            for cls in type(item).__mro__:
+                for slot in getattr(cls, '__slots__', ()):
+                    if hasattr(item, slot):
+                        stack.append(getattr(item, slot))
+    return total
+
+
+class _KeyStats():
+    __slots__ = ('queries', 'defaults', 'parse_failures', 'winners', 'latency')
+
+    def __init__(self):
+        self.queries = 0
+        self.defaults = 0
+        self.parse_failures = 0
+        self.winners = {}
+        self.latency = [0] * HISTOGRAM_BUCKETS
+
+
+class Stats():
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+        self.keys = {}       # {key: _KeyStats}
+        self.loads = {}      # {ruleset id: number of (re)loads}
+        self.batches = 0
+        self.batch_latency = [0] * HISTOGRAM_BUCKETS
+        self.lock = threading.Lock()
+
+    def _key(self, key):
+        stats = self.keys.get(key)
+        if stats is None:
+            stats = self.keys[key] = _KeyStats()
+        return stats
+
+    def queried(self, key, seconds):
+        with self.lock:
+            stats = self._key(key)
+            stats.queries += 1
+            stats.latency[_bucket(seconds)] += 1
+        if self.exporter is not None:
+            self.exporter("query", {"key": key, "seconds": seconds})
+
+    def queried_many(self, keys, seconds):
+        with self.lock:
+            for key in keys:
+                self._key(key).queries += 1
+            self.batches += 1
+            self.batch_latency[_bucket(seconds)] += 1
+        if self.exporter is not None:
+            self.exporter("query_many", {"keys": list(keys), "seconds": seconds})
+
+    def resolved(self, key, match, cached=False):
+        '''
+        `match` is the winning `(selector, value)`, or `None` for the
+        field's default. Selectors carry the id of their ruleset as
+        their provenance. `cached` is whether the value came from the
+        cache, rather than the cascade.
+        '''
+        ruleset = str(match[0].provenance) if match else None
+        with self.lock:
+            stats = self._key(key)
+            if ruleset is None:
+                stats.defaults += 1
+            else:
+                stats.winners[ruleset] = stats.winners.get(ruleset, 0) + 1
+        if self.exporter is not None:
+            self.exporter("resolve", {"key": key, "ruleset": ruleset, "cached": cached})
+
+    def parse_failed(self, key):
+        with self.lock:
+            self._key(key).parse_failures += 1
+        if self.exporter is not None:
+            self.exporter("parse_error", {"key": key})
+
+    def loaded(self, ruleset):
+        rulesetid = str(ruleset.id())
+        with self.lock:
+            self.loads[rulesetid] = self.loads.get(rulesetid, 0) + 1
+        if self.exporter is not None:
+            self.exporter("load", {"ruleset": rulesetid, "seconds": ruleset.load_seconds})
+
+    def report(self, rulesets=()):
+        '''
+        Everything so far, as plain dictionaries. Load times and
+        memory come from `rulesets`, as of now.
+        '''
+        with self.lock:
+            keys = {
+                key: {
+                    "queries": stats.queries,
+                    "defaults": stats.defaults,
+                    "parse_failures": stats.parse_failures,
+                    "winners": dict(stats.winners),
+                    "latency_microseconds": _histogram(stats.latency)
+                }
+                for key, stats in self.keys.items()
+            }
+            loads = dict(self.loads)
+            batches = {
+                "queries": self.batches,
+                "latency_microseconds": _histogram(self.batch_latency)
+            }
+        return {
+            "keys": keys,
+            "batches": batches,
+            "rulesets": {
+                str(ruleset.id()): {
+                    "loads": loads.get(str(ruleset.id()), 0),
+                    "last_load_seconds": ruleset.load_seconds,
+                    "approximate_bytes": ruleset.approximate_memory()
+                }
+                for ruleset in rulesets
+            }
+        }
+
+
+def test_counts_include_cache_hits():
+    import os
+    import tempfile
+
+    import pmss.pmsstypes
+    import pmss.rulesets
+    import pmss.schema
+
+    for key in ("test_stats_set", "test_stats_default"):
+        if key not in pmss.schema.default_schema.fields_by_name:
+            pmss.schema.register_field(name=key, type=pmss.pmsstypes.TYPES.integer, default=0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'stats.pmss')
+        with open(filename, 'w') as f:
+            f.write("* {\n    test_stats_set: 1;\n}\n")
+        reports = {}
+        for cache_size in (None, 128):
+            events = []
+            stats = Stats(exporter=lambda event, fields: events.append((event, fields)))
+            combined = pmss.rulesets.CombinedRuleset(
+                [pmss.rulesets.PMSSFileRuleset(filename, rulesetid="sheet")],
+                cache_size=cache_size,
+                stats=stats
+            )
+            combined.load()
+            for repeat in range(3):
+                assert combined.query("test_stats_set", {}) == 1
+                assert combined.query("test_stats_default", {}) == 0
+            combined.query_many(["test_stats_set", "test_stats_default"], {})
+            # Not counted
+            combined.resolve("test_stats_set", {}, record=False)
+            combined.query("test_stats_set", {}, record=False)
+            reports[cache_size] = {
+                key: (counts["queries"], counts["defaults"], counts["winners"])
+                for key, counts in stats.report()["keys"].items()
+            }
+            cached = [fields["cached"] for event, fields in events if event == "resolve"]
+            assert len(cached) == 8
+            assert sum(cached) == (0 if cache_size is None else 6)
+        assert reports[None] == reports[128] == {
+            "test_stats_set": (4, 0, {"sheet": 4}),
+            "test_stats_default": (4, 4, {})
+        }
+
+
+if __name__ == "__main__":
+    test_counts_include_cache_hits()
+    print("All test cases passed successfully.")
@@ -0,0 +1,220 @@
+'''
+Callbacks for when a setting changes, so programs can keep values in
+local variables, rather than reading settings in hot loops just to
+notice changes.
+
+`Subscriptions` listens to a `CombinedRuleset`. When one of its
+rulesets reloads, or rulesets are added or deleted, we re-resolve the
+subscriptions whose key the `pmss.changeset.ChangeSet` mentions (or
+all of them, if the ruleset can't say what changed), and call back
+only those whose value is different.
+
+Callbacks never run on the thread which reloaded. By default, they
+run one at a time, in order, on a shared dispatcher thread
+(`default_dispatcher()`), and should not block for long. A
+subscription with a `loop` is called back on that asyncio event loop
+instead.
+'''
+
+import queue
+import sys
+import threading
+import traceback
+
+
+class Dispatcher():
+    '''
+    Runs callbacks in order, on its own thread, started on first use.
+    '''
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def dispatch(self, callback, *args):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='pmss-Dispatcher', daemon=True)
+                self.thread.start()
+        self.queue.put((callback, args))
+
+    def _run(self):
+        while True:
+            callback, args = self.queue.get()
+            try:
+                callback(*args)
+            except Exception:
+                print("Error in PMSS subscription callback:", file=sys.stderr)
+                print(traceback.format_exc(), file=sys.stderr)
+
+
+_default_dispatcher = None
+_default_dispatcher_lock = threading.Lock()
+
+
+def default_dispatcher():
+    '''
+    The shared, process-wide dispatcher.
+    '''
+    global _default_dispatcher
+    with _default_dispatcher_lock:
+        if _default_dispatcher is None:
+            _default_dispatcher = Dispatcher()
+        return _default_dispatcher
+
+
+class Subscription():
+    '''
+    `value` is the value as of the last callback (or of subscribing).
+    '''
+    def __init__(self, subscriptions, key, context, callback, loop, value):
+        self.subscriptions = subscriptions
+        self.key = key
+        self.context = context
+        self.callback = callback
+        self.loop = loop
+        self.value = value
+
+    def cancel(self):
+        '''
+        Stop calling back. Callbacks already dispatched may still run.
+        '''
+        self.subscriptions.unsubscribe(self)
+
+
+class Subscriptions():
+    def __init__(self, ruleset, dispatcher=None):
+        self.ruleset = ruleset
+        self.dispatcher = dispatcher
+        self.by_key = {}  # {key: [Subscription]}
+        # Reentrant, since resolving may reload (with `watch='stat'`),
+        # which calls back into `ruleset_changed`
+        self.lock = threading.RLock()
+        self.listening = False
+
+    def subscribe(self, key, callback, context=None, loop=None):
+        '''
+        Call `callback(value)` whenever the value of `key` in `context`
+        changes. Returns a `Subscription`.
+        '''
+        if context is None:
+            context = {}
+        with self.lock:
+            if not self.listening:
+                self.ruleset.add_listener(self.ruleset_changed)
+                self.listening = True
+            value = self.ruleset.resolve(key, context, record=False)
+            subscription = Subscription(self, key, context, callback, loop, value)
+            self.by_key.setdefault(key, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.by_key.get(subscription.key, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self.by_key.pop(subscription.key, None)
+
+    def ruleset_changed(self, ruleset, changes=None):
+        '''
+        Listener on our `CombinedRuleset`. We resolve under the lock,
+        so callbacks for one subscription are dispatched in the order
+        of the changes.
+        '''
+        # Rulesets added to the stack notify before they load, and
+        # again once they have
+        if not all(member.loaded for member in self.ruleset.rulesets):
+            return
+        with self.lock:
+            if changes is None:
+                keys = list(self.by_key)
+            else:
+                keys = [key for key in changes.keys() if key in self.by_key]
+            for key in keys:
+                for subscription in list(self.by_key.get(key, [])):
+                    try:
+                        value = self.ruleset.resolve(key, subscription.context, record=False)
+                    except ValueError:
+                        print(f"Could not resolve subscribed key `{key}`; keeping the old value.", file=sys.stderr)
+                        print(traceback.format_exc(), file=sys.stderr)
+                        continue
+                    if value == subscription.value:
+                        continue
+                    subscription.value = value
+                    self._dispatch(subscription, value)
+
+    def _dispatch(self, subscription, value):
+        if subscription.loop is not None:
+            subscription.loop.call_soon_threadsafe(subscription.callback, value)
+        else:
+            (self.dispatcher or default_dispatcher()).dispatch(subscription.callback, value)
+
+
+def test_callbacks():
+    import os
+    import tempfile
+
+    import pmss.pmsstypes
+    import pmss.rulesets
+    import pmss.schema
+
+    keys = ("test_subscribed", "test_unsubscribed")
+    for key in keys:
+        if key not in pmss.schema.default_schema.fields_by_name:
+            pmss.schema.register_field(name=key, type=pmss.pmsstypes.TYPES.integer)
+
+    def write(filename, subscribed, unsubscribed):
+        with open(filename, 'w') as f:
+            f.write(f"* {{\n    test_subscribed: {subscribed};\n    test_unsubscribed: {unsubscribed};\n}}\n")
+
+    dispatcher = Dispatcher()
+
+    def flush():
+        # Callbacks run in order, so once this one has, so have the rest
+        done = threading.Event()
+        dispatcher.dispatch(done.set)
+        assert done.wait(10)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'subscribed.pmss')
+        for incremental in (False, True):
+            write(filename, 1, 1)
+            ruleset = pmss.rulesets.PMSSFileRuleset(filename, incremental=incremental)
+            combined = pmss.rulesets.CombinedRuleset([ruleset])
+            combined.load()
+            subscriptions = Subscriptions(combined, dispatcher=dispatcher)
+            calls = []
+            subscription = subscriptions.subscribe("test_subscribed", calls.append)
+            assert subscription.value == 1
+
+            # Reloads which leave our value alone don't call back
+            ruleset.reload()
+            write(filename, 1, 2)
+            ruleset.reload()
+            flush()
+            assert calls == []
+
+            # A change calls back exactly once
+            write(filename, 2, 2)
+            ruleset.reload()
+            flush()
+            assert calls == [2]
+            assert subscription.value == 2
+            ruleset.reload()
+            combined.load()
+            flush()
+            assert calls == [2]
+
+            # Nor after we cancel
+            subscription.cancel()
+            write(filename, 3, 3)
+            ruleset.reload()
+            flush()
+            assert calls == [2]
+            assert subscriptions.by_key == {}
+
+
+if __name__ == "__main__":
+    test_callbacks()
+    print("All test cases passed successfully.")
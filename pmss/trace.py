@@ -0,0 +1,144 @@
+'''
+A record of one lookup, step by step, for `Settings.explain()`.
+
+A `Trace` is passed down the same code path as `Settings.get()`
+(`CombinedRuleset.query`, `resolve` and `parse`), each of which
+records what it did, and how long it took. So the trace shows what
+`get()` actually does, cache and all, and doubles as a profile of a
+single lookup. On a cache hit, the cascade is run anyway, so the trace
+still shows where the value came from; `cached` is set, and that time
+is left out of the totals.
+
+For each ruleset consulted, we also list the candidate selectors, and
+whether each matches. That's worked out after the fact (the lookup
+itself stops at the first match, and skips candidates its index rules
+out), from the same index the lookup used, and its time is left out
+of the totals. Rulesets which may block (e.g. SQLite) only give their
+match, since listing their candidates means reading every rule.
+'''
+
+import time
+
+
+def describe(selector):
+    return {
+        "selector": str(selector),
+        "provenance": str(selector.provenance),
+        "specificity": selector.css_specificity()
+    }
+
+
+def _candidates(selector_index, context):
+    '''
+    `(candidates, skipped)`: the selectors in `selector_index` which
+    would be checked for `context`, in order of precedence, each with
+    whether it matches, and how many more the index rules out without
+    checking. `(None, None)` if there's no index.
+    '''
+    if selector_index is None:
+        return None, None
+    positions = selector_index.candidates(**context)
+    candidates = []
+    for position in positions:
+        selector, value = selector_index.entries[position]
+        candidate = describe(selector)
+        candidate["value"] = value
+        candidate["matched"] = bool(selector.match(**context))
+        candidates.append(candidate)
+    return candidates, len(selector_index) - len(candidates)
+
+
+class Trace():
+    def __init__(self, key, context):
+        self.key = key
+        self.context = context
+        self.steps = []
+        self.winner = None  # The winning selector, or `None` for the default
+        self.cached = False  # Whether the value came from the cache
+        self.overhead = 0.0  # Time spent on the trace itself
+        self.start = time.perf_counter()
+
+    def step(self, step, seconds, **fields):
+        self.steps.append(dict(step=step, seconds=seconds, **fields))
+
+    def ruleset(self, ruleset, match, seconds, selector_index=None):
+        '''
+        `ruleset` was asked for its best match, and gave `match`, from
+        `selector_index` (see `Ruleset._traced_match`).
+        '''
+        start = time.perf_counter()
+        candidates, skipped = _candidates(selector_index, self.context)
+        fields = {
+            "ruleset": str(ruleset.id()),
+            "candidates": candidates,
+            "skipped_by_index": skipped,
+            "match": None
+        }
+        if match:
+            fields["match"] = describe(match[0])
+            fields["match"]["value"] = match[1]
+        self.step("ruleset", seconds, **fields)
+        self.overhead += time.perf_counter() - start
+
+    def report(self, value=None, error=None):
+        return {
+            "key": self.key,
+            "context": self.context,
+            "steps": self.steps,
+            "winner": self.winner,
+            "cached": self.cached,
+            "value": value,
+            "error": error,
+            "seconds": time.perf_counter() - self.start - self.overhead
+        }
+
+
+def test_candidates_from_lookup():
+    import os
+    import tempfile
+
+    import pmss.pmssselectors
+    import pmss.pmsstypes
+    import pmss.rulesets
+    import pmss.schema
+
+    if "test_trace" not in pmss.schema.default_schema.fields_by_name:
+        pmss.schema.register_field(name="test_trace", type=pmss.pmsstypes.TYPES.string)
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'rules.db')
+        filename = os.path.join(directory, 'rules.pmss')
+        with open(filename, 'w') as f:
+            f.write("* { test_trace: default; }\n.dev { test_trace: dev; }\n.other { test_trace: other; }\n")
+        sqlite = pmss.rulesets.SQLiteRuleset(database, rulesetid="sqlite")
+        sheet = pmss.rulesets.PMSSFileRuleset(filename, rulesetid="sheet", watch='stat')
+        for cache_size in (None, 8):
+            combined = pmss.rulesets.CombinedRuleset([sqlite, sheet], cache_size=cache_size)
+            combined.load()
+            sqlite.set_rule("test_trace", pmss.pmssselectors.ClassSelector("admin"), "admin")
+
+            # Listing SQLite's candidates would read every rule
+            sqlite.candidates = sqlite.selector_index = None
+            checks = []
+            sheet.check_changes = lambda: checks.append(1)
+            for repeat in range(2):
+                checks.clear()
+                trace = Trace("test_trace", {"classes": ["dev"]})
+                assert combined.query("test_trace", trace.context, trace=trace, record=False) == "dev"
+                # Checked once, for the lookup itself
+                assert len(checks) == 1
+                steps = {step["ruleset"]: step for step in trace.steps if step["step"] == "ruleset"}
+                assert steps["sqlite"]["candidates"] is None and steps["sqlite"]["match"] is None
+                assert [(candidate["selector"], candidate["matched"]) for candidate in steps["sheet"]["candidates"]] == [
+                    (".dev / sheet", True), ("*", True)
+                ]
+                assert steps["sheet"]["skipped_by_index"] == 1
+                assert steps["sheet"]["match"]["value"] == "dev"
+                assert trace.cached == (cache_size is not None and repeat == 1)
+            del sqlite.candidates, sqlite.selector_index, sheet.check_changes
+        sqlite.close()
+
+
+if __name__ == "__main__":
+    test_candidates_from_lookup()
+    print("All test cases passed successfully.")
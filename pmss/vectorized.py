@@ -0,0 +1,347 @@
+'''
+Resolve one key over a large batch of contexts at once.
+
+Nightly and roster jobs need e.g. `roster_source` for every school,
+classroom, and student. Rather than calling `Settings.get` in a loop,
+we take the contexts as columns:
+
+    batch = pmss.ContextBatch(
+        classes={'dev': numpy.array([True, False, ...])},
+        attributes={'school': ['middlesex', None, ...]}
+    )
+    sources = settings.get_batch('roster_source', batch)
+
+and evaluate each candidate selector once, as a NumPy boolean mask
+over the rows it could apply to. Since each ruleset keeps its
+selectors in order of precedence, the winner for a row is the first
+candidate which matches it. The results are the same as calling `get` with
+`batch.context(row)` for each row.
+
+This requires NumPy, which is an optional dependency.
+'''
+
+import pmss.pmssselectors
+import pmss.selectorindex
+
+# {bucket kind: attribute operator}, e.g. `'attribute_prefix': '^='`
+_OPERATORS = {kind: operator for operator, kind in pmss.selectorindex.OPERATOR_KINDS.items()}
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise ImportError(
+            'Vectorized resolution requires NumPy. Install it with `pip install numpy`.'
+        ) from e
+    return numpy
+
+
+class ContextBatch():
+    '''
+    A batch of contexts, stored by column. All columns have one entry
+    per row:
+
+    * `ids`: the id for each row (or `None`)
+    * `types` / `classes`: `{name: booleans}`, whether each row has
+      the type / class
+    * `attributes`: `{name: values}`, with `None` where a row doesn't
+      have the attribute
+    '''
+    def __init__(self, size=None, ids=None, types=None, classes=None, attributes=None):
+        np = _numpy()
+        columns = [ids] + list((types or {}).values()) + list((classes or {}).values()) + list((attributes or {}).values())
+        lengths = set(len(column) for column in columns if column is not None)
+        if size is not None:
+            lengths.add(size)
+        if len(lengths) > 1:
+            raise ValueError(f"All columns in a ContextBatch need the same length, not {sorted(lengths)}")
+        if not lengths:
+            raise ValueError("Please give a size, or at least one column, for a ContextBatch")
+        self.size = lengths.pop()
+
+        self.ids = None if ids is None else np.asarray(ids, dtype=object)
+        self.types = {name: np.asarray(column, dtype=bool) for name, column in (types or {}).items()}
+        self.classes = {name: np.asarray(column, dtype=bool) for name, column in (classes or {}).items()}
+        self.attributes = {name: np.asarray(column, dtype=object) for name, column in (attributes or {}).items()}
+
+    def __len__(self):
+        return self.size
+
+    def context(self, row):
+        '''
+        The context for one row, as would be passed to `Settings.get`.
+        '''
+        return {
+            "id": None if self.ids is None else self.ids[row],
+            "types": [name for name, column in self.types.items() if column[row]],
+            "classes": [name for name, column in self.classes.items() if column[row]],
+            "attributes": {
+                name: column[row] for name, column in self.attributes.items()
+                if column[row] is not None
+            }
+        }
+
+
+class _Rows():
+    '''
+    Evaluates selectors over subsets of the rows in a batch.
+
+    We use each ruleset's `SelectorIndex`: every selector is filed
+    under one component (e.g. `[school=middlesex]`), so we only need
+    to evaluate it on the rows which have that component, rather than
+    on the whole batch.
+    '''
+    def __init__(self, batch):
+        self.np = _numpy()
+        self.batch = batch
+        self.groups = {}
+        self.component_rows = {}
+
+    def rows_by_value(self, name, column):
+        '''
+        `{value: row indices}` for a column, or `None` if some value
+        isn't hashable.
+        '''
+        if name not in self.groups:
+            groups = {}
+            try:
+                for row, value in enumerate(column):
+                    if value is not None:
+                        groups.setdefault(value, []).append(row)
+            except TypeError:
+                groups = None
+            else:
+                groups = {value: self.np.asarray(rows) for value, rows in groups.items()}
+            self.groups[name] = groups
+        return self.groups[name]
+
+    def rows_for(self, component):
+        '''
+        Indices of the rows with an index component, such as
+        `('class', 'dev')`.
+        '''
+        if component in self.component_rows:
+            return self.component_rows[component]
+        np = self.np
+        batch = self.batch
+        kind, name = component
+        rows = None
+        if kind == 'id' and batch.ids is not None:
+            groups = self.rows_by_value(('id',), batch.ids)
+            rows = np.flatnonzero(batch.ids == name) if groups is None else groups.get(name)
+        elif kind == 'class' and name in batch.classes:
+            rows = np.flatnonzero(batch.classes[name])
+        elif kind == 'type' and name in batch.types:
+            rows = np.flatnonzero(batch.types[name])
+        elif kind == 'attribute' and name in batch.attributes:
+            rows = np.flatnonzero(np.not_equal(batch.attributes[name], None))
+        elif kind == 'attribute_value' and name[0] in batch.attributes:
+            attribute, value = name
+            column = batch.attributes[attribute]
+            groups = self.rows_by_value(('attribute', attribute), column)
+            if groups is None:
+                rows = np.flatnonzero(np.not_equal(column, None) & np.asarray(column == value, dtype=bool))
+            else:
+                rows = groups.get(value)
+        elif kind in _OPERATORS and name[0] in batch.attributes:
+            attribute, value = name
+            selector = pmss.pmssselectors.AttributeSelector(attribute, _OPERATORS[kind], value)
+            column = batch.attributes[attribute]
+            groups = self.rows_by_value(('attribute', attribute), column)
+            if groups is None:
+                rows = np.flatnonzero(self.test_column(selector, column))
+            else:
+                # Each distinct value is tested once
+                matched = [group for group_value, group in groups.items() if selector.match_value(group_value)]
+                rows = np.sort(np.concatenate(matched)) if matched else None
+        if rows is None:
+            rows = np.zeros(0, dtype=np.intp)
+        self.component_rows[component] = rows
+        return rows
+
+    def test_column(self, selector, column):
+        '''
+        Boolean array: does each value of `column` match an attribute
+        `selector`? `None` is a missing attribute.
+        '''
+        return self.np.fromiter(
+            (value is not None and selector.match_value(value) for value in column),
+            dtype=bool,
+            count=len(column)
+        )
+
+    def matches(self, selector, rows):
+        '''
+        Boolean array: does `selector` match each of `rows`?
+        '''
+        np = self.np
+        batch = self.batch
+        if isinstance(selector, (pmss.pmssselectors.UniversalSelector, pmss.pmssselectors.NullSelector)):
+            return np.ones(len(rows), dtype=bool)
+        if isinstance(selector, pmss.pmssselectors.CompoundSelector):
+            mask = np.ones(len(rows), dtype=bool)
+            for child in selector.selectors:
+                mask &= self.matches(child, rows)
+            return mask
+        if isinstance(selector, pmss.pmssselectors.IDSelector):
+            if batch.ids is None:
+                return np.zeros(len(rows), dtype=bool)
+            return np.asarray(batch.ids[rows] == selector.id_name, dtype=bool)
+        if isinstance(selector, pmss.pmssselectors.ClassSelector):
+            if selector.class_name not in batch.classes:
+                return np.zeros(len(rows), dtype=bool)
+            return batch.classes[selector.class_name][rows]
+        if isinstance(selector, pmss.pmssselectors.TypeSelector):
+            if selector.element_type not in batch.types:
+                return np.zeros(len(rows), dtype=bool)
+            return batch.types[selector.element_type][rows]
+        if isinstance(selector, pmss.pmssselectors.AttributeSelector) and selector.operator in (None, '='):
+            if selector.attribute not in batch.attributes:
+                return np.zeros(len(rows), dtype=bool)
+            column = batch.attributes[selector.attribute][rows]
+            present = np.not_equal(column, None)
+            if selector.operator is None:
+                return present
+            return present & np.asarray(column == selector.value, dtype=bool)
+        if isinstance(selector, pmss.pmssselectors.AttributeSelector):
+            if selector.attribute not in batch.attributes:
+                return np.zeros(len(rows), dtype=bool)
+            return self.test_column(selector, batch.attributes[selector.attribute][rows])
+        # Anything else, we check row-by-row, so we never disagree with `match()`
+        return np.fromiter(
+            (selector.match(**batch.context(row)) for row in rows),
+            dtype=bool,
+            count=len(rows)
+        )
+
+    def first_matches(self, selector_index, unresolved):
+        '''
+        For each row, the position in `selector_index.entries` of the
+        first selector which matches it, or `len(entries)` if none
+        does. Rows not in `unresolved` are skipped.
+        '''
+        np = self.np
+        entries = selector_index.entries
+        best = np.full(len(self.batch), len(entries), dtype=np.intp)
+        buckets = [(positions, self.rows_for(component)) for component, positions in selector_index.buckets.items()]
+        buckets.append((selector_index.always, np.flatnonzero(unresolved)))
+        for positions, rows in buckets:
+            rows = rows[unresolved[rows]]
+            for position in positions:
+                if not len(rows):
+                    break
+                matched = rows[self.matches(entries[position][0], rows)]
+                best[matched] = np.minimum(best[matched], position)
+                # Later positions in this bucket can't beat this one
+                rows = rows[best[rows] > position]
+        return best
+
+
+def _fill(values, mask, value):
+    '''
+    `values[mask] = value`, without NumPy unpacking list values.
+    '''
+    np = _numpy()
+    scalar = np.empty((), dtype=object)
+    scalar[()] = value
+    values[mask] = scalar
+
+
+def resolve(ruleset, key, batch):
+    '''
+    Resolve `key` for every row of `batch` against a `CombinedRuleset`,
+    returning a NumPy object array of parsed values.
+    '''
+    np = _numpy()
+    rows = _Rows(batch)
+    values = np.empty(len(batch), dtype=object)
+    unresolved = np.ones(len(batch), dtype=bool)
+
+    for subruleset in ruleset.rulesets:
+        if not unresolved.any():
+            break
+        selector_index = subruleset.selector_index(key)
+        if selector_index is None:
+            # This ruleset can't list its selectors; ask it row by row
+            for row in np.flatnonzero(unresolved):
+                match = subruleset.best_match(key, batch.context(row))
+                if match:
+                    values[row] = ruleset.parse(key, match)
+                    unresolved[row] = False
+            continue
+        best = rows.first_matches(selector_index, unresolved)
+        matched = np.flatnonzero(best < len(selector_index.entries))
+        # Parse each winning value once, then scatter to its rows
+        positions, inverse = np.unique(best[matched], return_inverse=True)
+        parsed = np.empty(len(positions), dtype=object)
+        for i, position in enumerate(positions):
+            parsed[i] = ruleset.parse(key, selector_index.entries[position])
+        values[matched] = parsed[inverse]
+        unresolved[matched] = False
+
+    if unresolved.any():
+        _fill(values, unresolved, ruleset.parse(key, None))
+    return values
+
+
+def test_resolve_matches_query():
+    import random
+
+    import pmss.pmsstypes
+    import pmss.rulesets
+    import pmss.schema
+
+    rng = random.Random(1731)
+    key = "test_vectorized"
+    missing = "test_vectorized_missing"
+    if key not in pmss.schema.default_schema.fields_by_name:
+        pmss.schema.register_field(name=key, type=pmss.pmsstypes.TYPES.string, default="fallback")
+        pmss.schema.register_field(name=missing, type=pmss.pmsstypes.TYPES.string)
+
+    class Unlisted(pmss.rulesets.Ruleset):
+        # Can't list its selectors, so rows are resolved one by one
+        def __init__(self, selector_dict):
+            super().__init__(rulesetid="unlisted")
+            self.selector_dict = selector_dict
+            self.loaded = True
+
+        def query(self, key_, context):
+            if key_ != key:
+                return []
+            return pmss.selectorindex._linear_scan(self.selector_dict, context)
+
+    size = 200
+    for trial in range(30):
+        rulesets = []
+        for position in range(rng.randint(1, 3)):
+            selector_dict = pmss.selectorindex._random_selector_dict(rng, rules=15)
+            if rng.random() < 0.3:
+                rulesets.append(Unlisted(selector_dict))
+            else:
+                ruleset = pmss.rulesets.IndexedRuleset(rulesetid=f"indexed{position}")
+                ruleset.publish({key: selector_dict} if selector_dict else {})
+                rulesets.append(ruleset)
+        combined = pmss.rulesets.CombinedRuleset(rulesets)
+
+        # Contexts from `_random_selector`'s vocabulary, including
+        # non-string attribute values, and rows missing each column
+        batch = ContextBatch(
+            ids=[rng.choice([None, 'alice', 'bob']) for row in range(size)],
+            types={name: [rng.random() < 0.5 for row in range(size)] for name in ('roster', 'grade')},
+            classes={name: [rng.random() < 0.5 for row in range(size)] for name in ('dev', 'prod', 'roster')},
+            attributes={'school': [rng.choice(pmss.selectorindex._TEST_VALUES + [None, 3]) for row in range(size)]}
+        )
+        for lookup in (key, missing):
+            values = resolve(combined, lookup, batch)
+            expected = [combined.query(lookup, batch.context(row)) for row in range(size)]
+            assert list(values) == expected, (lookup, [
+                (batch.context(row), value, wanted)
+                for row, (value, wanted) in enumerate(zip(values, expected))
+                if value != wanted
+            ][:3])
+
+
+if __name__ == "__main__":
+    test_resolve_matches_query()
+    print("All test cases passed successfully.")
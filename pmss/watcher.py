@@ -0,0 +1,425 @@
+'''
+Background file watching, so rulesets can reload when their files
+change without touching the filesystem on every settings read.
+
+There is one shared watcher thread per process (`default_watcher()`).
+On Linux, it uses inotify on each watched file's directory, which
+catches editors which save by writing a temporary file and renaming
+it over the original. If the file is a symlink (as with Kubernetes
+ConfigMaps, which swap a `..data` link to a new directory on each
+update), we also watch the directory of the file it points to, and
+notice when it starts pointing elsewhere. Elsewhere (or if inotify isn't available), it
+falls back to polling `os.stat` every second or so.
+
+Writes tend to come in bursts (truncate, write, write, rename), so we
+debounce: a callback fires once no events have arrived for that path
+for `debounce` seconds.
+
+Callbacks run on the watcher thread, and should not block for long.
+Bound methods are held weakly, so watching a file doesn't keep its
+ruleset alive.
+'''
+
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import traceback
+import weakref
+
+# From <sys/inotify.h>
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_MASK = (
+    _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM
+    | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+)
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _reference(callback):
+    '''
+    A function returning `callback`, or `None` once it's been garbage
+    collected.
+    '''
+    if hasattr(callback, '__self__') and hasattr(callback, '__func__'):
+        return weakref.WeakMethod(callback)
+    return lambda: callback
+
+
+class Watcher():
+    '''
+    Base class for watchers. Subclasses wait for changes in `_wait()`,
+    and call `_changed(path)` for each path which may have changed.
+    '''
+    def __init__(self, debounce=0.1):
+        self.debounce = debounce
+        self.callbacks = {}  # {path: [callback reference]}
+        self.pending = {}    # {path: time at which to fire}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = None
+
+    def watch(self, path, callback):
+        '''
+        Call `callback(path)` after `path` changes.
+        '''
+        path = os.path.abspath(path)
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('This watcher has been closed.')
+            self._add(path)
+            self.callbacks.setdefault(path, []).append(_reference(callback))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=f'pmss-{type(self).__name__}', daemon=True)
+                self.thread.start()
+
+    def unwatch(self, path, callback):
+        '''
+        Stop calling `callback` for `path`. Once nothing watches
+        `path`, we stop watching it.
+        '''
+        path = os.path.abspath(path)
+        with self.lock:
+            references = self.callbacks.get(path, [])
+            self.callbacks[path] = [
+                reference for reference in references
+                if reference() is not None and reference() != callback
+            ]
+            if not self.callbacks[path]:
+                del self.callbacks[path]
+                self.pending.pop(path, None)
+                self._remove(path)
+
+    def close(self):
+        '''
+        Stop the watcher thread. No callbacks fire after this returns.
+        '''
+        with self.lock:
+            self.closed = True
+            self.callbacks = {}
+            self.pending = {}
+        self._wake()
+        if self.thread is threading.current_thread():
+            # Called from a callback; the thread exits when it returns
+            return
+        if self.thread is not None:
+            self.thread.join()
+        self._release()
+
+    def _add(self, path):
+        pass
+
+    def _remove(self, path):
+        '''
+        Called, with the lock held, once nothing watches `path`.
+        '''
+        pass
+
+    def _wake(self):
+        pass
+
+    def _release(self):
+        '''
+        Free any resources, once the thread has stopped.
+        '''
+        pass
+
+    def _wait(self, timeout):
+        raise NotImplementedError('This should always be called on a subclass')
+
+    def _changed(self, path):
+        '''
+        Note a possible change, and (re)start its debounce timer.
+        '''
+        if path in self.callbacks:
+            self.pending[path] = time.monotonic() + self.debounce
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if self.closed:
+                    return
+                now = time.monotonic()
+                due = [path for path, deadline in self.pending.items() if deadline <= now]
+                for path in due:
+                    del self.pending[path]
+                fire = [(path, list(self.callbacks.get(path, []))) for path in due]
+                timeout = max(0, min(self.pending.values()) - now) if self.pending else None
+            for path, references in fire:
+                for reference in references:
+                    callback = reference()
+                    if callback is None:
+                        continue
+                    try:
+                        callback(path)
+                    except Exception:
+                        print(f"Error in PMSS file watcher callback for {path}:", file=sys.stderr)
+                        print(traceback.format_exc(), file=sys.stderr)
+            self._wait(timeout)
+
+
+class PollingWatcher(Watcher):
+    '''
+    Portable fallback: `os.stat` each watched file every `interval`
+    seconds.
+    '''
+    def __init__(self, interval=1.0, debounce=0.1):
+        super().__init__(debounce=debounce)
+        self.interval = interval
+        self.signatures = {}
+        self.wakeup = threading.Event()
+
+    @staticmethod
+    def _signature(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _add(self, path):
+        if path not in self.signatures:
+            self.signatures[path] = self._signature(path)
+
+    def _remove(self, path):
+        self.signatures.pop(path, None)
+
+    def _wake(self):
+        self.wakeup.set()
+
+    def _wait(self, timeout):
+        if timeout is None or timeout > self.interval:
+            timeout = self.interval
+        self.wakeup.wait(timeout)
+        self.wakeup.clear()
+        with self.lock:
+            for path in list(self.callbacks):
+                signature = self._signature(path)
+                if signature != self.signatures.get(path):
+                    self.signatures[path] = signature
+                    self._changed(path)
+
+
+class InotifyWatcher(Watcher):
+    '''
+    Linux inotify, via `ctypes`. We watch directories rather than
+    files, since a rename-over-the-original replaces the inode we'd
+    otherwise be watching.
+    '''
+    def __init__(self, debounce=0.1):
+        super().__init__(debounce=debounce)
+        import ctypes
+        self.ctypes = ctypes
+        # The C library is already loaded into the process
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = self.ctypes.get_errno()
+            raise OSError(error, f'inotify_init1: {os.strerror(error)}')
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.directories = {}  # {watch descriptor: directory}
+        self.targets = {}      # {path: the file it resolves to, through any symlinks}
+
+    def _add(self, path):
+        self._add_directory(os.path.dirname(path))
+        target = os.path.realpath(path)
+        self.targets[path] = target
+        if target != path:
+            self._add_directory(os.path.dirname(target))
+
+    def _add_directory(self, directory):
+        if directory in self.directories.values():
+            return
+        descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), _IN_MASK)
+        if descriptor < 0:
+            error = self.ctypes.get_errno()
+            raise OSError(error, f'inotify_add_watch: {os.strerror(error)}', directory)
+        self.directories[descriptor] = directory
+
+    def _remove(self, path):
+        self.targets.pop(path, None)
+        self._prune()
+
+    def _prune(self):
+        '''
+        Stop watching directories which none of our paths, or the
+        files they resolve to, are in any more.
+        '''
+        needed = set()
+        for path, target in self.targets.items():
+            needed.add(os.path.dirname(path))
+            needed.add(os.path.dirname(target))
+        for descriptor, directory in list(self.directories.items()):
+            if directory not in needed:
+                del self.directories[descriptor]
+                # Fails if the kernel already dropped the watch, e.g.
+                # because the directory was deleted. That's fine.
+                self.libc.inotify_rm_watch(self.fd, descriptor)
+
+    def _retarget(self):
+        '''
+        Follow symlinks which now point somewhere else, and note their
+        paths as changed.
+        '''
+        retargeted = False
+        for path, target in list(self.targets.items()):
+            new_target = os.path.realpath(path)
+            if new_target == target:
+                continue
+            self.targets[path] = new_target
+            self._changed(path)
+            retargeted = True
+            try:
+                self._add_directory(os.path.dirname(new_target))
+            except OSError:
+                # Gone again already; the next event will tell
+                pass
+        if retargeted:
+            # e.g. the directory a ConfigMap's `..data` used to point to
+            self._prune()
+
+    def _wake(self):
+        os.write(self.wakeup_write, b'x')
+
+    def _wait(self, timeout):
+        readable, _, _ = select.select([self.fd, self.wakeup_read], [], [], timeout)
+        if self.wakeup_read in readable:
+            os.read(self.wakeup_read, 4096)
+        if self.fd not in readable:
+            return
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        with self.lock:
+            offset = 0
+            while offset < len(buffer):
+                descriptor, mask, cookie, length = _EVENT_HEADER.unpack_from(buffer, offset)
+                offset += _EVENT_HEADER.size
+                name = buffer[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & _IN_Q_OVERFLOW:
+                    # We lost events; assume everything changed
+                    for path in self.callbacks:
+                        self._changed(path)
+                    continue
+                directory = self.directories.get(descriptor)
+                if directory is not None and name:
+                    changed = os.path.join(directory, os.fsdecode(name))
+                    self._changed(changed)
+                    # Symlinks to the file which changed
+                    for path, target in self.targets.items():
+                        if target == changed and path != changed:
+                            self._changed(path)
+            self._retarget()
+
+    def _release(self):
+        for fd in (self.fd, self.wakeup_read, self.wakeup_write):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.fd = self.wakeup_read = self.wakeup_write = -1
+
+
+_default_watcher = None
+_default_watcher_lock = threading.Lock()
+
+
+def default_watcher():
+    '''
+    The shared, process-wide watcher: inotify where we can, polling
+    otherwise.
+    '''
+    global _default_watcher
+    with _default_watcher_lock:
+        if _default_watcher is None:
+            try:
+                _default_watcher = InotifyWatcher()
+            except (OSError, AttributeError):
+                # Not Linux, or no inotify in this libc
+                _default_watcher = PollingWatcher()
+        return _default_watcher
+
+
+def test_unwatch():
+    import tempfile
+
+    import pmss.rulesets
+
+    def kernel_watches(watcher):
+        # The watch descriptors the kernel has for us
+        with open(f'/proc/self/fdinfo/{watcher.fd}') as f:
+            return {int(line.split()[1][3:], 16) for line in f if line.startswith('inotify wd:')}
+
+    def callback(path):
+        pass
+
+    def other_callback(path):
+        pass
+
+    with tempfile.TemporaryDirectory() as root:
+        first, second, linked = (os.path.join(root, name) for name in ('first', 'second', 'linked'))
+        for directory in (first, second, linked):
+            os.mkdir(directory)
+        a, b, c = (os.path.join(first, name) for name in ('a.pmss', 'b.pmss', 'c.pmss'))
+        target = os.path.join(linked, 'target.pmss')
+        for filename in (a, b, target):
+            with open(filename, 'w') as f:
+                f.write('* {}\n')
+        os.symlink(target, c)
+
+        polling = PollingWatcher(interval=0.01)
+        polling.watch(a, callback)
+        polling.unwatch(a, callback)
+        assert polling.signatures == {} and polling.callbacks == {}
+        polling.close()
+
+        try:
+            watcher = InotifyWatcher()
+        except (OSError, AttributeError):
+            return
+        try:
+            watcher.watch(a, callback)
+            watcher.watch(a, other_callback)
+            watcher.watch(b, callback)
+            watcher.watch(c, callback)
+            assert sorted(watcher.directories.values()) == [first, linked]
+            assert set(watcher.directories) == kernel_watches(watcher)
+
+            # Still wanted by `other_callback`, and by `b` and `c`
+            watcher.unwatch(a, callback)
+            watcher.unwatch(b, callback)
+            assert sorted(watcher.directories.values()) == [first, linked]
+            # `c`'s target is the only reason to watch `linked`
+            watcher.unwatch(c, callback)
+            assert list(watcher.directories.values()) == [first]
+            assert list(watcher.targets) == [a]
+            watcher.unwatch(a, other_callback)
+            assert watcher.directories == {} and watcher.targets == {} and watcher.callbacks == {}
+            assert kernel_watches(watcher) == set()
+
+            # As do file rulesets deleted from a stack
+            ruleset = pmss.rulesets.PMSSFileRuleset(a, rulesetid='watched', watch=watcher)
+            combined = pmss.rulesets.CombinedRuleset([ruleset])
+            combined.load()
+            assert list(watcher.directories.values()) == [first]
+            combined.delete_ruleset('watched')
+            assert watcher.directories == {} and watcher.callbacks == {}
+            assert kernel_watches(watcher) == set()
+        finally:
+            watcher.close()
+
+
+if __name__ == "__main__":
+    test_unwatch()
+    print("All test cases passed successfully.")